@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """Tracks the job failure rate over a sliding time window and trips,
+    once it exceeds a threshold.
+
+    A tripped (open) breaker rejects all jobs. After `probe_interval`
+    seconds, it lets a single probe job through (half-open). If the probe
+    succeeds the breaker closes again, otherwise it stays open for another
+    `probe_interval`.
+
+    :param threshold: Failure rate between zero and one at which the breaker
+        trips.
+    :type threshold: float
+    :param window: Length of the sliding window in seconds.
+    :type window: int
+    :param min_jobs: Minimum number of jobs inside the window, before the
+        breaker can trip.
+    :type min_jobs: int
+    :param probe_interval: Number of seconds between two probes of an open
+        breaker.
+    :type probe_interval: int
+    """
+
+    def __init__(self, threshold=0.5, window=60, min_jobs=10,
+                 probe_interval=30):
+        self.threshold = threshold
+        self.window = window
+        self.min_jobs = min_jobs
+        self.probe_interval = probe_interval
+        self.state = CLOSED
+        self.opened = None
+        self.probing = False
+        self.total = 0
+        self.failures = 0
+        # one [second, total, failures] bucket per second
+        self._buckets = deque()
+
+    def _expire(self, now):
+        buckets = self._buckets
+        cutoff = now - self.window
+        while buckets and buckets[0][0] <= cutoff:
+            second, total, failures = buckets.popleft()
+            self.total -= total
+            self.failures -= failures
+
+    def _reset(self):
+        self._buckets.clear()
+        self.total = 0
+        self.failures = 0
+
+    def _trip(self, now):
+        self.state = OPEN
+        self.opened = now
+        self.probing = False
+        self._reset()
+
+    @property
+    def failure_rate(self):
+        if not self.total:
+            return 0.0
+        return float(self.failures) / self.total
+
+    def next_probe(self):
+        """Returns the time at which an open breaker allows the next probe
+        or `None` if the breaker isn't open.
+        """
+        if self.state != OPEN:
+            return None
+        return self.opened + self.probe_interval
+
+    def allow(self, now=None):
+        """Returns `True` if a job may be run. A half-open breaker allows
+        only one probe job, until its outcome is recorded or the probe is
+        cancelled.
+        """
+        if self.state == CLOSED:
+            return True
+        if now is None:
+            now = time.time()
+        if self.probing or now < self.opened + self.probe_interval:
+            return False
+        self.state = HALF_OPEN
+        self.probing = True
+        return True
+
+    def cancel(self):
+        """Give back an unused probe, for example if there was no message
+        to process. The breaker stays half-open and allows the next job
+        as a probe.
+        """
+        self.probing = False
+
+    def record(self, success, now=None):
+        """Record the outcome of a job. Returns `True` if the breaker has
+        tripped because of it.
+        """
+        if now is None:
+            now = time.time()
+        if self.state != CLOSED:
+            if success:
+                self.state = CLOSED
+                self.opened = None
+                self.probing = False
+                self._reset()
+                return False
+            self._trip(now)
+            return True
+        self._expire(now)
+        second = int(now)
+        buckets = self._buckets
+        if not buckets or buckets[-1][0] != second:
+            buckets.append([second, 0, 0])
+        buckets[-1][1] += 1
+        self.total += 1
+        if not success:
+            buckets[-1][2] += 1
+            self.failures += 1
+            if (self.total >= self.min_jobs and
+                    self.failure_rate >= self.threshold):
+                self._trip(now)
+                return True
+        return False
+
+
+class CircuitBreakers(object):
+    """A set of circuit breakers, one per queue or a single one for the
+    whole worker, depending on the `scope`.
+
+    :param scope: Either `queue` or `worker`.
+    :type scope: str
+    :param threshold: Failure rate at which the breakers trip. Zero disables
+        all breakers.
+    :type threshold: float
+
+    All other keyword arguments are passed to each
+    :py:class:`CircuitBreaker`.
+    """
+
+    def __init__(self, scope='queue', threshold=0, **kw):
+        if scope not in ('queue', 'worker'):
+            raise ValueError('Unknown circuit breaker scope: %r' % scope)
+        self.scope = scope
+        self.threshold = threshold
+        self.options = kw
+        self.breakers = {}
+
+    @property
+    def enabled(self):
+        return bool(self.threshold)
+
+    def get(self, queue_name):
+        """Returns the breaker responsible for `queue_name`."""
+        key = queue_name if self.scope == 'queue' else '*'
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            self.breakers[key] = breaker = CircuitBreaker(
+                threshold=self.threshold, **self.options)
+        return breaker
+
+    def allow(self, queue_name, now=None):
+        if not self.enabled:
+            return True
+        return self.get(queue_name).allow(now)
+
+    def closed(self, queue_name):
+        """Is the breaker of `queue_name` closed or disabled?"""
+        if not self.enabled:
+            return True
+        return self.get(queue_name).state == CLOSED
+
+    def cancel(self, queue_name):
+        if self.enabled:
+            self.get(queue_name).cancel()
+
+    def record(self, queue_name, success, now=None):
+        if not self.enabled:
+            return False
+        return self.get(queue_name).record(success, now)
+
+    def next_probe(self):
+        """Returns the time of the earliest probe of any open breaker or
+        `None`.
+        """
+        probes = [b.next_probe() for b in self.breakers.values()
+            if b.state == OPEN]
+        if not probes:
+            return None
+        return min(probes)
+
+    def as_dict(self):
+        result = {}
+        for key, breaker in self.breakers.items():
+            result[key] = {
+                'state': breaker.state,
+                'failure_rate': breaker.failure_rate,
+                'next_probe': breaker.next_probe(),
+            }
+        return result
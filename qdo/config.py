@@ -235,6 +235,7 @@ class SettingsDict(dict):
             self.setdefault(k, v)
 
 ERROR_QUEUE = 'qdo_error'
+ERROR_PARTITIONS = 7
 STATUS_QUEUE = 'qdo_status'
 STATUS_PARTITIONS = 7
 ZOO_DEFAULT_NS = 'mozilla-qdo'
@@ -254,13 +255,34 @@ class QdoSettings(SettingsDict):
         """Populate settings with default values"""
         self['qdo-worker.name'] = ''
         self['qdo-worker.wait_interval'] = 30
+        self['qdo-worker.lag_interval'] = 60
+        self['qdo-worker.metrics_interval'] = 60
+        self['qdo-worker.profile_every'] = 0
+        self['qdo-worker.profile_interval'] = 300
+        self['qdo-worker.profile_path'] = os.path.join(os.curdir, 'var')
         self['qdo-worker.ca_bundle'] = None
         self['qdo-worker.job'] = None
         self['qdo-worker.job_context'] = 'qdo.worker:dict_context'
         self['qdo-worker.job_failure'] = 'qdo.worker:log_failure'
+        self['qdo-worker.job_timeout'] = 0
+        self['qdo-worker.job_timeout_recycle'] = False
+        self['qdo-worker.stable_name'] = False
+        self['qdo-worker.error_buffer_size'] = 1000
+        self['qdo-worker.error_batch_size'] = 100
+        self['qdo-worker.error_flush_interval'] = 1
 
         self['partitions.policy'] = 'manual'
         self['partitions.ids'] = []
+        self['partitions.strategy'] = 'round_robin'
+        self['partitions.replicas'] = 100
+        self['partitions.balance_interval'] = 300
+        self['partitions.balance_tolerance'] = 1.25
+        self['partitions.grace_period'] = 0
+        self['partitions.lease_timeout'] = 0
+        self['partitions.handoff_timeout'] = 30
+        self['partitions.capacity'] = 1
+        self['partitions.max_partitions'] = 0
+        self['partitions.discovery_interval'] = 300
 
         self['queuey.connection'] = 'http://127.0.0.1:5000/v1/queuey/'
         self['queuey.app_key'] = None
@@ -268,6 +290,38 @@ class QdoSettings(SettingsDict):
         self['zookeeper.connection'] = ZOO_DEFAULT_CONN
         self['zookeeper.party_wait'] = 10
 
+        self['status.port'] = None
+        self['status.file'] = None
+
+        self['retry.attempts'] = 0
+        self['retry.backoff'] = 0.5
+        self['retry.max_backoff'] = 30
+        self['retry.exceptions'] = []
+        self['retry.capacity'] = 1000
+
+        self['breaker.threshold'] = 0
+        self['breaker.scope'] = 'queue'
+        self['breaker.window'] = 60
+        self['breaker.min_jobs'] = 10
+        self['breaker.probe_interval'] = 30
+
+        self['lanes.count'] = 0
+        self['lanes.threshold'] = 1
+        self['lanes.min_jobs'] = 5
+
+        self['unordered.queues'] = []
+        self['unordered.max_in_flight'] = 10
+        self['unordered.threads'] = 4
+
+        self['quarantine.max_failures'] = 0
+        self['quarantine.capacity'] = 10000
+
+        self['replay.queue'] = ''
+        self['replay.since'] = None
+        self['replay.until'] = None
+        self['replay.rate'] = 0
+        self['replay.partitions'] = []
+
         self['metlog.logger'] = 'qdo-worker'
         self['metlog.sender'] = {}
         self['metlog.sender']['class'] = 'metlog.senders.StdOutSender'
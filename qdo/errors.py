@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+import threading
+import time
+import weakref
+import zlib
+
+from queuey_py import HTTPError
+from ujson import encode as ujson_encode
+
+from qdo.config import ERROR_PARTITIONS
+from qdo.config import ERROR_QUEUE
+from qdo.log import log_raven
+
+ERROR_TTL = 2592000  # thirty days
+
+_WRITERS = weakref.WeakKeyDictionary()
+
+
+def register_writer(queuey_conn, writer):
+    """Register an :py:class:`ErrorQueueWriter` to be used for all failed
+    messages saved via `queuey_conn`.
+    """
+    _WRITERS[queuey_conn] = writer
+
+
+def get_writer(queuey_conn):
+    """Returns the :py:class:`ErrorQueueWriter` registered for
+    `queuey_conn` or `None`.
+    """
+    return _WRITERS.get(queuey_conn)
+
+
+def error_partition(name):
+    """Returns the error queue partition for failed messages of the
+    `<queue>-<partition>` `name`. All failures of one source partition end
+    up in the same error partition, but different source partitions are
+    spread evenly across all error partitions.
+
+    :rtype: int
+    """
+    return (zlib.crc32(name) & 0xffffffff) % ERROR_PARTITIONS + 1
+
+
+def post_failed_messages(queuey_conn, messages):
+    """Post a batch of failed messages to the error queue in a single
+    request. Each message is stored in the partition given by
+    :py:func:`error_partition` for its `queue` key.
+
+    :raises: :py:exc:`queuey_py.HTTPError`
+    """
+    batch = []
+    for message in messages:
+        batch.append({'body': ujson_encode(message), 'ttl': ERROR_TTL,
+            'partition': error_partition(message['queue'])})
+    response = queuey_conn.post(ERROR_QUEUE,
+        data=ujson_encode({'messages': batch}),
+        headers={'content-type': 'application/json'})
+    if not response.ok:
+        raise HTTPError(response.status_code, response)
+    return response
+
+
+class ErrorQueueWriter(object):
+    """Buffers failed messages and posts them to the error queue in batches
+    from a background thread.
+
+    The buffer is bounded, once it is full :py:meth:`put` blocks until the
+    flusher made room. Failed posts are retried and the messages are kept in
+    the buffer until they have been posted. :py:meth:`pending` tells if
+    messages of a partition still need to be posted, checkpoints for that
+    partition must not be committed until it returns zero.
+
+    :param queuey_conn: A
+        :py:class:`Queuey client <queuey_py.Client>` instance.
+    :type queuey_conn: object
+    :param capacity: Maximum number of buffered messages.
+    :type capacity: int
+    :param batch_size: Maximum number of messages posted in one request.
+    :type batch_size: int
+    :param interval: Maximum number of seconds a message waits in the
+        buffer before it is posted.
+    :type interval: float
+    """
+
+    def __init__(self, queuey_conn, capacity=1000, batch_size=100,
+                 interval=1.0):
+        self.queuey_conn = queuey_conn
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_wait = 1.0
+        self._buffer = deque()
+        self._pending = {}
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._close_deadline = None
+        self._thread = None
+
+    def __len__(self):
+        return len(self._buffer) + self._in_flight
+
+    def pending(self, partition):
+        """Returns the number of unposted messages of `partition`."""
+        return self._pending.get(partition, 0)
+
+    def put(self, message):
+        """Add a failed message to the buffer. The message must carry the
+        `<queue>-<partition>` name it came from in its `queue` key.
+        """
+        with self._cond:
+            if self._thread is None:
+                self._start()
+            while len(self) >= self.capacity and not self._closed:
+                self._cond.wait(self.interval)
+            partition = message['queue']
+            self._pending[partition] = self._pending.get(partition, 0) + 1
+            self._buffer.append(message)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _start(self):
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _take(self):
+        # called with the condition held, returns the next batch or None
+        # if the writer has been closed and everything has been posted
+        deadline = time.time() + self.interval
+        while len(self._buffer) < self.batch_size and not self._closed:
+            remaining = deadline - time.time()
+            if remaining <= 0 and self._buffer:
+                break
+            self._cond.wait(max(remaining, 0.01))
+            if not self._buffer:
+                deadline = time.time() + self.interval
+        if not self._buffer:
+            return None
+        batch = []
+        while self._buffer and len(batch) < self.batch_size:
+            batch.append(self._buffer.popleft())
+        self._in_flight = len(batch)
+        return batch
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                batch = self._take()
+                if batch is None:
+                    self._thread = None
+                    self._cond.notify_all()
+                    return
+            posted = self._post(batch)
+            with self._cond:
+                self._in_flight = 0
+                if not posted:
+                    # keep the partitions pending, so their checkpoints
+                    # are never committed
+                    self._cond.notify_all()
+                    continue
+                for message in batch:
+                    partition = message['queue']
+                    count = self._pending[partition] - 1
+                    if count:
+                        self._pending[partition] = count
+                    else:
+                        del self._pending[partition]
+                self._cond.notify_all()
+
+    def _post(self, batch):
+        # retry until the batch is stored, the messages' checkpoints are
+        # held back until then, so nothing gets lost
+        wait = self.retry_wait
+        while 1:
+            try:
+                post_failed_messages(self.queuey_conn, batch)
+                return True
+            except Exception:
+                log_raven()
+                if self._closed and self._close_deadline < time.time():
+                    # give up, the checkpoints weren't committed and the
+                    # messages will be processed again
+                    return False
+                time.sleep(wait)
+                wait = min(wait * 2, 30)
+
+    def flush(self, timeout=None):
+        """Wait until all buffered messages have been posted. Returns `True`
+        if all of them have been stored in the error queue.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while len(self):
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait(self.interval)
+            return not self._pending
+
+    def close(self, timeout=30):
+        """Post all remaining messages and stop the background thread."""
+        self._close_deadline = time.time() + timeout
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        return self.flush(timeout)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+from qdo.log import gauge
+from qdo.log import Histogram
+from qdo.partition import message_time
+
+
+class _PartitionState(object):
+
+    __slots__ = ('last_id', 'committed_id', 'caught_up', 'count',
+        'first_time', 'last_time', 'seconds', 'jobs')
+
+    def __init__(self):
+        self.last_id = None
+        self.committed_id = None
+        self.caught_up = False
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.first_time = None
+        self.last_time = None
+        self.seconds = 0.0
+        self.jobs = 0
+
+    @property
+    def density(self):
+        # messages per second of message creation time seen since the
+        # last report
+        if self.count < 2 or self.last_time <= self.first_time:
+            return None
+        return (self.count - 1) / (self.last_time - self.first_time)
+
+
+class LagTracker(object):
+    """Tracks how far behind the newest available message each partition
+    is. Message ids are UUID1's, so lag is computed by comparing the
+    timestamps embedded in the last processed and the newest message id.
+
+    :param interval: Minimum number of seconds between two reports, a value
+        of zero disables reporting.
+    :type interval: int
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.last_report = time.time()
+        self._state = {}
+        self.lags = {}
+        self.loads = {}
+
+    def _get(self, name):
+        state = self._state.get(name)
+        if state is None:
+            self._state[name] = state = _PartitionState()
+        return state
+
+    def processed(self, name, message_id):
+        """Record that `message_id` was processed for partition `name`."""
+        state = self._get(name)
+        created = message_time(message_id)
+        state.last_id = message_id
+        state.caught_up = False
+        state.count += 1
+        if state.first_time is None:
+            state.first_time = created
+        state.last_time = created
+
+    def job_time(self, name, seconds):
+        """Record that a job of partition `name` took `seconds`."""
+        state = self._get(name)
+        state.seconds += seconds
+        state.jobs += 1
+
+    def load(self, name, backlog):
+        """Returns the estimated number of seconds of work for partition
+        `name`: the time spent on its jobs since the last report plus the
+        time needed to process its `backlog` at the average job time.
+
+        :rtype: float
+        """
+        state = self._get(name)
+        if not state.jobs:
+            return 0.0
+        return state.seconds + backlog * (state.seconds / state.jobs)
+
+    def committed(self, name, message_id):
+        """Record that `message_id` was committed as the checkpoint of
+        partition `name`.
+        """
+        self._get(name).committed_id = message_id
+
+    def checkpoint(self, name):
+        """Returns the id of the last message committed as the checkpoint
+        of partition `name` by this worker or `None`.
+        """
+        state = self._state.get(name)
+        if state is None:
+            return None
+        return state.committed_id
+
+    def position(self, name):
+        """Returns the id of the last message processed for partition
+        `name` by this worker or `None`. It can run ahead of the
+        :py:meth:`checkpoint`, while the checkpoint is held back.
+        """
+        state = self._state.get(name)
+        if state is None:
+            return None
+        return state.last_id
+
+    def caught_up(self, name):
+        """Record that partition `name` had no more messages to process."""
+        self._get(name).caught_up = True
+
+    def due(self, now=None):
+        if not self.interval:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.last_report >= self.interval
+
+    def partition_lag(self, partition):
+        """Returns a tuple of the number of seconds the partition is behind
+        the newest message and the estimated number of unprocessed messages.
+
+        :param partition: The partition to check.
+        :type partition: :py:class:`qdo.partition.Partition`
+        :rtype: tuple
+        """
+        state = self._get(partition.name)
+        if state.caught_up:
+            # the last fetch returned no new messages, no need to ask
+            return (0.0, 0)
+        newest = partition.newest_message()
+        if newest is None:
+            return (0.0, 0)
+        last_id = state.last_id
+        if last_id is None:
+            last_id = partition.last_message
+        if not last_id:
+            # nothing processed yet, the oldest message we know about is
+            # the newest one
+            return (0.0, 1)
+        if newest['message_id'] == last_id:
+            return (0.0, 0)
+        lag = max(message_time(newest['message_id']) -
+            message_time(last_id), 0.0)
+        density = state.density
+        if density is None:
+            return (lag, 1)
+        return (lag, max(int(round(lag * density)), 1))
+
+    def report(self, partitions, now=None):
+        """Send per-partition and aggregate lag gauges for all `partitions`
+        and reset the tracking window.
+
+        :param partitions: The currently owned partitions.
+        :type partitions: list of :py:class:`qdo.partition.Partition`
+        """
+        self.last_report = time.time() if now is None else now
+        max_lag = 0.0
+        total_backlog = 0
+        lags = {}
+        loads = {}
+        names = set([p.name for p in partitions])
+        for name in self._state.keys():
+            if name not in names:
+                # forget about partitions we no longer own
+                del self._state[name]
+        for partition in partitions:
+            lag, backlog = self.partition_lag(partition)
+            lags[partition.name] = (lag, backlog)
+            loads[partition.name] = self.load(partition.name, backlog)
+            gauge('worker.lag.%s.seconds' % partition.name, lag)
+            gauge('worker.lag.%s.backlog' % partition.name, backlog)
+            max_lag = max(max_lag, lag)
+            total_backlog += backlog
+        gauge('worker.lag.seconds', max_lag)
+        gauge('worker.lag.backlog', total_backlog)
+        for state in self._state.itervalues():
+            state.reset()
+        self.lags = lags
+        self.loads = loads
+        return lags
+
+
+class LatencyTracker(object):
+    """Tracks the end-to-end latency of processed messages per queue, from
+    the time a message was posted until it has been processed. Latencies are
+    kept in in-process histograms and only percentiles are sent.
+
+    :param interval: Minimum number of seconds between two reports, a value
+        of zero disables reporting.
+    :type interval: int
+    """
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.last_report = time.time()
+        self.histograms = {}
+
+    def record(self, queue_name, message, now=None):
+        """Record the latency of a processed `message` from `queue_name`."""
+        if not self.interval:
+            return
+        if now is None:
+            now = time.time()
+        histogram = self.histograms.get(queue_name)
+        if histogram is None:
+            self.histograms[queue_name] = histogram = Histogram()
+        histogram.record(round((now - float(message['timestamp'])) * 1000))
+
+    def due(self, now=None):
+        if not self.interval:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.last_report >= self.interval
+
+    def report(self, now=None):
+        """Send latency percentiles in milliseconds for all queues that saw
+        messages since the last report and reset the histograms.
+        """
+        self.last_report = time.time() if now is None else now
+        for queue_name, histogram in self.histograms.items():
+            if not histogram.count:
+                # stop tracking idle queues
+                del self.histograms[queue_name]
+                continue
+            prefix = 'worker.latency.%s.' % queue_name
+            for percent in self.percentiles:
+                gauge(prefix + 'p%s' % percent,
+                    histogram.percentile(percent))
+            gauge(prefix + 'max', histogram.max)
+            gauge(prefix + 'count', histogram.count)
+            histogram.reset()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import Queue
+import threading
+import time
+
+# weight of the newest job time in the moving average
+_DECAY = 0.2
+
+
+class Lane(threading.Thread):
+    """A thread running jobs for the slow partitions assigned to it, with
+    its own job context. Results are put on the shared `results` queue as
+    `(partition, message, exception, seconds)` tuples. Threads of the pool
+    share their `tasks` queue. Jobs are run by the `watchdog`, if given.
+    """
+
+    def __init__(self, job, job_context, results, tasks=None,
+                 watchdog=None):
+        threading.Thread.__init__(self, name='qdo-lane')
+        self.daemon = True
+        self.job = job
+        self.job_context = job_context
+        self.results = results
+        if tasks is None:
+            tasks = Queue.Queue()
+        self.tasks = tasks
+        self.watchdog = watchdog
+        self.partitions = set()
+
+    def run(self):
+        with self.job_context() as context:
+            while 1:
+                task = self.tasks.get()
+                if task is None:
+                    break
+                name, message = task
+                exc = None
+                start = time.time()
+                try:
+                    if self.watchdog is None:
+                        self.job(message, context)
+                    else:
+                        self.watchdog.call(self.job, message, context)
+                except BaseException as exc:
+                    # all errors are handled by the worker itself
+                    pass
+                self.results.put((name, message, exc, time.time() - start))
+
+
+class Lanes(object):
+    """Moves slow partitions out of the main worker loop.
+
+    The average job time of each partition is tracked as an exponentially
+    weighted moving average. Once it exceeds `threshold` seconds, the
+    partition is assigned to one of `count` dedicated lane threads, the one
+    with the fewest slow partitions. Messages of that partition are then
+    handed to its lane, one at a time, while the main loop continues with
+    the remaining partitions. Once the average drops below half of the
+    threshold, the partition moves back to the main loop.
+
+    In addition a pool of `pool_size` threads runs the jobs of unordered
+    partitions, with any number of messages of the same partition in
+    flight at the same time.
+
+    :param count: Number of lane threads. Zero disables the lanes.
+    :type count: int
+    :param threshold: Average job time in seconds, above which a partition
+        is considered slow.
+    :type threshold: float
+    :param min_jobs: Minimum number of jobs of a partition, before it can be
+        considered slow.
+    :type min_jobs: int
+    :param pool_size: Number of threads for unordered partitions.
+    :type pool_size: int
+    """
+
+    def __init__(self, count=0, threshold=1.0, min_jobs=5, pool_size=0):
+        self.count = count
+        self.threshold = threshold
+        self.min_jobs = min_jobs
+        self.pool_size = pool_size
+        self.lanes = []
+        self.pool = []
+        self.pool_tasks = Queue.Queue()
+        self.assignments = {}
+        self.averages = {}
+        self.in_flight = {}
+        self.discarded = set()
+        self.results = Queue.Queue()
+        self._ready = []
+
+    @property
+    def enabled(self):
+        return bool(self.count or self.pool_size)
+
+    @property
+    def capacity(self):
+        return self.count + self.pool_size
+
+    def __len__(self):
+        return sum(self.in_flight.values())
+
+    def start(self, job, job_context, watchdog=None):
+        """Start the lane and pool threads. A hung job of any thread is
+        detected by the `watchdog`, if given.
+        """
+        if not self.enabled or self.lanes or self.pool:
+            return
+        for i in xrange(self.count):
+            lane = Lane(job, job_context, self.results, watchdog=watchdog)
+            lane.start()
+            self.lanes.append(lane)
+        for i in xrange(self.pool_size):
+            thread = Lane(job, job_context, self.results,
+                tasks=self.pool_tasks, watchdog=watchdog)
+            thread.start()
+            self.pool.append(thread)
+
+    def stop(self, timeout=None):
+        """Let the threads finish all submitted messages and stop."""
+        for thread in self.lanes + self.pool:
+            thread.tasks.put(None)
+        for thread in self.lanes + self.pool:
+            thread.join(timeout)
+        self.lanes = []
+        self.pool = []
+        self.assignments.clear()
+
+    def record(self, name, seconds):
+        """Record the job time of a message of partition `name` and move the
+        partition between the main loop and a lane if needed.
+        """
+        if not self.enabled:
+            return
+        average = self.averages.get(name)
+        if average is None:
+            self.averages[name] = average = [seconds, 0]
+        average[0] += _DECAY * (seconds - average[0])
+        average[1] += 1
+        if self.busy(name) or not self.lanes:
+            return
+        lane = self.assignments.get(name)
+        if lane is None:
+            if average[1] >= self.min_jobs and average[0] >= self.threshold:
+                lane = min(self.lanes, key=lambda l: len(l.partitions))
+                lane.partitions.add(name)
+                self.assignments[name] = lane
+        elif average[0] < self.threshold / 2.0:
+            lane.partitions.discard(name)
+            del self.assignments[name]
+
+    def lane(self, name):
+        """Returns the lane of a slow partition or `None`."""
+        return self.assignments.get(name)
+
+    def busy(self, name):
+        """Has partition `name` a message in flight?"""
+        return bool(self.in_flight.get(name))
+
+    def submit(self, name, message):
+        """Hand over `message` to the lane of partition `name`, or to the
+        pool if the partition has no lane.
+        """
+        self.in_flight[name] = self.in_flight.get(name, 0) + 1
+        lane = self.assignments.get(name)
+        if lane is None:
+            self.pool_tasks.put((name, message))
+        else:
+            lane.tasks.put((name, message))
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for a lane to finish a message.
+        Returns `True` if a result is available, or `False` after a
+        timeout or :py:meth:`interrupt`.
+        """
+        if self._ready:
+            return True
+        try:
+            result = self.results.get(True, timeout)
+        except Queue.Empty:
+            return False
+        if result is None:
+            return False
+        self._ready.append(result)
+        return True
+
+    def interrupt(self):
+        """Wake up a :py:meth:`wait` in another thread."""
+        if self.enabled:
+            self.results.put(None)
+
+    def completed(self):
+        """Returns the results of all finished messages. Results of
+        discarded partitions are dropped.
+        """
+        ready = self._ready
+        self._ready = []
+        while 1:
+            try:
+                ready.append(self.results.get_nowait())
+            except Queue.Empty:
+                break
+        result = []
+        in_flight = self.in_flight
+        for item in ready:
+            if item is None:
+                # left over from an interrupt
+                continue
+            name = item[0]
+            in_flight[name] -= 1
+            if not in_flight[name]:
+                del in_flight[name]
+            if name in self.discarded:
+                if name not in in_flight:
+                    self.discarded.discard(name)
+                continue
+            result.append(item)
+        return result
+
+    def discard(self, partitions):
+        """Forget about the given partitions, for example after they have
+        been released. Results of their messages in flight are dropped.
+        """
+        for name in partitions:
+            lane = self.assignments.pop(name, None)
+            if lane is not None:
+                lane.partitions.discard(name)
+            self.averages.pop(name, None)
+            if name in self.in_flight:
+                self.discarded.add(name)
@@ -3,16 +3,32 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import math
+import threading
+import time
+
 from metlog.holder import get_client
 from metlog.senders.dev import DebugCaptureSender
 
+_LOGGER = []
+
 
 def get_logger():
     """Get a global :term:`metlog` client.
 
     :rtype: :py:class:`metlog.client.MetlogClient`
     """
-    return get_client('qdo-worker')
+    # the holder always returns the same, in-place reconfigured client
+    if not _LOGGER:
+        _LOGGER.append(get_client('qdo-worker'))
+    return _LOGGER[0]
+
+
+def log_raven():
+    """Log the current exception using metlog-raven if it's configured."""
+    raven = getattr(get_logger(), 'raven', None)
+    if raven is not None:
+        raven()
 
 
 def configure(settings, debug=False):
@@ -28,3 +44,222 @@ def configure(settings, debug=False):
         # don't reconfigure an already configured debug logger
         if not isinstance(logger.sender, DebugCaptureSender):
             get_client('qdo-worker', settings)
+
+
+def gauge(name, value, logger=None):
+    """Send the current `value` of a metric as a :term:`metlog` gauge
+    message.
+    """
+    if logger is None:
+        logger = get_logger()
+    logger.metlog('gauge', payload=str(value),
+        fields={'name': name, 'rate': 1.0})
+
+
+class Histogram(object):
+    """A fixed-memory histogram with log-linear buckets for non-negative
+    values, like latencies in milliseconds.
+
+    Values below `2 * 2 ** precision` are counted exactly, larger values are
+    counted in buckets of `2 ** precision` linear steps per power of two,
+    which bounds the relative error to `2 ** -precision`. Values above
+    `2 ** max_exponent` are counted in the last bucket.
+
+    :param precision: Number of bits of linear resolution per power of two.
+    :type precision: int
+    :param max_exponent: The largest power of two tracked.
+    :type max_exponent: int
+    """
+
+    def __init__(self, precision=5, max_exponent=40):
+        self._sub = 1 << precision
+        self._precision = precision
+        self._max_shift = max_exponent - precision
+        self._counts = [0] * ((self._max_shift + 2) * self._sub)
+        self.reset()
+
+    def reset(self):
+        """Forget all recorded values."""
+        counts = self._counts
+        for i in xrange(len(counts)):
+            counts[i] = 0
+        self.count = 0
+        self.max = 0
+        self.total = 0
+
+    def _index(self, value):
+        if value < 2 * self._sub:
+            return value
+        # math.frexp's exponent equals the bit length of an integer
+        shift = math.frexp(value)[1] - self._precision - 1
+        if shift > self._max_shift:
+            return len(self._counts) - 1
+        return shift * self._sub + (value >> shift)
+
+    def _upper_bound(self, index):
+        if index < 2 * self._sub:
+            return index
+        shift = index // self._sub - 1
+        return ((index - shift * self._sub + 1) << shift) - 1
+
+    def record(self, value):
+        """Record a single value, negative values are counted as zero."""
+        value = max(int(value), 0)
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the value below which `percent` percent of all recorded
+        values fall, within the precision of the histogram.
+
+        :param percent: A number between 0 and 100.
+        :type percent: float
+        :rtype: int
+        """
+        if not self.count:
+            return 0
+        rank = max(int(math.ceil(self.count * percent / 100.0)), 1)
+        seen = 0
+        last = len(self._counts) - 1
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                if index == last:
+                    # the overflow bucket has no upper bound
+                    break
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+
+class _Timer(object):
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.metrics.timing(self.name, (time.time() - self.start) * 1000)
+        return False
+
+
+class Metrics(object):
+    """Aggregates counters and timers in memory and sends them as
+    statsd-style aggregates to :term:`metlog` once per `interval`, instead
+    of sending one message per event. Events can be recorded from multiple
+    threads.
+
+    :param interval: Minimum number of seconds between two flushes.
+    :type interval: int
+    :param logger: The :term:`metlog` client, defaults to
+        :py:func:`get_logger`.
+    :type logger: :py:class:`metlog.client.MetlogClient`
+    """
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self, interval=60, logger=None):
+        self.interval = interval
+        self.logger = logger if logger is not None else get_logger()
+        self.last_flush = time.time()
+        self.counters = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        """Increment the counter `name` by `count`."""
+        with self._lock:
+            counters = self.counters
+            counters[name] = counters.get(name, 0) + count
+
+    def timing(self, name, elapsed):
+        """Record an `elapsed` time in milliseconds for the timer `name`."""
+        with self._lock:
+            histogram = self.timers.get(name)
+            if histogram is None:
+                self.timers[name] = histogram = Histogram()
+            histogram.record(round(elapsed))
+
+    def timer(self, name):
+        """Returns a context manager recording the time spent inside it for
+        the timer `name`.
+        """
+        return _Timer(self, name)
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.last_flush >= self.interval
+
+    def flush(self, now=None):
+        """Send all aggregated values and reset them. Counters are sent as a
+        single increment, timers as gauges for their count, mean, max and
+        percentiles.
+        """
+        self.last_flush = time.time() if now is None else now
+        logger = self.logger
+        # swap in fresh containers first, so events recorded concurrently
+        # end up in the next interval
+        with self._lock:
+            counters, self.counters = self.counters, {}
+            timers, self.timers = self.timers, {}
+        for name, count in counters.iteritems():
+            logger.incr(name, count)
+        for name, histogram in timers.iteritems():
+            gauge(name + '.count', histogram.count, logger)
+            gauge(name + '.mean', histogram.total // histogram.count, logger)
+            gauge(name + '.max', histogram.max, logger)
+            for percent in self.percentiles:
+                gauge(name + '.p%s' % percent,
+                    histogram.percentile(percent), logger)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        return False
+
+
+class NullMetrics(object):
+    """A drop-in replacement for :py:class:`Metrics` which does nothing,
+    used when metrics are disabled.
+    """
+
+    _timer = _NullTimer()
+
+    def incr(self, name, count=1):
+        pass
+
+    def timing(self, name, elapsed):
+        pass
+
+    def timer(self, name):
+        return self._timer
+
+    def due(self, now=None):
+        return False
+
+    def flush(self, now=None):
+        pass
+
+
+def make_metrics(interval):
+    """Returns a :py:class:`Metrics` instance flushing every `interval`
+    seconds, or a :py:class:`NullMetrics` instance if the interval is zero
+    or no :term:`metlog` sender is configured.
+    """
+    logger = get_logger()
+    if not interval or not logger.is_active:
+        return NullMetrics()
+    return Metrics(interval, logger)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+import os
+import os.path
+import SocketServer
+import threading
+import time
+
+from ujson import encode as ujson_encode
+
+
+class WorkerStats(object):
+    """Collects in-process statistics about a worker, like its throughput,
+    idle time and the last job failure.
+
+    :param window: Number of seconds over which the recent throughput is
+        calculated.
+    :type window: int
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.started = time.time()
+        self.processed = 0
+        self.failed = 0
+        self.idle_time = 0.0
+        self.last_error = None
+        self.throughput = 0.0
+        self._window_start = self.started
+        self._window_processed = 0
+
+    def current_throughput(self, now=None):
+        """Returns the throughput of the last complete window. Once no
+        message closed a window for longer than `window` seconds, the rate
+        since the last window is returned, so it drops while the worker is
+        idle or stuck.
+        """
+        if now is None:
+            now = time.time()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return self.throughput
+        return (self.processed - self._window_processed) / elapsed
+
+    def record_processed(self, now=None):
+        """Record one processed message."""
+        self.processed += 1
+        if now is None:
+            now = time.time()
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            self.throughput = (
+                self.processed - self._window_processed) / elapsed
+            self._window_start = now
+            self._window_processed = self.processed
+
+    def record_failure(self, partition, message_id, exc):
+        """Record a failed job."""
+        self.failed += 1
+        self.last_error = {
+            'time': time.time(),
+            'partition': partition,
+            'message_id': message_id,
+            'error': repr(exc),
+        }
+
+    def record_idle(self, seconds):
+        """Record time spent idle waiting for new messages."""
+        self.idle_time += seconds
+
+    def as_dict(self, now=None):
+        if now is None:
+            now = time.time()
+        uptime = max(now - self.started, 0.001)
+        return {
+            'uptime': uptime,
+            'processed': self.processed,
+            'failed': self.failed,
+            'throughput': self.current_throughput(now),
+            'idle_fraction': min(self.idle_time / uptime, 1.0),
+            'last_error': self.last_error,
+        }
+
+
+def worker_status(worker):
+    """Returns a JSON serializable dict describing the current state of a
+    worker, its owned partitions and statistics.
+    """
+    partitions = {}
+    if worker.partitioner is not None and worker.partitioner.acquired:
+        lags = worker.lag.lags
+        for name in list(worker.partitioner):
+            lag, backlog = lags.get(name, (None, None))
+            partitions[name] = {
+                'checkpoint': worker.lag.checkpoint(name),
+                'position': worker.lag.position(name),
+                'lag': lag,
+                'backlog': backlog,
+                'slow': worker.lanes.lane(name) is not None,
+            }
+    buffers = {}
+    for name, buf in worker.buffers.items():
+        buffers[name] = {'size': len(buf), 'capacity': buf.capacity}
+    result = {
+        'name': worker.name,
+        'shutdown': worker.shutdown,
+        'draining': worker.draining,
+        'healthy': worker.watchdog.healthy,
+        'partitions': partitions,
+        'buffers': buffers,
+        'breakers': worker.breakers.as_dict(),
+        'quarantine': worker.quarantine.as_dict(),
+    }
+    result.update(worker.stats.as_dict())
+    return result
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/status'):
+            self.send_error(404)
+            return
+        body = ujson_encode(worker_status(self.server.worker))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/drain':
+            self.send_error(404)
+            return
+        self.server.worker.drain()
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # don't write access logs to stderr
+        pass
+
+
+class StatusServer(object):
+    """A tiny HTTP server exposing :py:func:`worker_status` as JSON. It runs
+    in a daemon thread and listens either on a local TCP port or on a unix
+    domain socket.
+
+    :param worker: The worker to report on.
+    :type worker: :py:class:`qdo.worker.Worker`
+    :param port: A `host:port` combination, like `127.0.0.1:4998`.
+    :type port: str
+    :param file: Path to a unix domain socket, used instead of `port`.
+    :type file: str
+    """
+
+    def __init__(self, worker, port=None, file=None):
+        self.worker = worker
+        self.port = port
+        self.file = file
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.file:
+            if os.path.exists(self.file):
+                # stale socket of an earlier process
+                os.unlink(self.file)
+            server = SocketServer.UnixStreamServer(self.file, StatusHandler)
+        else:
+            host, port = self.port.rsplit(':', 1)
+            server = HTTPServer((host, int(port)), StatusHandler)
+        server.worker = self.worker
+        self.server = server
+        self.thread = threading.Thread(target=server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def address(self):
+        if self.server is None:
+            return None
+        return self.server.server_address
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if self.file and os.path.exists(self.file):
+            os.unlink(self.file)
+        self.server = None
+        self.thread = None
@@ -3,6 +3,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from collections import deque
 import uuid
 
 from ujson import decode
@@ -11,6 +12,78 @@ from ujson import encode
 from qdo.config import STATUS_PARTITIONS
 from qdo.config import STATUS_QUEUE
 
+# 100-ns intervals between the UUID epoch 1582-10-15 and the Unix epoch
+_UUID_EPOCH_OFFSET = 0x01b21dd213814000
+
+
+def message_time(message_id):
+    """Returns the creation time of a message as seconds since the Unix
+    epoch, based on the timestamp embedded in its UUID1 message id.
+
+    :param message_id: A Queuey message id as a hex string.
+    :type message_id: str
+    :rtype: float
+    """
+    ts = uuid.UUID(hex=message_id).time
+    return (ts - _UUID_EPOCH_OFFSET) / 1e7
+
+
+class CheckpointTracker(object):
+    """Tracks messages of one partition, which are processed out of order.
+
+    Messages are dispatched in partition order and can be completed in any
+    order. The watermark is the id of the newest message, for which all
+    earlier dispatched messages have been completed as well. Only the
+    window between the watermark and the newest dispatched message is kept
+    in memory.
+    """
+
+    def __init__(self):
+        self.watermark = None
+        self._window = deque()
+        self._done = set()
+
+    def __len__(self):
+        """Number of dispatched messages above the watermark."""
+        return len(self._window)
+
+    @property
+    def in_flight(self):
+        """Number of dispatched messages, which aren't completed yet."""
+        return len(self._window) - len(self._done)
+
+    def dispatch(self, message_id):
+        """Record `message_id` as handed out for processing. Messages have
+        to be dispatched in partition order.
+        """
+        self._window.append(message_id)
+
+    def complete(self, message_id):
+        """Record `message_id` as completed. Returns the new watermark if it
+        advanced, otherwise `None`.
+        """
+        window = self._window
+        done = self._done
+        if not window:
+            return None
+        if window[0] != message_id:
+            if message_id in window:
+                done.add(message_id)
+            return None
+        window.popleft()
+        watermark = message_id
+        while window and window[0] in done:
+            watermark = window.popleft()
+            done.remove(watermark)
+        self.watermark = watermark
+        return watermark
+
+    def reset(self):
+        """Forget about all dispatched messages."""
+        self.watermark = None
+        self._window.clear()
+        self._done.clear()
+
 
 class Partition(object):
     """Represents a specific partition in a message queue.
@@ -26,6 +99,13 @@ class Partition(object):
     :type msgid: unicode
     :param worker_id: An id for the current worker process, used for logging.
     :type name: unicode
+
+    Messages processed out of order are recorded in the
+    :py:class:`CheckpointTracker` available as :py:attr:`tracker`.
+
+    The fencing token of the current owner, if any, is stored as
+    :py:attr:`token` with each checkpoint. It's informational only, the
+    stored token isn't compared before a new checkpoint is written.
     """
 
     def __init__(self, queuey_conn, name, msgid=None, worker_id=''):
@@ -41,6 +121,9 @@ class Partition(object):
         # map partition to one in 1 to max status partitions
         self.status_partition = ((self.partition - 1) % STATUS_PARTITIONS) + 1
         self.msgid = msgid
+        self._position = None
+        self.token = None
+        self.tracker = CheckpointTracker()
         if msgid is None:
             self.msgid = uuid.uuid1().hex
             self._create_status_message()
@@ -62,7 +145,8 @@ class Partition(object):
 
     def _update_status_message(self, value):
         result = self.queuey_conn.put(self._status_url, data=encode(dict(
-            partition=self.name, processed=value, last_worker=self.worker_id)),
+            partition=self.name, processed=value, last_worker=self.worker_id,
+            token=self.token)),
             headers={'X-TTL': '2592000'},  # thirty days
         )
         return result
@@ -79,9 +163,36 @@ class Partition(object):
         :rtype: list
         """
         return self.queuey_conn.messages(self.queue_name,
-            partition=self.partition, since=self.last_message, limit=limit,
+            partition=self.partition, since=self.position, limit=limit,
             order=order)
 
+    def newest_message(self):
+        """Returns the newest message in the partition, regardless of the
+           processing state, or `None` if the partition is empty.
+
+        :raises: :py:exc:`queuey_py.HTTPError`
+        :rtype: dict
+        """
+        messages = self.queuey_conn.messages(self.queue_name,
+            partition=self.partition, limit=1, order='descending')
+        if messages:
+            return messages[0]
+        return None
+
+    @property
+    def position(self):
+        """Property for the message id of the last message handed out for
+        processing. It's initialized from :py:attr:`last_message` and kept
+        in memory only, so it can run ahead of the committed checkpoint.
+        """
+        if self._position is None:
+            self._position = self.last_message
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self._position = value
+
     @property
     def last_message(self):
         """Property for the message id of the last processed message.
@@ -99,3 +210,8 @@ class Partition(object):
         :type value: str
         """
         self._update_status_message(value)
+        position = self._position
+        # never move the in-memory position backwards
+        if not position or (value and
+                message_time(value) >= message_time(position)):
+            self._position = value
@@ -0,0 +1,1138 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from bisect import bisect
+from hashlib import md5
+import threading
+import time
+
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import KazooState
+from ujson import decode as ujson_decode
+from ujson import encode as ujson_encode
+
+ALLOCATING = 'ALLOCATING'
+ACQUIRED = 'ACQUIRED'
+RELEASE = 'RELEASE'
+FAILURE = 'FAILURE'
+
+# the partitioners take a `set` argument, shadowing the builtin
+_builtin_set = set
+
+
+def _limits(capacities, member):
+    # returns the capacity and maximum number of partitions of a member
+    if capacities and member in capacities:
+        capacity, maximum = capacities[member]
+        return (float(capacity), int(maximum))
+    return (1.0, 0)
+
+
+def _weighted(capacities):
+    # do any members differ from the default capacity?
+    if not capacities:
+        return False
+    for member in capacities:
+        if _limits(capacities, member) != (1.0, 0):
+            return True
+    return False
+
+
+def round_robin(identifier, members, partitions, capacities=None):
+    """The default partition function. Hands out the sorted partitions to
+    the sorted members in turn, like the kazoo `SetPartitioner` does.
+
+    With `capacities` each partition goes to the member with the fewest
+    partitions relative to its capacity, which hasn't reached its maximum
+    number of partitions yet. Partitions exceeding the maximum of all
+    members stay unassigned.
+
+    :param identifier: The identifier of the current worker.
+    :type identifier: str
+    :param members: The identifiers of all workers, including the current.
+    :type members: list
+    :param partitions: All partitions.
+    :type partitions: list
+    :param capacities: A mapping of member identifiers to a tuple of their
+        capacity and maximum number of partitions, zero meaning unlimited.
+        Members default to a capacity of one.
+    :type capacities: dict
+    :rtype: list
+    """
+    members = sorted(members)
+    if identifier not in members:
+        return []
+    if not _weighted(capacities):
+        index = members.index(identifier)
+        return sorted(partitions)[index::len(members)]
+    limits = dict([(m, _limits(capacities, m)) for m in members])
+    counts = dict([(m, 0) for m in members])
+    result = []
+    for partition in sorted(partitions):
+        candidates = [m for m in members
+            if not limits[m][1] or counts[m] < limits[m][1]]
+        if not candidates:
+            break
+        member = min(candidates,
+            key=lambda m: ((counts[m] + 1) / limits[m][0], m))
+        counts[member] += 1
+        if member == identifier:
+            result.append(partition)
+    return result
+
+
+def _hash(key):
+    return int(md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """A consistent hash ring. Each member is placed on the ring at
+    `replicas` pseudo-random points (virtual nodes) and a key belongs to
+    the member owning the next point clockwise from the hash of the key.
+
+    Adding or removing one of N members only moves about 1/N of all keys,
+    all other keys keep their owner.
+
+    :param members: The identifiers of all members.
+    :type members: list
+    :param replicas: Number of virtual nodes per member.
+    :type replicas: int
+    :param capacities: Optional member capacities, as described for
+        :py:func:`round_robin`. The number of virtual nodes of each member
+        is proportional to its capacity.
+    :type capacities: dict
+    """
+
+    def __init__(self, members, replicas=100, capacities=None):
+        self.replicas = replicas
+        points = []
+        for member in members:
+            count = max(int(round(
+                replicas * _limits(capacities, member)[0])), 1)
+            for i in xrange(count):
+                points.append((_hash('%s#%s' % (member, i)), member))
+        points.sort()
+        self._points = [p[0] for p in points]
+        self._members = [p[1] for p in points]
+
+    def __len__(self):
+        return len(self._points)
+
+    def owner(self, key):
+        """Returns the member owning `key` or `None` for an empty ring."""
+        if not self._points:
+            return None
+        index = bisect(self._points, _hash(key)) % len(self._points)
+        return self._members[index]
+
+    def owners(self, key):
+        """Yields all members in the order they are found clockwise from
+        `key`, starting with its owner.
+        """
+        points = len(self._points)
+        if not points:
+            return
+        index = bisect(self._points, _hash(key))
+        seen = set()
+        for i in xrange(points):
+            member = self._members[(index + i) % points]
+            if member not in seen:
+                seen.add(member)
+                yield member
+
+
+def consistent_hash(identifier, members, partitions, replicas=100,
+                    capacities=None):
+    """A partition function based on a :py:class:`HashRing` over all
+    members, which moves as few partitions as possible when members join
+    or leave. Takes the same arguments as :py:func:`round_robin`.
+
+    If members have a maximum number of partitions, a partition whose
+    owner is full goes to the next member clockwise on the ring, which
+    isn't full yet.
+
+    :param replicas: Number of virtual nodes per member.
+    :type replicas: int
+    :rtype: list
+    """
+    if identifier not in members:
+        return []
+    ring = HashRing(members, replicas=replicas, capacities=capacities)
+    limits = dict([(m, _limits(capacities, m)[1]) for m in members])
+    if not [m for m in members if limits[m]]:
+        return [p for p in sorted(partitions) if ring.owner(p) == identifier]
+    counts = dict([(m, 0) for m in members])
+    result = []
+    for partition in sorted(partitions):
+        for member in ring.owners(partition):
+            if not limits[member] or counts[member] < limits[member]:
+                counts[member] += 1
+                if member == identifier:
+                    result.append(partition)
+                break
+    return result
+
+
+def balance(members, partitions, weights, capacities=None):
+    """Assigns the partitions to the members, so that each member gets a
+    roughly equal share of the total weight. Partitions are handed out
+    heaviest first, each to the member with the lowest weight so far. Ties
+    are broken by the number of partitions, so partitions without any
+    weight are spread evenly.
+
+    :param members: The identifiers of all members.
+    :type members: list
+    :param partitions: All partitions.
+    :type partitions: list
+    :param weights: A mapping of partition names to their weight, missing
+        partitions have a weight of zero.
+    :type weights: dict
+    :param capacities: Optional member capacities, as described for
+        :py:func:`round_robin`. Members get a share of the weight
+        proportional to their capacity.
+    :type capacities: dict
+    :returns: A mapping of member identifiers to sorted partition lists.
+    :rtype: dict
+    """
+    members = sorted(members)
+    result = dict([(m, []) for m in members])
+    if not members:
+        return result
+    limits = dict([(m, _limits(capacities, m)) for m in members])
+    loads = dict([(m, 0.0) for m in members])
+    order = sorted(partitions, key=lambda p: (-weights.get(p, 0.0), p))
+    for partition in order:
+        weight = weights.get(partition, 0.0)
+        candidates = [m for m in members
+            if not limits[m][1] or len(result[m]) < limits[m][1]]
+        if not candidates:
+            break
+        member = min(candidates, key=lambda m: (
+            (loads[m] + weight) / limits[m][0],
+            (len(result[m]) + 1) / limits[m][0], m))
+        result[member].append(partition)
+        loads[member] += weight
+    for assigned in result.values():
+        assigned.sort()
+    return result
+
+
+def imbalance(assignment, weights, capacities=None):
+    """Returns the ratio of the highest member weight to the average
+    member weight of an assignment, or `1.0` if there is no weight at all.
+    With `capacities`, the weights are taken relative to the capacity of
+    each member.
+
+    :rtype: float
+    """
+    total = 0.0
+    capacity = 0.0
+    highest = 0.0
+    for member, assigned in assignment.items():
+        member_capacity = _limits(capacities, member)[0]
+        load = sum([weights.get(p, 0.0) for p in assigned])
+        total += load
+        capacity += member_capacity
+        highest = max(highest, load / member_capacity)
+    if not total:
+        return 1.0
+    return highest / (total / capacity)
+
+
+class LoadBalancer(object):
+    """Assigns partitions by their load instead of their count.
+
+    Every member publishes the load of its partitions, as computed by the
+    :py:class:`qdo.lag.LagTracker`, into an ephemeral node below
+    `<path>/load`. The first member in sorted order acts as the leader.
+    It combines all loads, computes a new assignment using
+    :py:func:`balance` and publishes it in `<path>/assignment`, whenever the
+    membership or the set of partitions changed or the imbalance of the
+    current assignment exceeds `tolerance`, at most once every `interval`
+    seconds. All members follow the published assignment. Until an
+    assignment for the current membership is published, all members keep
+    their current partitions, so partitions move only once.
+
+    :param client: A started `kazoo.client.KazooClient`.
+    :param path: The ZooKeeper path of the partitioner.
+    :type path: str
+    :param identifier: A unique identifier of this member.
+    :type identifier: str
+    :param interval: Minimum number of seconds between two rebalances
+        caused by load changes.
+    :type interval: float
+    :param tolerance: Ratio of the highest to the average member load, above
+        which partitions are reassigned.
+    :type tolerance: float
+    """
+
+    def __init__(self, client, path, identifier, interval=300,
+                 tolerance=1.25):
+        self._client = client
+        self._identifier = identifier
+        self.interval = interval
+        self.tolerance = tolerance
+        self._load_path = path + '/load'
+        self._assignment_path = path + '/assignment'
+        self._lock = threading.Lock()
+        self._published = False
+        self._assignment = None
+        self._changed = False
+        self._last_balance = 0
+        client.ensure_path(self._load_path)
+        client.ensure_path(self._assignment_path)
+        self._watch_assignment()
+
+    def _watch_assignment(self, event=None):
+        try:
+            data, stat = self._client.get(self._assignment_path,
+                watch=self._watch_assignment)
+        except NoNodeError:  # pragma: no cover
+            return
+        assignment = ujson_decode(data) if data else None
+        with self._lock:
+            self._assignment = assignment
+            self._changed = True
+
+    def publish(self, loads):
+        """Publish the load of the partitions owned by this member.
+
+        :param loads: A mapping of partition names to their load.
+        :type loads: dict
+        """
+        path = self._load_path + '/' + self._identifier
+        data = ujson_encode(loads)
+        if self._published:
+            try:
+                self._client.set(path, data)
+                return
+            except NoNodeError:  # pragma: no cover
+                pass
+        try:
+            self._client.create(path, data, ephemeral=True)
+        except NodeExistsError:  # pragma: no cover
+            self._client.set(path, data)
+        self._published = True
+
+    def loads(self):
+        """Returns the combined loads published by all members."""
+        result = {}
+        for member in self._client.get_children(self._load_path):
+            try:
+                data, stat = self._client.get(self._load_path + '/' + member)
+            except NoNodeError:  # pragma: no cover
+                continue
+            if not data:
+                continue
+            for name, load in ujson_decode(data).items():
+                result[name] = max(result.get(name, 0.0), load)
+        return result
+
+    def _current(self, members, partitions):
+        # returns the published assignment if it matches the membership
+        # and partitions
+        assignment = self._assignment
+        if not assignment or assignment.get('members') != members:
+            return None
+        assigned = assignment.get('partitions', {})
+        names = []
+        for member_partitions in assigned.values():
+            names.extend(member_partitions)
+        if sorted(names) != sorted(partitions):
+            return None
+        return assigned
+
+    def assign(self, identifier, members, partitions, capacities=None):
+        """The partition function following the published assignment.
+        Returns `None` if there is no assignment for the current membership
+        and partitions yet.
+        """
+        members = sorted(members)
+        with self._lock:
+            assigned = self._current(members, partitions)
+        if assigned is None:
+            return None
+        return sorted([str(p) for p in assigned.get(identifier, [])])
+
+    def poll(self, members, partitions, now=None, leader=None,
+             capacities=None):
+        """Rebalance as the leader if necessary. Returns `True` if the
+        published assignment changed since the last call. The `leader`
+        defaults to the first of the `members`. The member `capacities` are
+        taken into account as described for :py:func:`balance`.
+        """
+        if now is None:
+            now = time.time()
+        members = sorted(members)
+        if leader is None and members:
+            leader = members[0]
+        if leader == self._identifier:
+            self._balance(members, partitions, now, capacities)
+        with self._lock:
+            changed = self._changed
+            self._changed = False
+        return changed
+
+    def _balance(self, members, partitions, now, capacities=None):
+        with self._lock:
+            assigned = self._current(members, partitions)
+        if assigned is not None and now - self._last_balance < self.interval:
+            return
+        weights = self.loads()
+        if (assigned is not None and
+                imbalance(assigned, weights, capacities) <= self.tolerance):
+            self._last_balance = now
+            return
+        self._last_balance = now
+        assignment = {
+            'members': members,
+            'partitions': balance(members, partitions, weights, capacities),
+        }
+        self._client.set(self._assignment_path, ujson_encode(assignment))
+        with self._lock:
+            # don't wait for our own watch
+            self._assignment = assignment
+            self._changed = True
+
+    def finish(self):
+        """Remove the published load of this member."""
+        if not self._published:
+            return
+        self._published = False
+        try:
+            self._client.delete(self._load_path + '/' + self._identifier)
+        except Exception:  # pragma: no cover
+            pass
+
+
+class Coordinator(object):
+    """Elects a single member to discover all partitions and publishes them
+    to all other members, so only one member lists the queues.
+
+    The member, which creates the ephemeral `<path>/coordinator` node, is
+    the leader. It calls `discover` and stores the returned partitions in
+    `<path>/partitions`, on election and every `interval` seconds after.
+    All members watch that node. If the leader goes away, the remaining
+    members run for election, once its node is deleted.
+
+    :param client: A started `kazoo.client.KazooClient`.
+    :param path: The ZooKeeper path of the partitioner.
+    :type path: str
+    :param identifier: A unique identifier of this member.
+    :type identifier: str
+    :param discover: A function without arguments, returning a list of all
+        partitions. It is only called by the leader.
+    :param interval: Number of seconds between two discoveries.
+    :type interval: float
+    """
+
+    def __init__(self, client, path, identifier, discover, interval=300):
+        self._client = client
+        self._identifier = identifier
+        self._discover = discover
+        self.interval = interval
+        self._leader_path = path + '/coordinator'
+        self._partitions_path = path + '/partitions'
+        self._lock = threading.Lock()
+        self.leader = False
+        self.partitions = None
+        self._changed = False
+        self._next_discovery = 0
+        client.ensure_path(self._partitions_path)
+        client.add_listener(self._session_listener)
+        self._elect()
+        self._watch_partitions()
+
+    def _session_listener(self, state):
+        if state == KazooState.LOST:
+            # our leader node is gone with the session
+            self.leader = False
+
+    def _elect(self, event=None):
+        if self.leader:
+            return
+        try:
+            self._client.create(self._leader_path, self._identifier,
+                ephemeral=True)
+        except NodeExistsError:
+            # run for election again, once the leader is gone
+            if self._client.exists(self._leader_path,
+                    watch=self._elect) is None:  # pragma: no cover
+                self._elect()
+            return
+        except Exception:  # pragma: no cover
+            return
+        # the discovery itself happens outside of the watch
+        self._next_discovery = 0
+        self.leader = True
+
+    def _watch_partitions(self, event=None):
+        try:
+            data, stat = self._client.get(self._partitions_path,
+                watch=self._watch_partitions)
+        except NoNodeError:  # pragma: no cover
+            return
+        if not data:
+            return
+        partitions = ujson_decode(data)
+        with self._lock:
+            if partitions != self.partitions:
+                self.partitions = partitions
+                self._changed = True
+
+    def poll(self, now=None):
+        """Discover and publish the partitions, if this member is the
+        leader and the discovery is due. Returns `True` if the published
+        partitions changed since the last call.
+        """
+        if now is None:
+            now = time.time()
+        if self.leader and now >= self._next_discovery:
+            self._next_discovery = now + self.interval
+            partitions = sorted(self._discover())
+            if partitions != self.partitions:
+                self._client.set(self._partitions_path,
+                    ujson_encode(partitions))
+                with self._lock:
+                    # don't wait for our own watch
+                    self.partitions = partitions
+                    self._changed = True
+        with self._lock:
+            changed = self._changed
+            self._changed = False
+        return changed
+
+    def wait(self, timeout=30):
+        """Wait until the partitions are published, for at most `timeout`
+        seconds. Returns the partitions or `None`.
+        """
+        end = time.time() + timeout
+        while 1:
+            self.poll()
+            remaining = end - time.time()
+            if self.partitions is not None or remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.1))
+        return self.partitions
+
+    def finish(self):
+        """Step down as the leader."""
+        if not self.leader:
+            return
+        self.leader = False
+        try:
+            self._client.delete(self._leader_path)
+        except Exception:  # pragma: no cover
+            pass
+
+
+#: Partition functions selectable with the `partitions.strategy` setting
+STRATEGIES = {
+    'round_robin': round_robin,
+    'consistent_hash': consistent_hash,
+}
+
+
+class StaticPartitioner(object):
+    """A partitioner using a static set list. Basic API compatibility
+    with the `kazoo.recipe.SetPartitioner` is preserved.
+    """
+
+    failed = False
+    release = False
+    allocating = True
+    acquired = False
+    releasing = ()
+    poll_interval = None
+    draining = False
+
+    def __init__(self, path, set, identifier=None, time_boundary=0):
+        # path and time_boundary are ignored and only here for API
+        # compatibility with the kazoo version
+        self._set = set
+        self._identifier = identifier
+
+    def __iter__(self):
+        for s in self._set:
+            yield s
+
+    def poll(self):
+        pass
+
+    def token(self, partition):
+        return None
+
+    def holds(self, partition, now=None):
+        return True
+
+    def wait_for_acquire(self, timeout=0):
+        self.allocating = False
+        self.acquired = True
+
+    def release_set(self):  # pragma: no cover
+        pass
+
+    def drain(self):
+        # there's nobody to hand over the partitions to
+        self.finish()
+
+    def finish(self):
+        self.acquired = False
+        self.failed = True
+
+
+class IncrementalPartitioner(object):
+    """Divides a set of partitions amongst the members of a party, moving
+    only those partitions whose assignment changes.
+
+    Members join the party by creating an ephemeral node named by their
+    identifier below `<path>/party`. Ownership of a partition is an
+    ephemeral node `<path>/owners/<partition>`. Whenever the party
+    membership has been stable for `time_boundary` seconds, each member
+    computes its target set of partitions using `partition_func`. Owned
+    partitions no longer in the target set are put into :py:attr:`releasing`
+    and the partitioner enters the `release` state, while all other owned
+    partitions can still be worked on. Target partitions which are still
+    owned by another member are acquired as soon as that member releases
+    them.
+
+    Watch callbacks only record changes, all ZooKeeper updates are done
+    in :py:meth:`poll`, which has to be called regularly by the worker.
+
+    Each acquisition of a partition increments its fencing token, stored
+    as the version of `<path>/tokens/<partition>`, see :py:meth:`token`.
+
+    With a `lease_timeout`, members renew a lease by updating their party
+    node on every poll. A member which didn't renew its lease for
+    `lease_timeout` seconds, as observed by the other members, is treated
+    as gone, long before its ZooKeeper session expires. Its partitions are
+    reassigned and their ownership nodes taken over. A member noticing it
+    stalled for that long drops all partitions it no longer owns. Until it
+    renews its lease, :py:meth:`holds` returns `False` for all partitions.
+    This check happens before a write and can't prevent a write by a member
+    stalling right after it.
+
+    A draining member, see :py:meth:`drain`, leaves the party right away,
+    without a grace period, and hands over its partitions one at a time.
+
+    The state API is compatible with the kazoo `SetPartitioner`.
+
+    :param client: A started `kazoo.client.KazooClient`.
+    :param path: The ZooKeeper path for the party and ownership nodes.
+    :type path: str
+    :param set: All partitions.
+    :type set: tuple
+    :param partition_func: A function taking the identifier of this member,
+        the identifiers of all members and all partitions and returning the
+        target partitions of this member, or `None` to keep the current
+        ones. Defaults to :py:func:`round_robin`.
+    :param identifier: A unique identifier of this member.
+    :type identifier: str
+    :param time_boundary: Number of seconds the party membership has to be
+        stable before partitions are reassigned.
+    :type time_boundary: float
+    :param balancer: An optional :py:class:`LoadBalancer`, which replaces
+        the `partition_func`. Partitions are reassigned whenever the
+        balancer publishes a new assignment.
+    :param grace_period: Number of seconds a member, which left the party,
+        is still taken into account for the assignment. Its partitions stay
+        unassigned until then, so a restarted member gets them back without
+        moving any other partitions. This requires identifiers, which are
+        stable across restarts.
+    :type grace_period: float
+    :param lease_timeout: Number of seconds after which the partitions of a
+        member, that stopped renewing its lease, are taken over. Zero
+        disables leases.
+    :type lease_timeout: float
+    :param handoff_timeout: Maximum number of seconds a draining member
+        waits for another member to pick up a released partition.
+    :type handoff_timeout: float
+    :param capacity: The capacity of this member relative to the others.
+        Members with a higher capacity get proportionally more partitions.
+    :type capacity: float
+    :param max_partitions: The maximum number of partitions of this member,
+        zero meaning unlimited.
+    :type max_partitions: int
+    :param takeover: Take over the nodes of another session with the same
+        identifier, see below.
+    :type takeover: bool
+    :param clock: A function returning the current time in seconds,
+        defaults to :py:func:`time.time`. Replaced by simulations.
+
+    Capacity and maximum are advertised as the data of the party node and
+    passed as `capacities` to the partition function, see
+    :py:func:`round_robin`.
+
+    Joining with an identifier, which another session still holds, fails
+    with a `RuntimeError`. With `takeover`, the nodes of the other session
+    are taken over instead, so a restarted member with a stable identifier
+    doesn't have to wait for its old session to expire. This must only be
+    enabled, if no two running members ever share an identifier.
+    """
+
+    #: Number of seconds between retries to acquire partitions
+    retry_interval = 1.0
+
+    def __init__(self, client, path, set, partition_func=None,
+                 identifier=None, time_boundary=30, balancer=None,
+                 grace_period=0, lease_timeout=0, handoff_timeout=30,
+                 capacity=1.0, max_partitions=0, takeover=False,
+                 clock=time.time):
+        self.state = ALLOCATING
+        self._clock = clock
+        self._client = client
+        self._set = tuple(set)
+        self._partition_func = partition_func or round_robin
+        self._balancer = balancer
+        if balancer is not None:
+            self._partition_func = balancer.assign
+        self._identifier = identifier
+        self._time_boundary = time_boundary
+        self._grace_period = grace_period
+        self._lease_timeout = lease_timeout
+        self._handoff_timeout = handoff_timeout
+        self._takeover = takeover
+        if capacity <= 0:
+            raise ValueError('The capacity must be positive: %r' % capacity)
+        self._member_data = ujson_encode({
+            'capacity': capacity, 'max_partitions': max_partitions})
+        self._capacities = {}
+        self._party_path = path + '/party'
+        self._owners_path = path + '/owners'
+        self._tokens_path = path + '/tokens'
+        self._leaving_path = path + '/leaving'
+        self._lock = threading.Lock()
+        self._owned = []
+        self._target = []
+        self._lost = _builtin_set()
+        self.releasing = []
+        self.tokens = {}
+        self._renewed = clock()
+        self._next_renew = 0
+        self._leases = {}
+        self._expired = _builtin_set()
+        self.draining = False
+        self._handoff = None
+        self._members = None
+        self._present = []
+        self._departed = {}
+        self._members_changed = None
+        self._owners_changed = False
+        self._set_changed = False
+        self._next_retry = 0
+        client.ensure_path(self._party_path)
+        client.ensure_path(self._owners_path)
+        client.ensure_path(self._tokens_path)
+        client.ensure_path(self._leaving_path)
+        client.add_listener(self._session_listener)
+        self._join()
+        self._watch_members()
+        self._watch_owners()
+
+    @property
+    def failed(self):
+        return self.state == FAILURE
+
+    @property
+    def release(self):
+        return self.state == RELEASE
+
+    @property
+    def allocating(self):
+        return self.state == ALLOCATING
+
+    @property
+    def acquired(self):
+        return self.state == ACQUIRED
+
+    @property
+    def poll_interval(self):
+        """Maximum number of seconds between two calls to
+        :py:meth:`poll`.
+        """
+        interval = min(self._time_boundary, self.retry_interval)
+        if self._lease_timeout:
+            interval = min(interval, self._lease_timeout / 3.0)
+        return max(interval, 0.1)
+
+    def __iter__(self):
+        for partition in list(self._owned):
+            yield partition
+
+    def _join(self):
+        path = self._party_path + '/' + self._identifier
+        try:
+            self._client.create(path, self._member_data, ephemeral=True)
+        except NodeExistsError:
+            data, stat = self._client.get(path)
+            if stat.ephemeralOwner != self._client.client_id[0]:
+                if not self._takeover:
+                    raise RuntimeError('The identifier %r is in use by '
+                        'another session.' % self._identifier)
+                # left behind by our previous session
+                self._client.delete(path)
+                self._client.create(path, self._member_data, ephemeral=True)
+        try:
+            # we drained before a restart
+            self._client.delete(self._leaving_path + '/' + self._identifier)
+        except NoNodeError:
+            pass
+
+    def token(self, partition):
+        """Returns the fencing token of an owned partition or `None`. A new
+        owner always gets a higher token than all previous owners. It's up
+        to the storage of the checkpoints to reject writes with an older
+        token, Queuey doesn't.
+        """
+        return self.tokens.get(partition)
+
+    def holds(self, partition, now=None):
+        """Is `partition` owned and the lease of this member valid?"""
+        if partition not in self._owned:
+            return False
+        if not self._lease_timeout:
+            return True
+        if now is None:
+            now = self._clock()
+        return now - self._renewed < self._lease_timeout
+
+    def _next_token(self, partition):
+        path = self._tokens_path + '/' + partition
+        try:
+            stat = self._client.set(path, self._identifier)
+        except NoNodeError:
+            try:
+                self._client.create(path, self._identifier)
+            except NodeExistsError:  # pragma: no cover
+                pass
+            stat = self._client.set(path, self._identifier)
+        return stat.version
+
+    def _claim(self, path):
+        # take over an ownership node of our previous session or of a
+        # member whose lease expired
+        try:
+            data, stat = self._client.get(path)
+        except NoNodeError:  # pragma: no cover
+            return False
+        if data == self._identifier:
+            if stat.ephemeralOwner == self._client.client_id[0]:
+                return True
+            if not self._takeover:
+                return False
+        elif data not in self._expired:
+            return False
+        try:
+            self._client.delete(path, version=stat.version)
+            self._client.create(path, self._identifier, ephemeral=True)
+        except (NoNodeError, NodeExistsError):  # pragma: no cover
+            return False
+        return True
+
+    def _session_listener(self, state):
+        if state == KazooState.LOST:
+            # all ephemeral nodes are gone, including our ownerships
+            self.state = FAILURE
+
+    def _watch_members(self, event=None):
+        if self.failed:
+            return
+        try:
+            members = self._client.get_children(self._party_path,
+                watch=self._watch_members)
+        except NoNodeError:  # pragma: no cover
+            return
+        capacities = {}
+        for member in members:
+            if member not in self._present or member not in self._capacities:
+                # read the capacity of new and rejoined members
+                capacities[member] = self._read_capacity(member)
+        now = self._clock()
+        with self._lock:
+            self._capacities.update(capacities)
+            departed = self._departed
+            if self._grace_period:
+                for member in self._present:
+                    if member not in members and not self._leaving(member):
+                        departed[member] = now
+            for member in members:
+                departed.pop(member, None)
+            self._present = sorted(members)
+            self._update_members(now)
+
+    def _read_capacity(self, member):
+        # returns the advertised capacity and maximum partitions of a member
+        try:
+            data, stat = self._client.get(self._party_path + '/' + member)
+            data = ujson_decode(data)
+            return (float(data.get('capacity', 1.0)),
+                int(data.get('max_partitions', 0)))
+        except (NoNodeError, ValueError, AttributeError):
+            return (1.0, 0)
+
+    def _leaving(self, member):
+        # did the member leave for good, by draining?
+        return self._client.exists(self._leaving_path + '/' + member)
+
+    def _update_members(self, now):
+        # called with the lock held
+        members = set(self._present) | set(self._departed)
+        members = sorted(members - self._expired)
+        if self._members is None or members != self._members:
+            self._members = members
+            self._members_changed = now
+
+    def _watch_owners(self, event=None):
+        if self.failed:
+            return
+        try:
+            self._client.get_children(self._owners_path,
+                watch=self._watch_owners)
+        except NoNodeError:  # pragma: no cover
+            return
+        with self._lock:
+            self._owners_changed = True
+
+    def poll(self, now=None):
+        """Reassign partitions once the membership is stable and try to
+        acquire all target partitions not owned yet.
+        """
+        if self.failed or self.release:
+            return
+        if now is None:
+            now = self._clock()
+        if self.draining:
+            self._drain_step(now)
+            return
+        if self._lease_timeout and now >= self._next_renew:
+            self._renew(now)
+            if self.failed or self.release:
+                return
+        with self._lock:
+            expired = [m for m, left in self._departed.items()
+                if now - left >= self._grace_period]
+            if expired:
+                for member in expired:
+                    del self._departed[member]
+                self._update_members(now)
+            changed = self._members_changed
+            members = self._members
+            present = self._present
+            capacities = dict([(m, self._capacities.get(m, (1.0, 0)))
+                for m in members])
+            owners_changed = self._owners_changed
+            self._owners_changed = False
+            set_changed = self._set_changed
+            self._set_changed = False
+        stable = changed is None or now - changed >= self._time_boundary
+        reassign = set_changed
+        if stable and changed is not None:
+            reassign = True
+            with self._lock:
+                if self._members_changed == changed:
+                    self._members_changed = None
+        if stable and present and self._balancer is not None:
+            if self._balancer.poll(members, self._set, now,
+                    leader=present[0], capacities=capacities):
+                reassign = True
+        target = None
+        if reassign:
+            target = self._partition_func(
+                self._identifier, members, self._set, capacities=capacities)
+        if target is not None:
+            self._target = target
+            self.releasing = [p for p in self._owned
+                if p not in self._target]
+            self._acquire()
+            if self.releasing:
+                self.state = RELEASE
+            elif self.allocating:
+                self.state = ACQUIRED
+        elif not self.allocating and (
+                owners_changed or now >= self._next_retry):
+            self._acquire()
+
+    def update_set(self, partitions):
+        """Replace all partitions, for example after new queues have been
+        discovered. The partitions are reassigned at the next poll.
+        """
+        partitions = tuple(partitions)
+        if partitions == self._set:
+            return
+        with self._lock:
+            self._set = partitions
+            self._set_changed = True
+
+    def drain(self):
+        """Leave the party and hand over all owned partitions, one at a time.
+        Each partition is put into :py:attr:`releasing` and the next one is
+        released once another member acquired it, or after
+        `handoff_timeout` seconds. Once all partitions are handed over, the
+        partitioner enters the `failed` state, like after :py:meth:`finish`.
+        """
+        if self.failed or self.draining:
+            return
+        self.draining = True
+        self._target = []
+        identifier = self._identifier
+        try:
+            self._client.create(self._leaving_path + '/' + identifier,
+                identifier, ephemeral=True)
+        except NodeExistsError:  # pragma: no cover
+            pass
+        try:
+            self._client.delete(self._party_path + '/' + identifier)
+        except NoNodeError:  # pragma: no cover
+            pass
+        if self._balancer is not None:
+            self._balancer.finish()
+
+    def _drain_step(self, now):
+        # nobody checks our lease anymore
+        self._renewed = now
+        with self._lock:
+            owners_changed = self._owners_changed
+            self._owners_changed = False
+        if self._handoff is not None:
+            partition, deadline = self._handoff
+            if now < deadline:
+                if not owners_changed and now < self._next_retry:
+                    return
+                self._next_retry = now + self.retry_interval
+                if not self._client.exists(
+                        self._owners_path + '/' + partition):
+                    return
+            self._handoff = None
+        if not self._owned:
+            self.finish()
+            return
+        self.releasing = [self._owned[0]]
+        self.state = RELEASE
+
+    def _renew(self, now):
+        path = self._party_path + '/' + self._identifier
+        try:
+            self._client.set(path, self._member_data)
+        except NoNodeError:  # pragma: no cover
+            self.state = FAILURE
+            return
+        if now - self._renewed >= self._lease_timeout:
+            # we stalled, others might have taken over our partitions
+            self._fence()
+        self._renewed = now
+        self._next_renew = now + self._lease_timeout / 3.0
+        self._check_leases(now)
+
+    def _fence(self):
+        session = self._client.client_id[0]
+        lost = []
+        for partition in self._owned:
+            try:
+                data, stat = self._client.get(
+                    self._owners_path + '/' + partition)
+            except NoNodeError:
+                lost.append(partition)
+                continue
+            if stat.ephemeralOwner != session:
+                lost.append(partition)
+        for partition in lost:
+            self._owned.remove(partition)
+            self.tokens.pop(partition, None)
+        if lost:
+            self._lost.update(lost)
+            self.releasing = lost
+            self.state = RELEASE
+
+    def _check_leases(self, now):
+        # observe the lease renewals of all other members
+        leases = self._leases
+        expired = set()
+        for member in self._present:
+            if member == self._identifier:
+                continue
+            try:
+                data, stat = self._client.get(self._party_path + '/' + member)
+            except NoNodeError:
+                continue
+            lease = leases.get(member)
+            if lease is None or lease[0] != stat.version:
+                leases[member] = lease = (stat.version, now)
+            if now - lease[1] >= self._lease_timeout:
+                expired.add(member)
+        for member in leases.keys():
+            if member not in self._present:
+                del leases[member]
+        with self._lock:
+            if expired != self._expired:
+                self._expired = expired
+                self._update_members(now)
+
+    def _acquire(self):
+        owned = self._owned
+        missing = [p for p in self._target if p not in owned]
+        for partition in missing:
+            path = self._owners_path + '/' + partition
+            try:
+                self._client.create(path, self._identifier, ephemeral=True)
+            except NodeExistsError:
+                if not self._claim(path):
+                    continue
+            owned.append(partition)
+            self.tokens[partition] = self._next_token(partition)
+        self._next_retry = self._clock() + self.retry_interval
+
+    def wait_for_acquire(self, timeout=30):
+        """Wait until the initial assignment is done."""
+        end = time.time() + timeout
+        while self.allocating:
+            self.poll()
+            remaining = end - time.time()
+            if not self.allocating or remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.1))
+
+    def release_set(self):
+        """Give up all partitions in :py:attr:`releasing`. The caller has to
+        make sure to stop working on them first.
+        """
+        for partition in self.releasing:
+            if partition in self._lost:
+                # the node belongs to the new owner
+                self._lost.discard(partition)
+                continue
+            try:
+                self._client.delete(self._owners_path + '/' + partition)
+            except NoNodeError:  # pragma: no cover
+                pass
+            if partition in self._owned:
+                self._owned.remove(partition)
+            self.tokens.pop(partition, None)
+            if self.draining:
+                self._handoff = (partition,
+                    self._clock() + self._handoff_timeout)
+        self.releasing = []
+        if self.release:
+            self.state = ACQUIRED
+        self._acquire()
+
+    def finish(self):
+        """Give up all partitions and leave the party."""
+        if self.failed:
+            return
+        self.state = FAILURE
+        for partition in self._owned:
+            try:
+                self._client.delete(self._owners_path + '/' + partition)
+            except Exception:  # pragma: no cover
+                pass
+        self._owned = []
+        for path in (self._party_path, self._leaving_path):
+            try:
+                self._client.delete(path + '/' + self._identifier)
+            except Exception:  # pragma: no cover
+                pass
+        if self._balancer is not None:
+            self._balancer.finish()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import cProfile
+from functools import wraps
+import os
+import os.path
+import pstats
+import threading
+import time
+
+from qdo.log import log_raven
+
+DEFAULT_PROFILE_PATH = os.path.join(os.curdir, 'var')
+
+
+class JobProfiler(object):
+    """Profiles every Nth job call and periodically writes the aggregated
+    profile in :py:mod:`pstats` format, to be inspected with the standard
+    library tools or a viewer like `RunSnakeRun`. The wrapped job can be
+    called from multiple threads, like the worker lanes.
+
+    :param every: Profile every `every` th job call.
+    :type every: int
+    :param interval: Minimum number of seconds between two writes.
+    :type interval: int
+    :param path: Directory in which the profile is written.
+    :type path: str
+    :param name: Name of the profile file, defaults to
+        `qdo-worker-<pid>.pstats`.
+    :type name: str
+    """
+
+    def __init__(self, every=100, interval=300, path=DEFAULT_PROFILE_PATH,
+                 name=None):
+        self.every = every
+        self.interval = interval
+        if name is None:
+            name = 'qdo-worker-%s.pstats' % os.getpid()
+        self.filename = os.path.join(path, name)
+        self.calls = 0
+        self.samples = 0
+        self.stats = None
+        self.last_dump = time.time()
+        self._lock = threading.Lock()
+
+    def wrap(self, func):
+        """Returns a wrapper for `func`, which profiles every Nth call."""
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with self._lock:
+                self.calls += 1
+                sample = not self.calls % self.every
+            if not sample:
+                return func(*args, **kwargs)
+            return self.runcall(func, *args, **kwargs)
+        return wrapped
+
+    def runcall(self, func, *args, **kwargs):
+        """Call `func` under the profiler and add the result to the
+        aggregated profile, even if `func` raised an exception.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.samples += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+            if time.time() - self.last_dump >= self.interval:
+                self.dump()
+
+    def dump(self):
+        """Write the aggregated profile, replacing any earlier version.
+
+        Write errors are logged and otherwise ignored, so they neither fail
+        the profiled job nor hide its own exception.
+        """
+        with self._lock:
+            self.last_dump = time.time()
+            if self.stats is None:
+                return
+            tmp_name = self.filename + '.tmp'
+            try:
+                self.stats.dump_stats(tmp_name)
+                os.rename(tmp_name, self.filename)
+            except Exception:
+                log_raven()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+import threading
+
+
+class PoisonMessage(Exception):
+    """Passed to the `job_failure` hook instead of running the job for a
+    quarantined message.
+    """
+
+
+class Quarantine(object):
+    """Remembers how often messages failed and quarantines those, which
+    failed `max_failures` times.
+
+    Failure counts are kept for at most `capacity` message ids, those which
+    didn't fail for the longest time are forgotten first. Failed messages
+    saved to the error queue carry an `attempts` counter, which is taken
+    into account as well, so messages keep their failure count across
+    replays and restarts.
+
+    :param max_failures: Number of failures after which a message is
+        quarantined. Zero disables the quarantine.
+    :type max_failures: int
+    :param capacity: Maximum number of tracked message ids.
+    :type capacity: int
+    """
+
+    def __init__(self, max_failures=0, capacity=10000):
+        self.max_failures = max_failures
+        self.capacity = capacity
+        self.quarantined = 0
+        # failure counts by message id, least recently failed first
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.max_failures)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def failures(self, message):
+        """Returns the number of known failures of `message`."""
+        tracked = self._counts.get(message.get('message_id'), 0)
+        return max(tracked, message.get('attempts', 0))
+
+    def is_poison(self, message):
+        """Should `message` be quarantined instead of running its job?
+        Every positive answer is counted in `quarantined`.
+        """
+        if not self.enabled:
+            return False
+        if self.failures(message) < self.max_failures:
+            return False
+        with self._lock:
+            self.quarantined += 1
+        return True
+
+    def record_failure(self, message):
+        """Record a failed job for `message`."""
+        if not self.enabled:
+            return
+        message_id = message.get('message_id')
+        with self._lock:
+            counts = self._counts
+            # move the entry to the end, it failed most recently
+            count = counts.pop(message_id, 0) + 1
+            while counts and len(counts) >= self.capacity:
+                counts.popitem(last=False)
+            counts[message_id] = count
+
+    def record_success(self, message):
+        """Forget about earlier failures of `message`."""
+        if self._counts:
+            with self._lock:
+                self._counts.pop(message.get('message_id'), None)
+
+    def as_dict(self):
+        return {
+            'tracked': len(self._counts),
+            'quarantined': self.quarantined,
+        }
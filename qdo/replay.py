@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+
+from queuey_py import Client
+from ujson import decode as ujson_decode
+
+from qdo.config import ERROR_PARTITIONS
+from qdo.config import ERROR_QUEUE
+from qdo.errors import post_failed_messages
+from qdo.log import log_raven
+from qdo.partition import message_time
+from qdo.quarantine import Quarantine
+from qdo.worker import dict_context
+from qdo.worker import resolve
+from qdo.worker import StopWorker
+
+
+class RateLimiter(object):
+    """A thread-safe limiter allowing at most `rate` calls of
+    :py:meth:`acquire` per second, a rate of zero means no limit.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(self._next, now) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Replayer(object):
+    """Replays failed messages from the error queue through the configured
+    job, in parallel across the error queue partitions.
+
+    Messages are selected by the `replay` settings section. Successfully
+    replayed messages are deleted from the error queue. Messages failing
+    again are saved once more with an increased `attempts` counter. Only
+    messages saved before the replay started are considered, so messages
+    failing again aren't retried within one run. Quarantined messages,
+    which failed too often, are left in the error queue untouched.
+
+    :param settings: Configuration settings
+    :type settings: dict
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.job = None
+        self.job_context = dict_context
+        self.shutdown = False
+        self.replayed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.quarantined = 0
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(self):
+        qdo_section = self.settings.getsection('qdo-worker')
+        resolve(self, qdo_section, 'job')
+        resolve(self, qdo_section, 'job_context')
+        queuey_section = self.settings.getsection('queuey')
+        self.app_key = queuey_section['app_key']
+        self.connection = queuey_section['connection']
+        replay_section = self.settings.getsection('replay')
+        self.queue = replay_section['queue']
+        self.since = replay_section['since']
+        self.until = replay_section['until']
+        partitions = replay_section['partitions']
+        if not isinstance(partitions, list):
+            # a single partition is parsed as a plain number
+            partitions = [partitions]
+        self.partitions = [int(p) for p in partitions if p]
+        if not self.partitions:
+            self.partitions = range(1, ERROR_PARTITIONS + 1)
+        self.limiter = RateLimiter(float(replay_section['rate']))
+        quarantine_section = self.settings.getsection('quarantine')
+        self.quarantine = Quarantine(
+            max_failures=quarantine_section['max_failures'])
+
+    def matches(self, message):
+        """Does the failed `message` match the configured filters?"""
+        if self.queue:
+            queue = message.get('queue', '')
+            if queue != self.queue and not queue.startswith(
+                    self.queue + '-'):
+                return False
+        if self.since or self.until:
+            timestamp = float(message['timestamp'])
+            if self.since and timestamp < self.since:
+                return False
+            if self.until and timestamp > self.until:
+                return False
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def replay_partition(self, partition, started, batch_size=100):
+        """Replay all matching messages of one error queue partition."""
+        try:
+            self._replay_partition(partition, started, batch_size)
+        except Exception:
+            # don't let one partition take down the others
+            log_raven()
+
+    def _replay_partition(self, partition, started, batch_size):
+        # requests sessions aren't thread-safe, use one client per thread
+        queuey_conn = Client(self.app_key, connection=self.connection)
+        since = None
+        with self.job_context() as context:
+            while not self.shutdown:
+                messages = queuey_conn.messages(ERROR_QUEUE,
+                    partition=partition, since=since, limit=batch_size)
+                if not messages:
+                    break
+                for entry in messages:
+                    since = entry['message_id']
+                    if message_time(since) > started:
+                        # saved during this replay
+                        return
+                    message = ujson_decode(entry['body'])
+                    if not self.matches(message):
+                        self._count('skipped')
+                        continue
+                    if self.quarantine.is_poison(message):
+                        self._count('quarantined')
+                        continue
+                    self.limiter.acquire()
+                    self.replay_message(queuey_conn, context, partition,
+                        since, message)
+                    if self.shutdown:
+                        return
+
+    def replay_message(self, queuey_conn, context, partition, error_id,
+                       message):
+        """Run the job for one failed `message`, stored as `error_id` in
+        the error queue.
+        """
+        try:
+            self.job(message, context)
+            self._count('replayed')
+        except StopWorker:
+            self.shutdown = True
+            return
+        except Exception:
+            log_raven()
+            self._count('failed')
+            message['attempts'] = message.get('attempts', 1) + 1
+            try:
+                post_failed_messages(queuey_conn, [message])
+            except Exception:
+                # keep the old copy around
+                log_raven()
+                return
+        try:
+            queuey_conn.delete('%s/%s%%3A%s' % (
+                ERROR_QUEUE, partition, error_id))
+        except Exception:
+            # the message will be replayed once more
+            log_raven()
+
+    def run(self):
+        """Replay all partitions in parallel and wait for them to finish."""
+        if not self.job:
+            return
+        started = time.time()
+        threads = []
+        for partition in self.partitions:
+            thread = threading.Thread(target=self.replay_partition,
+                args=(partition, started))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+
+def run(settings):  # pragma: no cover
+    replayer = Replayer(settings)
+    replayer.run()
+    print('Replayed: %s, failed again: %s, skipped: %s, quarantined: %s' % (
+        replayer.replayed, replayer.failed, replayer.skipped,
+        replayer.quarantined))
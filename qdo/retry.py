@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import heapq
+import random
+import time
+
+
+def _resolve_exception(spec):
+    # resolve a `module:Class` resource specification
+    mod, name = spec.split(':')
+    result = __import__(mod, globals(), locals(), name)
+    return getattr(result, name)
+
+
+class RetryPolicy(object):
+    """Decides if and when a failed job is retried.
+
+    Retries use exponential back-off with equal jitter: the n-th retry waits
+    a random time between half and all of `backoff * 2 ** (n - 1)` seconds,
+    capped at `max_backoff`.
+
+    :param attempts: Number of retries for any exception, not counting the
+        first attempt. Zero disables retries.
+    :type attempts: int
+    :param backoff: Base wait time in seconds before the first retry.
+    :type backoff: float
+    :param max_backoff: Maximum wait time in seconds between two retries.
+    :type max_backoff: float
+    :param exceptions: A list of `module:Class N` strings, overriding the
+        number of retries for specific exception classes and their
+        subclasses. The first matching entry wins.
+    :type exceptions: list
+    """
+
+    def __init__(self, attempts=0, backoff=0.5, max_backoff=30,
+                 exceptions=()):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.exceptions = []
+        if isinstance(exceptions, basestring):
+            exceptions = [exceptions]
+        for entry in exceptions:
+            spec, count = entry.split()
+            self.exceptions.append((_resolve_exception(spec), int(count)))
+
+    @property
+    def enabled(self):
+        if self.attempts:
+            return True
+        for exc_class, count in self.exceptions:
+            if count:
+                return True
+        return False
+
+    def attempts_for(self, exc):
+        """Returns the number of retries allowed for the exception `exc`."""
+        for exc_class, count in self.exceptions:
+            if isinstance(exc, exc_class):
+                return count
+        return self.attempts
+
+    def delay(self, retry):
+        """Returns the number of seconds to wait before the `retry` th
+        retry, counting from one.
+        """
+        wait = min(self.backoff * 2 ** (retry - 1), self.max_backoff)
+        return random.uniform(wait / 2.0, wait)
+
+
+class RetryQueue(object):
+    """Holds failed messages until their next retry is due.
+
+    :param policy: The retry policy.
+    :type policy: :py:class:`RetryPolicy`
+    :param capacity: Maximum number of messages waiting for their retry.
+    :type capacity: int
+    """
+
+    def __init__(self, policy, capacity=1000):
+        self.policy = policy
+        self.capacity = capacity
+        self._heap = []
+        self._pending = {}
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def full(self):
+        return len(self._heap) >= self.capacity
+
+    def pending(self, partition):
+        """Returns the number of messages of `partition` waiting for a
+        retry.
+        """
+        return self._pending.get(partition, 0)
+
+    def schedule(self, partition, message, exc, retry=1, now=None):
+        """Schedule the `retry` th retry of a failed message. Returns `False`
+        if the policy doesn't allow any more retries for `exc` or the queue
+        is full.
+        """
+        if retry > self.policy.attempts_for(exc):
+            return False
+        if self.full:
+            return False
+        if now is None:
+            now = time.time()
+        due = now + self.policy.delay(retry)
+        self._seq += 1
+        heapq.heappush(self._heap,
+            (due, self._seq, partition, message, retry))
+        self._pending[partition] = self._pending.get(partition, 0) + 1
+        return True
+
+    def next_due(self):
+        """Returns the time the next retry is due or `None`."""
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, now=None):
+        """Remove and return all retries which are due, as a list of
+        `(partition, message, retry)` tuples. They stay pending until
+        :py:meth:`done` is called for each of them.
+        """
+        if now is None:
+            now = time.time()
+        result = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            due, seq, partition, message, retry = heapq.heappop(heap)
+            result.append((partition, message, retry))
+        return result
+
+    def done(self, partition):
+        """Mark one retry of `partition` as finished."""
+        count = self._pending[partition] - 1
+        if count:
+            self._pending[partition] = count
+        else:
+            del self._pending[partition]
+
+    def discard(self, partitions):
+        """Forget all retries of the given partitions, for example after
+        they have been released.
+        """
+        partitions = set(partitions)
+        self._heap = [e for e in self._heap if e[2] not in partitions]
+        heapq.heapify(self._heap)
+        for partition in partitions:
+            self._pending.pop(partition, None)
@@ -11,6 +11,7 @@ import sys
 import pkg_resources
 
 from qdo import log
+from qdo import replay
 from qdo import worker
 from qdo.config import load_into_settings
 from qdo.config import QdoSettings
@@ -29,12 +30,40 @@ def _nicepath(filename):
 def parse_args(args):
     version = pkg_resources.get_distribution('qdo').version
     parser = argparse.ArgumentParser(description='qdo worker')
+    parser.add_argument('command', nargs='?', default='work',
+                        choices=('work', 'replay-errors'),
+                        help='either work on all queues (the default) or '
+                             'replay failed messages from the error queue')
     parser.add_argument('-v', '--version', action='version',
                         version='%(prog)s ' + version)
     parser.add_argument('-c', '--config', action='store',
                         dest='configfile', default=DEFAULT_CONFIGFILE,
                         help='specify configuration file, defaults to '
                              '%s' % DEFAULT_CONFIGFILE)
+    parser.add_argument('-p', '--profile', action='store', type=int,
+                        dest='profile_every', default=None, metavar='N',
+                        help='profile every Nth job and write the '
+                             'aggregated profile into the var directory')
+    group = parser.add_argument_group('replay-errors options')
+    group.add_argument('--queue', action='store', dest='replay_queue',
+                       default=None, metavar='NAME',
+                       help='only replay messages of this queue or '
+                            '<queue>-<partition>')
+    group.add_argument('--since', action='store', type=float,
+                       dest='replay_since', default=None, metavar='TIME',
+                       help='only replay messages posted at or after this '
+                            'unix timestamp')
+    group.add_argument('--until', action='store', type=float,
+                       dest='replay_until', default=None, metavar='TIME',
+                       help='only replay messages posted at or before this '
+                            'unix timestamp')
+    group.add_argument('--rate', action='store', type=float,
+                       dest='replay_rate', default=None, metavar='N',
+                       help='replay at most N messages per second')
+    group.add_argument('--partition', action='append', type=int,
+                       dest='replay_partitions', default=None, metavar='N',
+                       help='only replay this error queue partition, can '
+                            'be given multiple times')
     return parser.parse_args(args=args)
 
 
@@ -61,5 +90,14 @@ def run(args=sys.argv[1:]):
     if config is None:
         print('Configuration file not found or cannot be read.')
         sys.exit(1)
+    if arguments.profile_every is not None:
+        settings['qdo-worker.profile_every'] = arguments.profile_every
+    if arguments.command == 'replay-errors':
+        for name in ('queue', 'since', 'until', 'rate', 'partitions'):
+            value = getattr(arguments, 'replay_' + name)
+            if value is not None:
+                settings['replay.' + name] = value
+        replay.run(settings)
+        sys.exit(0)  # pragma: no cover
     worker.run(settings)
     sys.exit(0)  # pragma: no cover
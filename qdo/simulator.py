@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+import heapq
+import random
+
+from qdo.log import Histogram
+from qdo.partitioner import IncrementalPartitioner
+from qdo.partitioner import STRATEGIES
+from qdo.testing import FakeZooKeeper
+from qdo.worker import backoff
+
+_PATH = '/worker'
+
+
+class SimulatedQueue(object):
+    """A queue with a synthetic message arrival rate and job cost.
+
+    :param name: The queue name.
+    :type name: str
+    :param partitions: Number of partitions, messages are spread evenly.
+    :type partitions: int
+    :param rate: Average number of new messages per second, arriving as a
+        Poisson process.
+    :type rate: float
+    :param job_time: Either the average job time in seconds of an
+        exponential distribution, or a function taking a
+        :py:class:`random.Random` instance and returning the job time of a
+        single message.
+    """
+
+    def __init__(self, name, partitions=1, rate=1.0, job_time=0.01):
+        self.name = name
+        self.partitions = partitions
+        self.rate = rate
+        self.job_time = job_time
+
+    def names(self):
+        return ['%s-%s' % (self.name, i)
+            for i in xrange(1, self.partitions + 1)]
+
+    def cost(self, rng):
+        if callable(self.job_time):
+            return self.job_time(rng)
+        if not self.job_time:
+            return 0.0
+        return rng.expovariate(1.0 / self.job_time)
+
+
+class _Partition(object):
+
+    __slots__ = ('queue', 'rate', 'next_arrival', 'pending')
+
+    def __init__(self, queue, rng):
+        self.queue = queue
+        self.rate = float(queue.rate) / queue.partitions
+        self.next_arrival = self._interval(rng)
+        self.pending = deque()
+
+    def _interval(self, rng):
+        if self.rate <= 0:
+            return float('inf')
+        return rng.expovariate(self.rate)
+
+    def arrive(self, now, rng):
+        # add all messages, which arrived until `now`
+        while self.next_arrival <= now:
+            self.pending.append(self.next_arrival)
+            self.next_arrival += self._interval(rng)
+        return self.pending
+
+
+class _Worker(object):
+
+    def __init__(self, name, start, stop, capacity):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.capacity = capacity
+        self.client = None
+        self.partitioner = None
+        self.running = False
+        self.waited = 0
+        self.wait_until = 0
+        self.processed = 0
+        self.idle_polls = 0
+        self.idle_seconds = 0.0
+        self.paused_seconds = 0.0
+        self.rebalances = 0
+
+    def as_dict(self):
+        return {
+            'processed': self.processed,
+            'idle_polls': self.idle_polls,
+            'idle_seconds': self.idle_seconds,
+            'paused_seconds': self.paused_seconds,
+            'rebalances': self.rebalances,
+            'partitions': sorted(self.partitioner or []),
+        }
+
+
+class Simulation(object):
+    """A discrete-event simulation of multiple workers, sharing the
+    partitions of synthetic queues. It can be used to choose the
+    `wait_interval`, `party_wait` and number of workers for a given
+    workload, without experimenting in production.
+
+    Each worker runs the real
+    :py:class:`~qdo.partitioner.IncrementalPartitioner` against an
+    in-process :py:class:`~qdo.testing.FakeZooKeeper`, driven by the
+    simulated clock. Like the worker loop, each round polls the
+    partitioner, fetches one message from each owned partition and runs its
+    job. Rounds without any messages are followed by the same randomized,
+    exponential wait as in :py:meth:`qdo.worker.Worker.wait`, during which
+    only the partitioner is polled. Each fetch takes `fetch_time` seconds,
+    whether or not there was a message.
+
+    :param queues: The simulated queues.
+    :type queues: list of :py:class:`SimulatedQueue`
+    :param wait_interval: The `qdo-worker.wait_interval` setting.
+    :type wait_interval: float
+    :param party_wait: The `zookeeper.party_wait` setting.
+    :type party_wait: float
+    :param strategy: The `partitions.strategy` setting, either
+        `round_robin` or `consistent_hash`.
+    :type strategy: str
+    :param grace_period: The `partitions.grace_period` setting.
+    :type grace_period: float
+    :param fetch_time: Number of seconds of a single request to Queuey.
+    :type fetch_time: float
+    :param seed: Seed of the random number generator, to get reproducible
+        results.
+    """
+
+    def __init__(self, queues, wait_interval=30, party_wait=10,
+                 strategy='round_robin', grace_period=0, fetch_time=0.005,
+                 seed=None):
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown partition strategy: %r' % strategy)
+        self.queues = queues
+        self.wait_interval = wait_interval
+        self.party_wait = party_wait
+        self.partition_func = STRATEGIES[strategy]
+        self.grace_period = grace_period
+        self.fetch_time = fetch_time
+        self.random = random.Random(seed)
+        self.zookeeper = FakeZooKeeper()
+        self.now = 0.0
+        self.workers = []
+        self.partitions = {}
+        for queue in queues:
+            for name in queue.names():
+                self.partitions[name] = _Partition(queue, self.random)
+        self.lag = Histogram()
+        self.unowned_seconds = 0.0
+        self._events = []
+        self._sequence = 0
+        self._unowned = len(self.partitions)
+
+    def clock(self):
+        return self.now
+
+    def add_worker(self, start=0, stop=None, capacity=1.0):
+        """Add a worker, joining the party at `start` and leaving it at
+        `stop` seconds into the simulation. Returns the worker name.
+        """
+        name = 'worker%s' % len(self.workers)
+        worker = _Worker(name, start, stop, capacity)
+        self.workers.append(worker)
+        self._schedule(start, worker, self._start)
+        if stop is not None:
+            self._schedule(stop, worker, self._stop)
+        return name
+
+    def _schedule(self, when, worker, action):
+        self._sequence += 1
+        heapq.heappush(self._events, (when, self._sequence, worker, action))
+
+    def _count_unowned(self):
+        owned = self.zookeeper.get_children(_PATH + '/owners')
+        self._unowned = len(self.partitions) - len(owned)
+
+    def _start(self, worker):
+        worker.client = self.zookeeper.client()
+        worker.client.start()
+        worker.partitioner = IncrementalPartitioner(worker.client, _PATH,
+            set=tuple(sorted(self.partitions)),
+            partition_func=self.partition_func, identifier=worker.name,
+            time_boundary=self.party_wait, grace_period=self.grace_period,
+            capacity=worker.capacity, clock=self.clock)
+        worker.running = True
+        self._step(worker)
+
+    def _stop(self, worker):
+        worker.running = False
+        worker.partitioner.finish()
+        worker.client.stop()
+
+    def _step(self, worker):
+        if not worker.running:
+            return
+        now = self.now
+        partitioner = worker.partitioner
+        partitioner.poll(now)
+        if partitioner.release:
+            worker.rebalances += 1
+            partitioner.release_set()
+            self._schedule(now, worker, self._step)
+            return
+        if partitioner.allocating:
+            # the worker waits for the initial assignment
+            pause = 0.1
+            worker.paused_seconds += pause
+            self._schedule(now + pause, worker, self._step)
+            return
+        if not partitioner.acquired:
+            worker.running = False
+            return
+        rng = self.random
+        names = list(partitioner)
+        no_messages = 0
+        when = now
+        for name in names:
+            when += self.fetch_time
+            partition = self.partitions[name]
+            pending = partition.arrive(when, rng)
+            if not pending:
+                no_messages += 1
+                continue
+            arrived = pending.popleft()
+            self.lag.record((when - arrived) * 1000)
+            when += partition.queue.cost(rng)
+            worker.processed += 1
+        if no_messages == len(names):
+            seconds = backoff(self.wait_interval, worker.waited,
+                rng.uniform(0.8, 1.2))
+            worker.waited += 1
+            worker.idle_polls += 1
+            worker.idle_seconds += seconds
+            worker.wait_until = when + seconds
+            self._schedule(when, worker, self._wait)
+            return
+        worker.waited = 0
+        self._schedule(when, worker, self._step)
+
+    def _wait(self, worker):
+        # like Worker.wait, poll the partitioner in slices of its
+        # poll_interval and only fetch messages again once the wait is over
+        # or the partitions changed
+        if not worker.running:
+            return
+        now = self.now
+        partitioner = worker.partitioner
+        if now < worker.wait_until:
+            owned = list(partitioner)
+            partitioner.poll(now)
+            if (partitioner.release or partitioner.allocating or
+                    partitioner.failed or list(partitioner) != owned):
+                worker.idle_seconds -= worker.wait_until - now
+                worker.wait_until = now
+        if now >= worker.wait_until:
+            self._step(worker)
+            return
+        when = worker.wait_until
+        if partitioner.poll_interval:
+            when = min(when, now + partitioner.poll_interval)
+        self._schedule(when, worker, self._wait)
+
+    def run(self, duration):
+        """Run the simulation for `duration` seconds and return a report.
+
+        :rtype: dict
+        """
+        events = self._events
+        while events and events[0][0] <= duration:
+            when, sequence, worker, action = heapq.heappop(events)
+            self.unowned_seconds += (when - self.now) * self._unowned
+            self.now = when
+            action(worker)
+            self._count_unowned()
+        self.unowned_seconds += (duration - self.now) * self._unowned
+        self.now = duration
+        return self.report(duration)
+
+    def report(self, duration):
+        """Returns the throughput in messages per second, the lag of the
+        processed messages in milliseconds, the number of idle polls and
+        rebalances and the pauses caused by them. `paused_seconds` is the
+        time workers spent waiting for their initial assignment,
+        `unowned_seconds` sums up the time each partition had no owner.
+
+        :rtype: dict
+        """
+        lag = self.lag
+        processed = sum([w.processed for w in self.workers])
+        backlog = 0
+        for partition in self.partitions.values():
+            backlog += len(partition.arrive(duration, self.random))
+        return {
+            'duration': duration,
+            'processed': processed,
+            'throughput': processed / float(duration) if duration else 0.0,
+            'backlog': backlog,
+            'lag': {
+                'mean': lag.total / float(lag.count) if lag.count else 0.0,
+                'p50': lag.percentile(50),
+                'p99': lag.percentile(99),
+                'max': lag.max,
+            },
+            'idle_polls': sum([w.idle_polls for w in self.workers]),
+            'rebalances': sum([w.rebalances for w in self.workers]),
+            'paused_seconds': sum([w.paused_seconds for w in self.workers]),
+            'unowned_seconds': self.unowned_seconds,
+            'workers': dict([(w.name, w.as_dict()) for w in self.workers]),
+        }
@@ -3,12 +3,26 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import itertools
 import os
 import os.path
+import threading
 import time
 import xmlrpclib
 
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NotEmptyError
+from kazoo.exceptions import ZookeeperStoppedError
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
+from kazoo.protocol.states import KeeperState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
 from qdo import log
+from qdo.log import log_raven
 from qdo.worker import StopWorker
 
 here = os.path.dirname(__file__)
@@ -65,3 +79,321 @@ def setup():
 def teardown():
     """Shared one-time test tear down, called from tests/__init__.py"""
     pass
+
+
+class _Node(object):
+
+    __slots__ = ('data', 'czxid', 'mzxid', 'ctime', 'mtime', 'version',
+        'cversion', 'owner', 'children', 'sequence')
+
+    def __init__(self, data, zxid, owner):
+        self.data = data
+        self.czxid = self.mzxid = zxid
+        self.ctime = self.mtime = int(time.time() * 1000)
+        self.version = 0
+        self.cversion = 0
+        self.owner = owner
+        self.children = set()
+        self.sequence = 0
+
+    def stat(self):
+        return ZnodeStat(self.czxid, self.mzxid, self.ctime, self.mtime,
+            self.version, self.cversion, 0, self.owner or 0, len(self.data),
+            len(self.children), self.mzxid)
+
+
+def _parent(path):
+    return path.rsplit('/', 1)[0] or '/'
+
+
+class FakeZooKeeper(object):
+    """An in-process stand-in for a ZooKeeper ensemble, shared by any number
+    of :py:class:`FakeClient` instances, each with its own session.
+
+    It implements the subset of the kazoo client API used by qdo: creating
+    ephemeral and sequence nodes, deleting, reading and updating nodes with
+    version checks, listing children and one-shot data and child watches.
+    Watches are called synchronously, after the change is applied, in the
+    thread making the change.
+
+    Pass :py:meth:`client` as the `zk_client_class` of a
+    :py:class:`qdo.worker.Worker`, to run multiple workers as threads of a
+    single test.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._zxid = itertools.count(1)
+        self._sessions = itertools.count(1)
+        self.nodes = {'/': _Node('', 0, None)}
+        self.clients = {}
+        self._data_watches = {}
+        self._child_watches = {}
+
+    def client(self, hosts=None, **kw):
+        """Returns a new, not yet started client. Takes the same arguments
+        as `kazoo.client.KazooClient`, which are ignored.
+        """
+        return FakeClient(self)
+
+    def _connect(self, client):
+        with self._lock:
+            session = self._sessions.next()
+            self.clients[session] = client
+            return session
+
+    def expire(self, session):
+        """Expire a session, removing all its ephemeral nodes. Its client
+        is notified with a `LOST` state.
+        """
+        with self._lock:
+            client = self.clients.pop(session, None)
+            paths = [path for path, node in self.nodes.items()
+                if node.owner == session]
+            # a closed session doesn't receive any more events
+            for watches in (self._data_watches, self._child_watches):
+                for path, callbacks in watches.items():
+                    callbacks[:] = [c for c in callbacks if c[0] != session]
+        if client is not None:
+            client._lost()
+        for path in sorted(paths, reverse=True):
+            try:
+                self.delete(path)
+            except NoNodeError:  # pragma: no cover
+                pass
+
+    def _fire(self, watches, path, event_type):
+        # one-shot watches are removed before they are called
+        with self._lock:
+            callbacks = watches.pop(path, [])
+        event = WatchedEvent(event_type, KeeperState.CONNECTED, path)
+        for session, callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                # like kazoo, don't let a watch fail the change itself
+                log_raven()
+
+    def _watch(self, watches, path, callback, session):
+        with self._lock:
+            callbacks = watches.setdefault(path, [])
+            if (session, callback) not in callbacks:
+                callbacks.append((session, callback))
+
+    def create(self, path, value='', ephemeral=False, sequence=False,
+               makepath=False, session=None):
+        with self._lock:
+            nodes = self.nodes
+            parent_path = _parent(path)
+            if parent_path not in nodes:
+                if not makepath:
+                    raise NoNodeError(parent_path)
+                self.ensure_path(parent_path)
+            parent = nodes[parent_path]
+            if sequence:
+                path = '%s%010d' % (path, parent.sequence)
+                parent.sequence += 1
+            if path in nodes:
+                raise NodeExistsError(path)
+            nodes[path] = _Node(value, self._zxid.next(),
+                session if ephemeral else None)
+            parent.children.add(path.rsplit('/', 1)[1])
+            parent.cversion += 1
+        self._fire(self._data_watches, path, EventType.CREATED)
+        self._fire(self._child_watches, parent_path, EventType.CHILD)
+        return path
+
+    def ensure_path(self, path):
+        with self._lock:
+            current = ''
+            for part in path.strip('/').split('/'):
+                if not part:
+                    continue
+                current += '/' + part
+                if current not in self.nodes:
+                    self.create(current)
+        return True
+
+    def delete(self, path, version=-1, recursive=False):
+        with self._lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            if version != -1 and node.version != version:
+                raise BadVersionError(path)
+            if node.children:
+                if not recursive:
+                    raise NotEmptyError(path)
+                for child in sorted(node.children):
+                    self.delete(path + '/' + child, recursive=True)
+            del self.nodes[path]
+            parent = self.nodes[_parent(path)]
+            parent.children.discard(path.rsplit('/', 1)[1])
+            parent.cversion += 1
+        self._fire(self._data_watches, path, EventType.DELETED)
+        self._fire(self._child_watches, path, EventType.DELETED)
+        self._fire(self._child_watches, _parent(path), EventType.CHILD)
+        return True
+
+    def get(self, path, watch=None, session=None):
+        with self._lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            if watch is not None:
+                self._watch(self._data_watches, path, watch, session)
+            return (node.data, node.stat())
+
+    def set(self, path, data, version=-1):
+        with self._lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            if version != -1 and node.version != version:
+                raise BadVersionError(path)
+            node.data = data
+            node.version += 1
+            node.mzxid = self._zxid.next()
+            node.mtime = int(time.time() * 1000)
+            stat = node.stat()
+        self._fire(self._data_watches, path, EventType.CHANGED)
+        return stat
+
+    def exists(self, path, watch=None, session=None):
+        with self._lock:
+            node = self.nodes.get(path)
+            if watch is not None:
+                self._watch(self._data_watches, path, watch, session)
+            if node is None:
+                return None
+            return node.stat()
+
+    def get_children(self, path, watch=None, session=None):
+        with self._lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+            if watch is not None:
+                self._watch(self._child_watches, path, watch, session)
+            return sorted(node.children)
+
+
+class FakeClient(object):
+    """A client of a :py:class:`FakeZooKeeper`, compatible with the parts of
+    `kazoo.client.KazooClient` used by qdo.
+    """
+
+    def __init__(self, zookeeper):
+        self.zookeeper = zookeeper
+        self.session = None
+        self.state = KazooState.LOST
+        self._listeners = []
+
+    @property
+    def client_id(self):
+        if self.session is None:
+            return None
+        return (self.session, '')
+
+    @property
+    def connected(self):
+        return self.session is not None
+
+    def start(self, timeout=15):
+        if self.session is None:
+            self.session = self.zookeeper._connect(self)
+            self._set_state(KazooState.CONNECTED)
+
+    def stop(self):
+        """Close the session, which removes all its ephemeral nodes."""
+        if self.session is not None:
+            self.zookeeper.expire(self.session)
+
+    def _lost(self):
+        self.session = None
+        self._set_state(KazooState.LOST)
+
+    def _set_state(self, state):
+        self.state = state
+        for listener in list(self._listeners):
+            if listener(state) is True:
+                self._listeners.remove(listener)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _check(self):
+        if self.session is None:
+            raise ZookeeperStoppedError('The client is not connected')
+
+    def create(self, path, value='', acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        self._check()
+        return self.zookeeper.create(path, value, ephemeral=ephemeral,
+            sequence=sequence, makepath=makepath, session=self.session)
+
+    def ensure_path(self, path, acl=None):
+        self._check()
+        return self.zookeeper.ensure_path(path)
+
+    def delete(self, path, version=-1, recursive=False):
+        self._check()
+        return self.zookeeper.delete(path, version=version,
+            recursive=recursive)
+
+    def get(self, path, watch=None):
+        self._check()
+        return self.zookeeper.get(path, watch=watch, session=self.session)
+
+    def set(self, path, data, version=-1):
+        self._check()
+        return self.zookeeper.set(path, data, version=version)
+
+    def exists(self, path, watch=None):
+        self._check()
+        return self.zookeeper.exists(path, watch=watch,
+            session=self.session)
+
+    def get_children(self, path, watch=None):
+        self._check()
+        return self.zookeeper.get_children(path, watch=watch,
+            session=self.session)
+
+
+class FakeZooKeeperHarness(object):
+    """A drop-in replacement for `kazoo.testing.KazooTestHarness`, using a
+    :py:class:`FakeZooKeeper` instead of a real ZooKeeper cluster. It can
+    be used as a mixin for unit test classes::
+
+        class TestSomething(unittest.TestCase, FakeZooKeeperHarness):
+
+            def setUp(self):
+                self.setup_zookeeper()
+
+            def tearDown(self):
+                self.teardown_zookeeper()
+    """
+
+    zookeeper = None
+    client = None
+
+    def _get_client(self, **kwargs):
+        return self.zookeeper.client(**kwargs)
+
+    def setup_zookeeper(self):
+        self.zookeeper = FakeZooKeeper()
+        self.client = self._get_client()
+        self.client.start()
+
+    def teardown_zookeeper(self):
+        self.client.stop()
+        self.client = None
+        self.zookeeper = None
+
+    def expire_session(self, client_id=None):
+        """Expire the session of `client_id`, or of :py:attr:`client`."""
+        client_id = client_id or self.client.client_id
+        self.zookeeper.expire(client_id[0])
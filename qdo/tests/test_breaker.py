@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def _make_one(self, **kw):
+        from qdo.breaker import CircuitBreaker
+        return CircuitBreaker(**kw)
+
+    def test_min_jobs(self):
+        breaker = self._make_one(threshold=0.5, min_jobs=3)
+        self.assertFalse(breaker.record(False, now=0))
+        self.assertFalse(breaker.record(False, now=0))
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.record(False, now=0))
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow(now=1))
+
+    def test_threshold(self):
+        breaker = self._make_one(threshold=0.5, min_jobs=1)
+        for i in range(3):
+            breaker.record(True, now=0)
+        breaker.record(False, now=0)
+        self.assertEqual(breaker.failure_rate, 0.25)
+        self.assertFalse(breaker.record(False, now=0))
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.record(False, now=0))
+
+    def test_window(self):
+        breaker = self._make_one(threshold=0.6, window=10, min_jobs=2)
+        breaker.record(False, now=0)
+        breaker.record(True, now=5)
+        # the first failure drops out of the window
+        self.assertFalse(breaker.record(False, now=10))
+        self.assertEqual(breaker.total, 2)
+        self.assertEqual(breaker.failure_rate, 0.5)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.record(False, now=10))
+
+    def test_probe(self):
+        breaker = self._make_one(threshold=0.5, min_jobs=1,
+            probe_interval=30)
+        breaker.record(False, now=0)
+        self.assertEqual(breaker.next_probe(), 30)
+        self.assertFalse(breaker.allow(now=29))
+        self.assertTrue(breaker.allow(now=30))
+        self.assertEqual(breaker.state, 'half-open')
+        # only a single probe at a time
+        self.assertFalse(breaker.allow(now=30))
+        self.assertEqual(breaker.next_probe(), None)
+        # a failed probe re-opens the breaker
+        self.assertTrue(breaker.record(False, now=31))
+        self.assertEqual(breaker.next_probe(), 61)
+        self.assertTrue(breaker.allow(now=61))
+        self.assertFalse(breaker.record(True, now=62))
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow(now=62))
+
+    def test_cancel(self):
+        breaker = self._make_one(threshold=0.5, min_jobs=1,
+            probe_interval=30)
+        breaker.record(False, now=0)
+        self.assertTrue(breaker.allow(now=30))
+        breaker.cancel()
+        self.assertTrue(breaker.allow(now=40))
+
+
+class TestCircuitBreakers(unittest.TestCase):
+
+    def _make_one(self, **kw):
+        from qdo.breaker import CircuitBreakers
+        return CircuitBreakers(**kw)
+
+    def test_disabled(self):
+        breakers = self._make_one()
+        self.assertFalse(breakers.enabled)
+        for i in range(20):
+            self.assertFalse(breakers.record('a', False))
+        self.assertTrue(breakers.allow('a'))
+        self.assertEqual(breakers.as_dict(), {})
+
+    def test_queue_scope(self):
+        breakers = self._make_one(threshold=0.5, min_jobs=1,
+            probe_interval=30)
+        self.assertTrue(breakers.record('a', False, now=0))
+        self.assertFalse(breakers.allow('a', now=1))
+        self.assertTrue(breakers.allow('b', now=1))
+        self.assertEqual(breakers.next_probe(), 30)
+        self.assertEqual(sorted(breakers.as_dict().keys()), ['a', 'b'])
+
+    def test_worker_scope(self):
+        breakers = self._make_one(scope='worker', threshold=0.5,
+            min_jobs=1)
+        self.assertTrue(breakers.record('a', False, now=0))
+        self.assertFalse(breakers.allow('b', now=1))
+        self.assertEqual(breakers.as_dict().keys(), ['*'])
+
+    def test_closed(self):
+        breakers = self._make_one()
+        self.assertTrue(breakers.closed('a'))
+        breakers = self._make_one(threshold=0.5, min_jobs=1)
+        self.assertTrue(breakers.closed('a'))
+        breakers.record('a', False)
+        self.assertFalse(breakers.closed('a'))
+
+    def test_invalid_scope(self):
+        self.assertRaises(ValueError, self._make_one, scope='partition')
@@ -21,11 +21,26 @@ class TestConfig(unittest.TestCase):
         qdo_section = settings.getsection('qdo-worker')
         self.assertEqual(qdo_section['wait_interval'], 30)
         self.assertEqual(qdo_section['name'], '')
+        self.assertEqual(qdo_section['lag_interval'], 60)
+        self.assertEqual(qdo_section['metrics_interval'], 60)
+        self.assertEqual(qdo_section['profile_every'], 0)
+        self.assertEqual(qdo_section['job_timeout'], 0)
+        self.assertEqual(qdo_section['job_timeout_recycle'], False)
         queuey_section = settings.getsection('queuey')
         self.assertEqual(queuey_section['connection'],
             'http://127.0.0.1:5000/v1/queuey/')
         zk_section = settings.getsection('zookeeper')
         self.assertEqual(zk_section['connection'], config.ZOO_DEFAULT_CONN)
+        status_section = settings.getsection('status')
+        self.assertEqual(status_section['port'], None)
+        self.assertEqual(status_section['file'], None)
+        breaker_section = settings.getsection('breaker')
+        self.assertEqual(breaker_section['threshold'], 0)
+        self.assertEqual(breaker_section['scope'], 'queue')
+        partitions_section = settings.getsection('partitions')
+        self.assertEqual(partitions_section['strategy'], 'round_robin')
+        self.assertEqual(partitions_section['replicas'], 100)
+        self.assertEqual(partitions_section['discovery_interval'], 300)
 
     def test_configure(self):
         extra = {
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import unittest
+
+import ujson
+
+from qdo.errors import error_partition
+
+
+class DummyResponse(object):
+
+    def __init__(self, ok=True):
+        self.ok = ok
+        self.status_code = 200 if ok else 503
+
+
+class DummyConnection(object):
+
+    def __init__(self, fail=0):
+        self.posts = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def post(self, url='', params=None, data='', headers=None):
+        with self.lock:
+            if self.fail:
+                self.fail -= 1
+                return DummyResponse(ok=False)
+            self.posts.append((url, ujson.decode(data), headers))
+        return DummyResponse()
+
+    @property
+    def messages(self):
+        result = []
+        for url, data, headers in self.posts:
+            for m in data['messages']:
+                result.append(ujson.decode(m['body']))
+        return result
+
+
+class TestErrorPartition(unittest.TestCase):
+
+    def test_stable(self):
+        self.assertEqual(error_partition('abc-1'), error_partition('abc-1'))
+
+    def test_range(self):
+        from qdo.config import ERROR_PARTITIONS
+        partitions = set()
+        for i in range(200):
+            partitions.add(error_partition('%032x-%s' % (i * 7919, i % 5)))
+        self.assertEqual(partitions, set(range(1, ERROR_PARTITIONS + 1)))
+
+    def test_post_single(self):
+        from qdo.errors import post_failed_messages
+        conn = DummyConnection()
+        post_failed_messages(conn, [{'body': 'a', 'queue': 'b-2'}])
+        url, data, headers = conn.posts[0]
+        self.assertEqual(data['messages'][0]['partition'],
+            error_partition('b-2'))
+
+
+class TestErrorQueueWriter(unittest.TestCase):
+
+    def _make_one(self, conn=None, **kw):
+        from qdo.errors import ErrorQueueWriter
+        if conn is None:
+            conn = DummyConnection()
+        kw.setdefault('interval', 0.05)
+        writer = ErrorQueueWriter(conn, **kw)
+        writer.retry_wait = 0.01
+        return writer
+
+    def test_batches(self):
+        writer = self._make_one(batch_size=10)
+        for i in range(25):
+            writer.put({'body': str(i), 'queue': 'a-1'})
+        self.assertTrue(writer.close(timeout=5))
+        conn = writer.queuey_conn
+        self.assertEqual(len(conn.posts), 3)
+        url, data, headers = conn.posts[0]
+        self.assertEqual(url, 'qdo_error')
+        self.assertEqual(headers, {'content-type': 'application/json'})
+        self.assertEqual(data['messages'][0]['ttl'], 2592000)
+        self.assertEqual(data['messages'][0]['partition'],
+            error_partition('a-1'))
+        bodies = [m['body'] for m in conn.messages]
+        self.assertEqual(bodies, [str(i) for i in range(25)])
+        self.assertEqual(len(writer), 0)
+
+    def test_pending(self):
+        writer = self._make_one(batch_size=100, interval=10)
+        writer.put({'body': '1', 'queue': 'a-1'})
+        writer.put({'body': '2', 'queue': 'a-1'})
+        writer.put({'body': '3', 'queue': 'b-1'})
+        self.assertEqual(writer.pending('a-1'), 2)
+        self.assertEqual(writer.pending('b-1'), 1)
+        self.assertEqual(writer.pending('c-1'), 0)
+        self.assertEqual(len(writer), 3)
+        self.assertTrue(writer.close(timeout=5))
+        self.assertEqual(writer.pending('a-1'), 0)
+        self.assertEqual(writer.pending('b-1'), 0)
+
+    def test_flush_interval(self):
+        writer = self._make_one(batch_size=100)
+        writer.put({'body': '1', 'queue': 'a-1'})
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(len(writer.queuey_conn.posts), 1)
+        writer.close()
+
+    def test_capacity(self):
+        writer = self._make_one(batch_size=2, capacity=4)
+        for i in range(20):
+            writer.put({'body': str(i), 'queue': 'a-1'})
+            self.assertTrue(len(writer) <= 4)
+        self.assertTrue(writer.close(timeout=5))
+        self.assertEqual(len(writer.queuey_conn.messages), 20)
+
+    def test_retry(self):
+        from qdo import log
+        log.configure(None, debug=True)
+        conn = DummyConnection(fail=2)
+        writer = self._make_one(conn)
+        writer.put({'body': '1', 'queue': 'a-1'})
+        self.assertTrue(writer.close(timeout=5))
+        self.assertEqual(len(conn.posts), 1)
+
+    def test_close_gives_up(self):
+        from qdo import log
+        log.configure(None, debug=True)
+        conn = DummyConnection(fail=1000)
+        writer = self._make_one(conn)
+        writer.put({'body': '1', 'queue': 'a-1'})
+        self.assertFalse(writer.close(timeout=0.2))
+        # the partition stays pending, its checkpoint must not be committed
+        self.assertEqual(writer.pending('a-1'), 1)
+
+    def test_registry(self):
+        from qdo.errors import get_writer
+        from qdo.errors import register_writer
+        conn = DummyConnection()
+        self.assertEqual(get_writer(conn), None)
+        writer = self._make_one(conn)
+        register_writer(conn, writer)
+        self.assertTrue(get_writer(conn) is writer)
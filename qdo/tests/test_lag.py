@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+import uuid
+
+from qdo import log
+
+
+def _message_id(timestamp):
+    # build a uuid1 hex for the given unix timestamp
+    intervals = int(timestamp * 1e7) + 0x01b21dd213814000
+    time_low = intervals & 0xffffffff
+    time_mid = (intervals >> 32) & 0xffff
+    time_hi = (intervals >> 48) & 0x0fff
+    return uuid.UUID(fields=(time_low, time_mid, time_hi | 0x1000,
+        0x80, 0, 0)).hex
+
+
+class DummyPartition(object):
+
+    def __init__(self, name, newest=None, last_message=''):
+        self.name = name
+        self.newest = newest
+        self.last_message = last_message
+        self.queries = 0
+
+    def newest_message(self):
+        self.queries += 1
+        if self.newest is None:
+            return None
+        return {'message_id': self.newest}
+
+
+class TestMessageTime(unittest.TestCase):
+
+    def test_message_time(self):
+        from qdo.partition import message_time
+        now = time.time()
+        self.assertAlmostEqual(message_time(uuid.uuid1().hex), now, 0)
+        self.assertAlmostEqual(message_time(_message_id(1346153731.5)),
+            1346153731.5, 3)
+
+
+class GaugeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        log.configure(None, debug=True)
+        self.sender = log.get_logger().sender
+        self.sender.msgs.clear()
+
+    def _gauges(self):
+        from ujson import decode
+        result = {}
+        for msg in self.sender.msgs:
+            msg = decode(msg)
+            if msg['type'] == 'gauge':
+                result[msg['fields']['name']] = float(msg['payload'])
+        return result
+
+
+class TestLagTracker(GaugeTestCase):
+
+    def _make_one(self, interval=60):
+        from qdo.lag import LagTracker
+        return LagTracker(interval)
+
+    def test_due(self):
+        tracker = self._make_one(interval=10)
+        now = time.time()
+        self.assertFalse(tracker.due(now))
+        self.assertTrue(tracker.due(now + 10))
+        self.assertFalse(self._make_one(interval=0).due(now + 10))
+
+    def test_caught_up(self):
+        tracker = self._make_one()
+        partition = DummyPartition('a-1', newest=_message_id(100))
+        tracker.processed('a-1', _message_id(50))
+        tracker.caught_up('a-1')
+        self.assertEqual(tracker.partition_lag(partition), (0.0, 0))
+        self.assertEqual(partition.queries, 0)
+
+    def test_empty_partition(self):
+        tracker = self._make_one()
+        partition = DummyPartition('a-1')
+        self.assertEqual(tracker.partition_lag(partition), (0.0, 0))
+
+    def test_lag(self):
+        tracker = self._make_one()
+        partition = DummyPartition('a-1', newest=_message_id(200))
+        for i in range(11):
+            tracker.processed('a-1', _message_id(100 + i))
+        lag, backlog = tracker.partition_lag(partition)
+        self.assertAlmostEqual(lag, 90.0, 3)
+        # one message per second was processed
+        self.assertEqual(backlog, 90)
+
+    def test_lag_from_checkpoint(self):
+        tracker = self._make_one()
+        partition = DummyPartition('a-1', newest=_message_id(200),
+            last_message=_message_id(150))
+        lag, backlog = tracker.partition_lag(partition)
+        self.assertAlmostEqual(lag, 50.0, 3)
+        self.assertEqual(backlog, 1)
+
+    def test_checkpoint(self):
+        tracker = self._make_one()
+        self.assertEqual(tracker.checkpoint('a-1'), None)
+        tracker.processed('a-1', _message_id(100))
+        tracker.processed('a-1', _message_id(110))
+        tracker.committed('a-1', _message_id(100))
+        # the processed position runs ahead of the committed checkpoint
+        self.assertEqual(tracker.checkpoint('a-1'), _message_id(100))
+        self.assertEqual(tracker.position('a-1'), _message_id(110))
+
+    def test_report(self):
+        tracker = self._make_one()
+        p1 = DummyPartition('a-1', newest=_message_id(200))
+        p2 = DummyPartition('b-1', newest=_message_id(300))
+        tracker.processed('a-1', _message_id(190))
+        tracker.processed('b-1', _message_id(280))
+        tracker.processed('c-1', _message_id(280))
+        lags = tracker.report([p1, p2], now=1000)
+        self.assertEqual(sorted(lags.keys()), ['a-1', 'b-1'])
+        self.assertEqual(tracker.last_report, 1000)
+        gauges = self._gauges()
+        self.assertAlmostEqual(gauges['worker.lag.a-1.seconds'], 10.0, 3)
+        self.assertAlmostEqual(gauges['worker.lag.seconds'], 20.0, 3)
+        self.assertEqual(gauges['worker.lag.backlog'], 2)
+        # released partitions are forgotten
+        self.assertFalse('c-1' in tracker._state)
+
+    def test_load(self):
+        tracker = self._make_one()
+        self.assertEqual(tracker.load('a-1', 10), 0.0)
+        tracker.job_time('a-1', 1.0)
+        tracker.job_time('a-1', 3.0)
+        self.assertEqual(tracker.load('a-1', 0), 4.0)
+        self.assertEqual(tracker.load('a-1', 5), 14.0)
+        p1 = DummyPartition('a-1', newest=_message_id(200))
+        tracker.processed('a-1', _message_id(200))
+        tracker.report([p1], now=1000)
+        self.assertEqual(tracker.loads, {'a-1': 4.0})
+        # the job times are reset with each report
+        self.assertEqual(tracker.load('a-1', 5), 0.0)
+
+
+class TestLatencyTracker(GaugeTestCase):
+
+    def _make_one(self, interval=60):
+        from qdo.lag import LatencyTracker
+        return LatencyTracker(interval)
+
+    def test_report(self):
+        tracker = self._make_one()
+        now = 1000.0
+        for i in range(100):
+            tracker.record('a', {'timestamp': '%s' % (now - i / 1000.0)},
+                now=now)
+        tracker.record('b', {'timestamp': '995.0'}, now=now)
+        tracker.report(now=now)
+        gauges = self._gauges()
+        self.assertEqual(gauges['worker.latency.a.p50'], 49)
+        self.assertEqual(gauges['worker.latency.a.max'], 99)
+        self.assertEqual(gauges['worker.latency.a.count'], 100)
+        self.assertEqual(gauges['worker.latency.b.p99'], 5000)
+        # idle queues are dropped on the next report
+        tracker.record('a', {'timestamp': '999.0'}, now=now)
+        tracker.report(now=now)
+        self.assertEqual(tracker.histograms.keys(), ['a'])
+
+    def test_disabled(self):
+        tracker = self._make_one(interval=0)
+        tracker.record('a', {'timestamp': '1.0'})
+        self.assertEqual(tracker.histograms, {})
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from contextlib import contextmanager
+import threading
+import time
+import unittest
+
+
+@contextmanager
+def _context():
+    yield {}
+
+
+class TestLanes(unittest.TestCase):
+
+    def setUp(self):
+        self.lanes = None
+        self.watchdog = None
+
+    def tearDown(self):
+        if self.lanes is not None:
+            self.lanes.stop(timeout=1)
+        if self.watchdog is not None:
+            self.watchdog.stop()
+
+    def _make_one(self, count=2, job=None, watchdog=None):
+        from qdo.lanes import Lanes
+        self.lanes = Lanes(count, threshold=1.0, min_jobs=2)
+        if job is None:
+            job = lambda message, context: None
+        self.lanes.start(job, _context, watchdog)
+        return self.lanes
+
+    def _make_watchdog(self, timeout=0.05):
+        from qdo.watchdog import Watchdog
+        self.watchdog = Watchdog(timeout)
+        self.watchdog.start()
+        return self.watchdog
+
+    def _wait_unhealthy(self, watchdog, timeout=2):
+        end = time.time() + timeout
+        while watchdog.healthy and time.time() < end:
+            time.sleep(0.01)
+        return not watchdog.healthy
+
+    def test_disabled(self):
+        lanes = self._make_one(count=0)
+        for i in range(10):
+            lanes.record('a-1', 5)
+        self.assertEqual(lanes.lanes, [])
+        self.assertEqual(lanes.lane('a-1'), None)
+
+    def test_promote(self):
+        lanes = self._make_one()
+        lanes.record('a-1', 2)
+        self.assertEqual(lanes.lane('a-1'), None)
+        lanes.record('a-1', 2)
+        self.assertTrue(lanes.lane('a-1') is lanes.lanes[0])
+        lanes.record('b-1', 0.1)
+        lanes.record('b-1', 0.1)
+        self.assertEqual(lanes.lane('b-1'), None)
+        lanes.record('c-1', 3)
+        lanes.record('c-1', 3)
+        # spread across the lanes
+        self.assertTrue(lanes.lane('c-1') is lanes.lanes[1])
+
+    def test_demote(self):
+        lanes = self._make_one()
+        lanes.record('a-1', 1)
+        lanes.record('a-1', 1)
+        self.assertFalse(lanes.lane('a-1') is None)
+        # needs to drop below half the threshold
+        for i in range(3):
+            lanes.record('a-1', 0)
+        self.assertFalse(lanes.lane('a-1') is None)
+        lanes.record('a-1', 0)
+        self.assertEqual(lanes.lane('a-1'), None)
+        self.assertEqual(lanes.lanes[0].partitions, set())
+
+    def test_submit(self):
+        calls = []
+
+        def job(message, context):
+            calls.append(message['body'])
+            if message['body'] == 'fail':
+                raise ValueError
+
+        lanes = self._make_one(job=job)
+        lanes.record('a-1', 2)
+        lanes.record('a-1', 2)
+        lanes.submit('a-1', {'body': 'fail'})
+        self.assertTrue(lanes.busy('a-1'))
+        self.assertEqual(len(lanes), 1)
+        self.assertTrue(lanes.wait(1))
+        result = lanes.completed()
+        self.assertEqual(len(result), 1)
+        name, message, exc, seconds = result[0]
+        self.assertEqual(name, 'a-1')
+        self.assertTrue(isinstance(exc, ValueError))
+        self.assertFalse(lanes.busy('a-1'))
+        self.assertEqual(calls, ['fail'])
+
+    def test_hung_lane(self):
+        watchdog = self._make_watchdog()
+        release = threading.Event()
+
+        def job(message, context):
+            release.wait(5)
+
+        lanes = self._make_one(job=job, watchdog=watchdog)
+        lanes.record('a-1', 2)
+        lanes.record('a-1', 2)
+        lanes.submit('a-1', {'body': 'a'})
+        # the lane job can't be interrupted, but is detected
+        self.assertTrue(self._wait_unhealthy(watchdog))
+        release.set()
+        self.assertTrue(lanes.wait(1))
+        self.assertEqual(lanes.completed()[0][2], None)
+
+    def test_pool(self):
+        from qdo.lanes import Lanes
+        calls = []
+        self.lanes = lanes = Lanes(pool_size=2)
+        lanes.start(lambda message, context: calls.append(message), _context)
+        self.assertTrue(lanes.enabled)
+        for i in range(4):
+            lanes.submit('a-1', i)
+        while len(lanes):
+            lanes.wait(1)
+            lanes.completed()
+        self.assertEqual(sorted(calls), [0, 1, 2, 3])
+        self.assertEqual(lanes.lane('a-1'), None)
+
+    def test_hung_pool(self):
+        from qdo.lanes import Lanes
+        watchdog = self._make_watchdog()
+        release = threading.Event()
+
+        def job(message, context):
+            if message == 'hang':
+                release.wait(5)
+
+        self.lanes = lanes = Lanes(pool_size=2)
+        lanes.start(job, _context, watchdog)
+        lanes.submit('a-1', 'hang')
+        lanes.submit('a-1', 'ok')
+        # the other thread keeps going, while the hung job is detected
+        self.assertTrue(lanes.wait(1))
+        self.assertEqual(len(lanes.completed()), 1)
+        self.assertTrue(lanes.busy('a-1'))
+        self.assertTrue(self._wait_unhealthy(watchdog))
+        release.set()
+        self.assertTrue(lanes.wait(1))
+        self.assertEqual(len(lanes.completed()), 1)
+        self.assertFalse(lanes.busy('a-1'))
+
+    def test_discard(self):
+        lanes = self._make_one()
+        lanes.record('a-1', 2)
+        lanes.record('a-1', 2)
+        lanes.submit('a-1', {'body': 'a'})
+        lanes.discard(['a-1'])
+        self.assertEqual(lanes.lane('a-1'), None)
+        self.assertTrue(lanes.wait(1))
+        self.assertEqual(lanes.completed(), [])
+        self.assertFalse(lanes.busy('a-1'))
+        self.assertEqual(lanes.discarded, set())
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import threading
+import unittest
+
+
+class TestHistogram(unittest.TestCase):
+
+    def _make_one(self, **kw):
+        from qdo.log import Histogram
+        return Histogram(**kw)
+
+    def test_empty(self):
+        histogram = self._make_one()
+        self.assertEqual(histogram.count, 0)
+        self.assertEqual(histogram.percentile(50), 0)
+
+    def test_exact_small_values(self):
+        histogram = self._make_one()
+        for i in range(1, 11):
+            histogram.record(i)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(90), 9)
+        self.assertEqual(histogram.percentile(100), 10)
+        self.assertEqual(histogram.max, 10)
+        self.assertEqual(histogram.total, 55)
+
+    def test_relative_error(self):
+        histogram = self._make_one(precision=5)
+        rng = random.Random(42)
+        values = [rng.randint(0, 10 ** 6) for i in range(5000)]
+        for v in values:
+            histogram.record(v)
+        values.sort()
+        for percent in (50, 90, 99):
+            expected = values[int(len(values) * percent / 100.0) - 1]
+            result = histogram.percentile(percent)
+            self.assertTrue(abs(result - expected) <= expected / 16.0 + 1,
+                (percent, result, expected))
+        self.assertEqual(histogram.percentile(100), values[-1])
+
+    def test_fixed_memory(self):
+        histogram = self._make_one(precision=4, max_exponent=10)
+        size = len(histogram._counts)
+        histogram.record(-5)
+        histogram.record(10 ** 12)
+        self.assertEqual(len(histogram._counts), size)
+        self.assertEqual(histogram.percentile(50), 0)
+        self.assertEqual(histogram.percentile(100), 10 ** 12)
+
+    def test_reset(self):
+        histogram = self._make_one()
+        histogram.record(100)
+        histogram.reset()
+        self.assertEqual(histogram.count, 0)
+        self.assertEqual(histogram.max, 0)
+        self.assertEqual(sum(histogram._counts), 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        from qdo import log
+        log.configure(None, debug=True)
+        self.sender = log.get_logger().sender
+        self.sender.msgs.clear()
+
+    def _make_one(self, interval=60):
+        from qdo.log import make_metrics
+        return make_metrics(interval)
+
+    def _messages(self):
+        from ujson import decode
+        result = {}
+        for msg in self.sender.msgs:
+            msg = decode(msg)
+            result[(msg['type'], msg['fields']['name'])] = msg['payload']
+        return result
+
+    def test_get_logger_cached(self):
+        from qdo.log import get_logger
+        self.assertTrue(get_logger() is get_logger())
+
+    def test_disabled(self):
+        from qdo.log import NullMetrics
+        metrics = self._make_one(interval=0)
+        self.assertTrue(isinstance(metrics, NullMetrics))
+        metrics.incr('foo')
+        with metrics.timer('bar'):
+            pass
+        self.assertFalse(metrics.due())
+        metrics.flush()
+        self.assertEqual(len(self.sender.msgs), 0)
+
+    def test_due(self):
+        metrics = self._make_one(interval=10)
+        now = metrics.last_flush
+        self.assertFalse(metrics.due(now + 5))
+        self.assertTrue(metrics.due(now + 10))
+
+    def test_flush(self):
+        metrics = self._make_one()
+        for i in range(5):
+            metrics.incr('worker.foo')
+        metrics.incr('worker.bar', 3)
+        for i in range(1, 101):
+            metrics.timing('worker.job_time', i)
+        with metrics.timer('worker.other'):
+            pass
+        # nothing is sent before a flush
+        self.assertEqual(len(self.sender.msgs), 0)
+        metrics.flush(now=1000)
+        self.assertEqual(metrics.last_flush, 1000)
+        messages = self._messages()
+        self.assertEqual(messages[('counter', 'worker.foo')], '5')
+        self.assertEqual(messages[('counter', 'worker.bar')], '3')
+        self.assertEqual(messages[('gauge', 'worker.job_time.count')], '100')
+        self.assertEqual(messages[('gauge', 'worker.job_time.mean')], '50')
+        # 90 is counted in a bucket of width two
+        self.assertEqual(messages[('gauge', 'worker.job_time.p90')], '91')
+        self.assertEqual(messages[('gauge', 'worker.job_time.max')], '100')
+        self.assertEqual(messages[('gauge', 'worker.other.count')], '1')
+        # aggregates are reset after a flush
+        self.sender.msgs.clear()
+        metrics.flush()
+        self.assertEqual(len(self.sender.msgs), 0)
+        self.assertEqual(metrics.timers, {})
+
+    def test_concurrent_flush(self):
+        from ujson import decode
+        metrics = self._make_one()
+
+        def record():
+            for i in range(1000):
+                metrics.timing('worker.job_time', i)
+
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(5):
+            metrics.flush()
+        for thread in threads:
+            thread.join()
+        metrics.flush()
+        counts = [int(decode(msg)['payload']) for msg in self.sender.msgs
+            if decode(msg)['fields']['name'] == 'worker.job_time.count']
+        # every recorded time is sent exactly once
+        self.assertEqual(sum(counts), 4000)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os.path
+import shutil
+import socket
+import tempfile
+import unittest
+import urllib2
+
+import ujson
+
+
+class DummyBuffer(list):
+
+    capacity = 10
+
+
+class DummyWorker(object):
+
+    def __init__(self):
+        from qdo.breaker import CircuitBreakers
+        from qdo.lag import LagTracker
+        from qdo.lanes import Lanes
+        from qdo.monitor import WorkerStats
+        from qdo.quarantine import Quarantine
+        from qdo.watchdog import Watchdog
+        from qdo.worker import StaticPartitioner
+        self.name = 'dummy'
+        self.shutdown = False
+        self.draining = False
+        self.partitioner = StaticPartitioner('/worker', set=['a-1', 'b-1'])
+        self.partitioner.wait_for_acquire()
+        self.lag = LagTracker()
+        self.stats = WorkerStats()
+        self.buffers = {'errors': DummyBuffer([1, 2])}
+        self.breakers = CircuitBreakers(threshold=0.5, min_jobs=1)
+        self.breakers.record('a', False, now=10)
+        self.quarantine = Quarantine(max_failures=1)
+        self.watchdog = Watchdog()
+        self.lanes = Lanes()
+        self.quarantine.record_failure({'message_id': 'abc'})
+
+    def drain(self):
+        self.draining = True
+
+
+class TestWorkerStats(unittest.TestCase):
+
+    def _make_one(self, window=60):
+        from qdo.monitor import WorkerStats
+        return WorkerStats(window)
+
+    def test_throughput(self):
+        stats = self._make_one(window=10)
+        start = stats.started
+        for i in range(50):
+            stats.record_processed(now=start + 1)
+        self.assertEqual(stats.throughput, 0.0)
+        stats.record_processed(now=start + 10)
+        self.assertAlmostEqual(stats.throughput, 5.1, 3)
+        self.assertEqual(stats.processed, 51)
+        self.assertAlmostEqual(
+            stats.as_dict(now=start + 15)['throughput'], 5.1, 3)
+        # the rate drops while no more messages are processed
+        self.assertEqual(stats.as_dict(now=start + 20)['throughput'], 0.0)
+
+    def test_failure(self):
+        stats = self._make_one()
+        stats.record_failure('a-1', 'abc', ValueError('broken'))
+        self.assertEqual(stats.failed, 1)
+        self.assertEqual(stats.last_error['partition'], 'a-1')
+        self.assertEqual(stats.last_error['error'], "ValueError('broken',)")
+
+    def test_idle_fraction(self):
+        stats = self._make_one()
+        stats.record_idle(5)
+        result = stats.as_dict(now=stats.started + 20)
+        self.assertAlmostEqual(result['idle_fraction'], 0.25, 3)
+        self.assertEqual(result['uptime'], 20)
+
+
+class TestStatusServer(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = DummyWorker()
+        self.worker.lag.processed('a-1', 'a8f70ab3cb7411e19621b88d120c81de')
+        self.worker.lag.processed('a-1', 'b8f70ab3cb7411e19621b88d120c81de')
+        self.worker.lag.committed('a-1', 'a8f70ab3cb7411e19621b88d120c81de')
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+
+    def _check_status(self, status):
+        self.assertEqual(status['name'], 'dummy')
+        self.assertEqual(status['healthy'], True)
+        self.assertEqual(status['draining'], False)
+        self.assertEqual(sorted(status['partitions'].keys()), ['a-1', 'b-1'])
+        self.assertEqual(status['partitions']['a-1']['checkpoint'],
+            'a8f70ab3cb7411e19621b88d120c81de')
+        self.assertEqual(status['partitions']['a-1']['position'],
+            'b8f70ab3cb7411e19621b88d120c81de')
+        self.assertEqual(status['partitions']['b-1']['checkpoint'], None)
+        self.assertEqual(status['partitions']['b-1']['slow'], False)
+        self.assertEqual(status['buffers'],
+            {'errors': {'size': 2, 'capacity': 10}})
+        self.assertEqual(status['breakers'], {'a': {
+            'state': 'open', 'failure_rate': 0.0, 'next_probe': 40}})
+        self.assertEqual(status['quarantine'],
+            {'tracked': 1, 'quarantined': 0})
+        self.assertEqual(status['processed'], 0)
+
+    def test_tcp(self):
+        from qdo.monitor import StatusServer
+        self.server = StatusServer(self.worker, port='127.0.0.1:0')
+        self.server.start()
+        host, port = self.server.address
+        response = urllib2.urlopen('http://%s:%s/status' % (host, port))
+        self.assertEqual(response.headers['Content-Type'],
+            'application/json')
+        self._check_status(ujson.decode(response.read()))
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+            'http://%s:%s/other' % (host, port))
+
+    def test_drain(self):
+        from qdo.monitor import StatusServer
+        self.server = StatusServer(self.worker, port='127.0.0.1:0')
+        self.server.start()
+        host, port = self.server.address
+        url = 'http://%s:%s/drain' % (host, port)
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url)
+        self.assertFalse(self.worker.draining)
+        response = urllib2.urlopen(url, data='')
+        self.assertEqual(response.code, 202)
+        self.assertTrue(self.worker.draining)
+
+    def test_unix_socket(self):
+        from qdo.monitor import StatusServer
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'qdo.sock')
+            self.server = StatusServer(self.worker, file=path)
+            self.server.start()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.sendall('GET /status HTTP/1.0\r\n\r\n')
+            data = ''
+            while 1:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            sock.close()
+            headers, body = data.split('\r\n\r\n', 1)
+            self.assertTrue(headers.startswith('HTTP/1.0 200'))
+            self._check_status(ujson.decode(body))
+            self.server.stop()
+            self.server = None
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tempdir)
@@ -3,6 +3,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import unittest
+
 from qdo.config import STATUS_QUEUE
 from qdo.tests.base import BaseTestCase
 
@@ -45,3 +47,42 @@ class TestPartition(BaseTestCase):
         partition = self._make_one()
         partition.last_message = self.dummy_uuid.encode('utf-8')
         self.assertEqual(partition.last_message, self.dummy_uuid)
+
+
+class TestCheckpointTracker(unittest.TestCase):
+
+    def _make_one(self, *message_ids):
+        from qdo.partition import CheckpointTracker
+        tracker = CheckpointTracker()
+        for message_id in message_ids:
+            tracker.dispatch(message_id)
+        return tracker
+
+    def test_in_order(self):
+        tracker = self._make_one('a', 'b')
+        self.assertEqual(tracker.complete('a'), 'a')
+        self.assertEqual(tracker.complete('b'), 'b')
+        self.assertEqual(tracker.watermark, 'b')
+        self.assertEqual(len(tracker), 0)
+
+    def test_out_of_order(self):
+        tracker = self._make_one('a', 'b', 'c', 'd')
+        self.assertEqual(tracker.complete('c'), None)
+        self.assertEqual(tracker.complete('b'), None)
+        self.assertEqual(tracker.watermark, None)
+        self.assertEqual(tracker.in_flight, 2)
+        self.assertEqual(tracker.complete('a'), 'c')
+        self.assertEqual(len(tracker), 1)
+        self.assertEqual(tracker.in_flight, 1)
+        tracker.dispatch('e')
+        self.assertEqual(tracker.complete('e'), None)
+        self.assertEqual(tracker.complete('d'), 'e')
+        self.assertEqual(tracker.in_flight, 0)
+
+    def test_unknown(self):
+        tracker = self._make_one('a')
+        self.assertEqual(tracker.complete('x'), None)
+        self.assertEqual(tracker.in_flight, 1)
+        tracker.reset()
+        self.assertEqual(tracker.complete('a'), None)
+        self.assertEqual(len(tracker), 0)
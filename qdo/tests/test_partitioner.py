@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+
+from kazoo.testing import KazooTestHarness
+
+from qdo.testing import FakeZooKeeperHarness
+
+
+class TestRoundRobin(unittest.TestCase):
+
+    def _call(self, identifier, members, partitions):
+        from qdo.partitioner import round_robin
+        return round_robin(identifier, members, partitions)
+
+    def test_single(self):
+        self.assertEqual(self._call('a', ['a'], ['b-1', 'a-1']),
+            ['a-1', 'b-1'])
+
+    def test_members(self):
+        partitions = ['a-%s' % i for i in range(1, 6)]
+        self.assertEqual(self._call('w1', ['w2', 'w1'], partitions),
+            ['a-1', 'a-3', 'a-5'])
+        self.assertEqual(self._call('w2', ['w2', 'w1'], partitions),
+            ['a-2', 'a-4'])
+
+    def test_not_a_member(self):
+        self.assertEqual(self._call('w3', ['w1', 'w2'], ['a-1']), [])
+
+    def test_capacities(self):
+        from qdo.partitioner import round_robin
+        partitions = ['a-%s' % i for i in range(1, 7)]
+        capacities = {'w1': (1, 0), 'w2': (2, 0)}
+        self.assertEqual(round_robin('w1', ['w1', 'w2'], partitions,
+            capacities=capacities), ['a-2', 'a-5'])
+        self.assertEqual(round_robin('w2', ['w1', 'w2'], partitions,
+            capacities=capacities), ['a-1', 'a-3', 'a-4', 'a-6'])
+
+    def test_max_partitions(self):
+        from qdo.partitioner import round_robin
+        partitions = ['a-%s' % i for i in range(1, 7)]
+        capacities = {'w1': (1, 1), 'w2': (1, 2)}
+        self.assertEqual(round_robin('w1', ['w1', 'w2'], partitions,
+            capacities=capacities), ['a-1'])
+        self.assertEqual(round_robin('w2', ['w1', 'w2'], partitions,
+            capacities=capacities), ['a-2', 'a-3'])
+
+
+class TestConsistentHash(unittest.TestCase):
+
+    def _call(self, identifier, members, partitions):
+        from qdo.partitioner import consistent_hash
+        return consistent_hash(identifier, members, partitions)
+
+    def _assign(self, members, partitions):
+        result = {}
+        for member in members:
+            for partition in self._call(member, members, partitions):
+                self.assertFalse(partition in result)
+                result[partition] = member
+        return result
+
+    def test_ring(self):
+        from qdo.partitioner import HashRing
+        ring = HashRing(['w1', 'w2'], replicas=10)
+        self.assertEqual(len(ring), 20)
+        self.assertTrue(ring.owner('a-1') in ('w1', 'w2'))
+        self.assertEqual(ring.owner('a-1'), ring.owner('a-1'))
+        self.assertEqual(HashRing([]).owner('a-1'), None)
+
+    def test_not_a_member(self):
+        self.assertEqual(self._call('w3', ['w1', 'w2'], ['a-1']), [])
+
+    def test_complete(self):
+        partitions = ['q%s-%s' % (q, i) for q in range(10) for i in range(10)]
+        members = ['w%s' % i for i in range(4)]
+        assignment = self._assign(members, partitions)
+        self.assertEqual(sorted(assignment), sorted(partitions))
+        counts = {}
+        for member in assignment.values():
+            counts[member] = counts.get(member, 0) + 1
+        # roughly balanced
+        self.assertEqual(len(counts), 4)
+        self.assertTrue(min(counts.values()) >= 10, counts)
+
+    def test_minimal_movement(self):
+        partitions = ['q%s-%s' % (q, i) for q in range(10) for i in range(10)]
+        members = ['w%s' % i for i in range(4)]
+        before = self._assign(members, partitions)
+        after = self._assign(members + ['w4'], partitions)
+        moved = [p for p in partitions if before[p] != after[p]]
+        # only partitions moving to the new member change their owner
+        self.assertEqual(set([after[p] for p in moved]), set(['w4']))
+        self.assertTrue(len(moved) < 40, len(moved))
+        # removing it again restores the original assignment
+        self.assertEqual(self._assign(members, partitions), before)
+
+    def test_capacities(self):
+        from qdo.partitioner import consistent_hash
+        from qdo.partitioner import HashRing
+        capacities = {'w1': (1.0, 0), 'w2': (3.0, 0)}
+        self.assertEqual(len(HashRing(['w1', 'w2'], replicas=10,
+            capacities=capacities)), 40)
+        partitions = ['q%s-%s' % (q, i) for q in range(10) for i in range(10)]
+        small = consistent_hash('w1', ['w1', 'w2'], partitions,
+            capacities=capacities)
+        large = consistent_hash('w2', ['w1', 'w2'], partitions,
+            capacities=capacities)
+        self.assertEqual(len(small) + len(large), 100)
+        self.assertTrue(len(large) > 2 * len(small), (len(small), len(large)))
+
+    def test_max_partitions(self):
+        from qdo.partitioner import consistent_hash
+        partitions = ['q%s-%s' % (q, i) for q in range(10) for i in range(10)]
+        capacities = {'w1': (1.0, 10), 'w2': (1.0, 0)}
+        first = consistent_hash('w1', ['w1', 'w2'], partitions,
+            capacities=capacities)
+        second = consistent_hash('w2', ['w1', 'w2'], partitions,
+            capacities=capacities)
+        self.assertEqual(len(first), 10)
+        self.assertEqual(len(second), 90)
+
+
+class TestBalance(unittest.TestCase):
+
+    def _call(self, members, partitions, weights, capacities=None):
+        from qdo.partitioner import balance
+        return balance(members, partitions, weights, capacities)
+
+    def test_no_members(self):
+        self.assertEqual(self._call([], ['a-1'], {}), {})
+
+    def test_without_weights(self):
+        result = self._call(['w2', 'w1'], ['a-1', 'a-2', 'a-3'], {})
+        self.assertEqual(result, {'w1': ['a-1', 'a-3'], 'w2': ['a-2']})
+
+    def test_skewed(self):
+        weights = {'a-1': 100.0, 'a-2': 10.0, 'a-3': 10.0, 'b-1': 80.0}
+        partitions = ['a-1', 'a-2', 'a-3', 'b-1', 'b-2', 'b-3']
+        result = self._call(['w1', 'w2'], partitions, weights)
+        # equal weight, the idle partitions fill up the partition count
+        self.assertEqual(result['w1'], ['a-1', 'b-2', 'b-3'])
+        self.assertEqual(result['w2'], ['a-2', 'a-3', 'b-1'])
+
+    def test_capacities(self):
+        weights = {'a-1': 30.0, 'a-2': 20.0, 'a-3': 10.0}
+        result = self._call(['w1', 'w2'], ['a-1', 'a-2', 'a-3'], weights,
+            capacities={'w1': (1.0, 0), 'w2': (5.0, 0)})
+        self.assertEqual(result, {'w1': ['a-3'], 'w2': ['a-1', 'a-2']})
+        result = self._call(['w1', 'w2'], ['a-1', 'a-2', 'a-3'], weights,
+            capacities={'w1': (1.0, 1), 'w2': (5.0, 0)})
+        self.assertEqual(result, {'w1': ['a-3'], 'w2': ['a-1', 'a-2']})
+
+    def test_imbalance(self):
+        from qdo.partitioner import imbalance
+        weights = {'a-1': 30.0, 'a-2': 10.0}
+        self.assertEqual(imbalance({'w1': ['a-1'], 'w2': ['a-2']}, weights),
+            1.5)
+        self.assertEqual(imbalance({'w1': ['b-1'], 'w2': []}, weights), 1.0)
+        self.assertEqual(imbalance({'w1': ['a-1'], 'w2': ['a-2']}, weights,
+            capacities={'w1': (3.0, 0), 'w2': (1.0, 0)}), 1.0)
+
+
+class TestStaticPartitioner(unittest.TestCase):
+
+    def test_states(self):
+        from qdo.partitioner import StaticPartitioner
+        partitioner = StaticPartitioner('/worker', set=('a-1', 'a-2'))
+        self.assertTrue(partitioner.allocating)
+        partitioner.wait_for_acquire()
+        partitioner.poll()
+        self.assertTrue(partitioner.acquired)
+        self.assertEqual(list(partitioner), ['a-1', 'a-2'])
+        partitioner.finish()
+        self.assertTrue(partitioner.failed)
+
+    def test_drain(self):
+        from qdo.partitioner import StaticPartitioner
+        partitioner = StaticPartitioner('/worker', set=('a-1', ))
+        partitioner.wait_for_acquire()
+        partitioner.drain()
+        self.assertTrue(partitioner.failed)
+
+
+class TestIncrementalPartitioner(unittest.TestCase, FakeZooKeeperHarness):
+
+    def setUp(self):
+        self.setup_zookeeper()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.stop()
+        self.teardown_zookeeper()
+
+    def _make_one(self, identifier, partitions, weighted=False,
+                  grace_period=0, lease_timeout=0, capacity=1.0,
+                  takeover=False):
+        from qdo.partitioner import IncrementalPartitioner
+        from qdo.partitioner import LoadBalancer
+        client = self._get_client()
+        client.start()
+        self.clients.append(client)
+        balancer = None
+        if weighted:
+            balancer = LoadBalancer(client, '/worker', identifier, interval=0)
+        return IncrementalPartitioner(client, '/worker', set=partitions,
+            identifier=identifier, time_boundary=0, balancer=balancer,
+            grace_period=grace_period, lease_timeout=lease_timeout,
+            capacity=capacity, takeover=takeover)
+
+    def test_acquire(self):
+        partitioner = self._make_one('w1', ('a-1', 'a-2'))
+        partitioner.wait_for_acquire(5)
+        self.assertTrue(partitioner.acquired)
+        self.assertEqual(sorted(partitioner), ['a-1', 'a-2'])
+        self.assertTrue(partitioner.holds('a-1'))
+        self.assertFalse(partitioner.holds('a-3'))
+        token = partitioner.token('a-1')
+        self.assertTrue(token is not None)
+        self.assertEqual(sorted(self.client.get_children(
+            '/worker/owners')), ['a-1', 'a-2'])
+        partitioner.finish()
+        self.assertTrue(partitioner.failed)
+        self.assertEqual(self.client.get_children('/worker/owners'), [])
+        self.assertEqual(self.client.get_children('/worker/party'), [])
+
+    def test_rebalance(self):
+        partitions = ('a-1', 'a-2', 'a-3', 'a-4')
+        first = self._make_one('w1', partitions)
+        first.wait_for_acquire(5)
+        self.assertEqual(len(list(first)), 4)
+        second = self._make_one('w2', partitions)
+        second.wait_for_acquire(5)
+        # the new member waits for the old owner
+        self.assertEqual(list(second), [])
+        first._watch_members()
+        first.poll()
+        self.assertTrue(first.release)
+        self.assertEqual(first.releasing, ['a-2', 'a-4'])
+        # the remaining partitions are still owned during the release
+        self.assertEqual(list(first), list(partitions))
+        first.release_set()
+        self.assertTrue(first.acquired)
+        self.assertEqual(list(first), ['a-1', 'a-3'])
+        second.poll(now=second._next_retry)
+        self.assertEqual(sorted(second), ['a-2', 'a-4'])
+        # the first member leaves, the second takes over everything
+        first.finish()
+        second._watch_members()
+        second.poll()
+        self.assertEqual(sorted(second), list(partitions))
+
+    def test_weighted(self):
+        partitions = ('a-1', 'a-2', 'a-3')
+        first = self._make_one('w1', partitions, weighted=True)
+        first.wait_for_acquire(5)
+        self.assertEqual(sorted(first), list(partitions))
+        first._balancer.publish({'a-1': 100.0, 'a-2': 1.0, 'a-3': 1.0})
+        second = self._make_one('w2', partitions, weighted=True)
+        # the leader publishes a new assignment for both members
+        first._watch_members()
+        first.poll()
+        self.assertTrue(first.release)
+        self.assertEqual(first.releasing, ['a-2', 'a-3'])
+        first.release_set()
+        self.assertEqual(list(first), ['a-1'])
+        second.wait_for_acquire(5)
+        self.assertEqual(sorted(second), ['a-2', 'a-3'])
+
+    def test_grace_period(self):
+        partitions = ('a-1', 'a-2', 'a-3', 'a-4')
+        first = self._make_one('w1', partitions, grace_period=60)
+        second = self._make_one('w2', partitions, grace_period=60)
+        first._watch_members()
+        first.wait_for_acquire(5)
+        second.wait_for_acquire(5)
+        self.assertEqual(list(first), ['a-1', 'a-3'])
+        self.assertEqual(list(second), ['a-2', 'a-4'])
+        second.finish()
+        first._watch_members()
+        now = time.time()
+        first.poll(now=now)
+        # the partitions of the second member stay unassigned
+        self.assertTrue(first.acquired)
+        self.assertEqual(list(first), ['a-1', 'a-3'])
+        # and are taken over once the grace period is over
+        first.poll(now=now + 61)
+        first.poll(now=now + 62)
+        self.assertEqual(sorted(first), list(partitions))
+
+    def test_restart(self):
+        partitions = ('a-1', 'a-2')
+        first = self._make_one('w1', partitions)
+        first.wait_for_acquire(5)
+        # a restarted member with the same identity takes over the nodes
+        # of its previous session, which hasn't expired yet
+        restarted = self._make_one('w1', partitions, takeover=True)
+        restarted.wait_for_acquire(5)
+        self.assertEqual(sorted(restarted), list(partitions))
+        data, stat = self.client.get('/worker/owners/a-1')
+        self.assertEqual(stat.ephemeralOwner,
+            self.clients[-1].client_id[0])
+
+    def test_identifier_in_use(self):
+        partitions = ('a-1', 'a-2')
+        first = self._make_one('w1', partitions)
+        first.wait_for_acquire(5)
+        # without takeover, a second member can't steal the identity
+        self.assertRaises(RuntimeError, self._make_one, 'w1', partitions)
+        data, stat = self.client.get('/worker/party/w1')
+        self.assertEqual(stat.ephemeralOwner, self.clients[0].client_id[0])
+        self.assertEqual(sorted(first), list(partitions))
+
+    def test_tokens(self):
+        first = self._make_one('w1', ('a-1', ))
+        first.wait_for_acquire(5)
+        token = first.token('a-1')
+        first.finish()
+        second = self._make_one('w2', ('a-1', ))
+        second.wait_for_acquire(5)
+        self.assertTrue(second.token('a-1') > token)
+
+    def test_lease(self):
+        partitions = ('a-1', 'a-2')
+        first = self._make_one('w1', partitions, lease_timeout=3)
+        second = self._make_one('w2', partitions, lease_timeout=3)
+        first._watch_members()
+        now = time.time()
+        first.poll(now=now)
+        second.poll(now=now)
+        self.assertEqual(list(first), ['a-1'])
+        self.assertEqual(list(second), ['a-2'])
+        # the first member stalls, the second one takes over
+        second.poll(now=now + 1)
+        second.poll(now=now + 4)
+        second.poll(now=now + 4)
+        self.assertEqual(sorted(second), list(partitions))
+        self.assertTrue(second.token('a-1') > 0)
+        # the first member notices, that it lost its lease
+        self.assertFalse(first.holds('a-1', now=now + 4))
+        first.poll(now=now + 4)
+        self.assertTrue(first.release)
+        self.assertEqual(first.releasing, ['a-1'])
+        first.release_set()
+        self.assertEqual(list(first), [])
+        # the node of the new owner is kept
+        data, stat = self.client.get('/worker/owners/a-1')
+        self.assertEqual(data, 'w2')
+
+    def test_drain(self):
+        partitions = ('a-1', 'a-2')
+        first = self._make_one('w1', partitions, grace_period=60)
+        first.wait_for_acquire(5)
+        second = self._make_one('w2', partitions, grace_period=60)
+        second.wait_for_acquire(5)
+        self.assertEqual(list(second), [])
+        first.drain()
+        self.assertTrue(first.draining)
+        # the draining member leaves without a grace period
+        second._watch_members()
+        first.poll()
+        self.assertTrue(first.release)
+        self.assertEqual(first.releasing, ['a-1'])
+        first.release_set()
+        self.assertEqual(list(first), ['a-2'])
+        # the next partition is released once the first one is picked up
+        first.poll()
+        self.assertFalse(first.release)
+        second.poll(now=second._next_retry)
+        self.assertEqual(list(second), ['a-1'])
+        first.poll(now=first._next_retry)
+        self.assertEqual(first.releasing, ['a-2'])
+        first.release_set()
+        second.poll(now=second._next_retry)
+        first.poll(now=first._next_retry)
+        self.assertTrue(first.failed)
+        self.assertEqual(sorted(second), list(partitions))
+
+    def test_capacity(self):
+        partitions = ('a-1', 'a-2', 'a-3', 'a-4')
+        small = self._make_one('w1', partitions)
+        large = self._make_one('w2', partitions, capacity=3.0)
+        small._watch_members()
+        small.wait_for_acquire(5)
+        large.wait_for_acquire(5)
+        self.assertEqual(small._capacities['w2'], (3.0, 0))
+        self.assertEqual(list(small), ['a-3'])
+        self.assertEqual(sorted(large), ['a-1', 'a-2', 'a-4'])
+        self.assertRaises(ValueError, self._make_one, 'w3', partitions,
+            capacity=0)
+
+
+    def test_update_set(self):
+        first = self._make_one('w1', ('a-1', 'a-2'))
+        second = self._make_one('w2', ('a-1', 'a-2'))
+        first._watch_members()
+        first.wait_for_acquire(5)
+        second.wait_for_acquire(5)
+        self.assertEqual(list(first), ['a-1'])
+        self.assertEqual(list(second), ['a-2'])
+        # a new queue got discovered
+        partitions = ('a-1', 'a-2', 'b-1', 'b-2')
+        first.update_set(partitions)
+        second.update_set(partitions)
+        first.poll()
+        second.poll()
+        self.assertEqual(list(first), ['a-1', 'b-1'])
+        self.assertEqual(list(second), ['a-2', 'b-2'])
+        # a queue got deleted
+        first.update_set(('b-1', 'b-2'))
+        first.poll()
+        self.assertTrue(first.release)
+        self.assertEqual(first.releasing, ['a-1'])
+        first.release_set()
+        self.assertEqual(list(first), ['b-1'])
+
+
+class TestCoordinator(unittest.TestCase, FakeZooKeeperHarness):
+
+    def setUp(self):
+        self.setup_zookeeper()
+        self.clients = []
+        self.discoveries = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.stop()
+        self.teardown_zookeeper()
+
+    def _make_one(self, identifier, partitions=('a-1', 'a-2')):
+        from qdo.partitioner import Coordinator
+        client = self._get_client()
+        client.start()
+        self.clients.append(client)
+
+        def discover():
+            self.discoveries.append(identifier)
+            return list(partitions)
+
+        return Coordinator(client, '/worker', identifier, discover,
+            interval=60)
+
+    def test_single_discovery(self):
+        first = self._make_one('w1')
+        second = self._make_one('w2')
+        self.assertTrue(first.leader)
+        self.assertFalse(second.leader)
+        self.assertEqual(second.partitions, None)
+        self.assertTrue(first.poll(now=0))
+        self.assertEqual(first.partitions, ['a-1', 'a-2'])
+        self.assertTrue(second.poll(now=0))
+        self.assertEqual(second.wait(5), ['a-1', 'a-2'])
+        self.assertFalse(second.poll(now=0))
+        # only the leader lists the queues, once per interval
+        self.assertFalse(first.poll(now=30))
+        self.assertEqual(self.discoveries, ['w1'])
+        first.poll(now=60)
+        self.assertEqual(self.discoveries, ['w1', 'w1'])
+        data, stat = self.client.get('/worker/coordinator')
+        self.assertEqual(data, 'w1')
+
+    def test_new_partitions(self):
+        first = self._make_one('w1')
+        second = self._make_one('w2')
+        first.poll(now=0)
+        second.poll(now=0)
+        first._discover = lambda: ['a-1', 'a-2', 'b-1']
+        self.assertTrue(first.poll(now=60))
+        self.assertTrue(second.poll(now=60))
+        self.assertEqual(second.partitions, ['a-1', 'a-2', 'b-1'])
+
+    def test_leader_leaves(self):
+        first = self._make_one('w1')
+        second = self._make_one('w2')
+        first.poll(now=0)
+        first.finish()
+        self.assertFalse(first.leader)
+        self.assertTrue(second.leader)
+        second.poll(now=0)
+        self.assertEqual(self.discoveries, ['w1', 'w2'])
+
+    def test_leader_expires(self):
+        first = self._make_one('w1')
+        second = self._make_one('w2')
+        self.expire_session(self.clients[0].client_id)
+        self.assertFalse(first.leader)
+        self.assertTrue(second.leader)
+
+
+class TestZooKeeperPartitioner(TestIncrementalPartitioner, KazooTestHarness):
+    # runs the same tests against a real ZooKeeper server, the fake harness
+    # comes first in the method resolution order
+
+    def _get_client(self, **kwargs):
+        return KazooTestHarness._get_client(self, **kwargs)
+
+    def setup_zookeeper(self):
+        KazooTestHarness.setup_zookeeper(self)
+
+    def teardown_zookeeper(self):
+        KazooTestHarness.teardown_zookeeper(self)
+
+    def expire_session(self, client_id=None):
+        KazooTestHarness.expire_session(self, client_id)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import os.path
+import pstats
+import shutil
+import tempfile
+import unittest
+
+
+def sample_job(message, context):
+    context.append(message)
+    if message == 'fail':
+        raise ValueError(message)
+
+
+class TestJobProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _make_one(self, every=3, interval=300):
+        from qdo.profiler import JobProfiler
+        return JobProfiler(every, interval=interval, path=self.tempdir,
+            name='test.pstats')
+
+    def test_sampling(self):
+        profiler = self._make_one(every=3)
+        job = profiler.wrap(sample_job)
+        context = []
+        for i in range(10):
+            job(i, context)
+        self.assertEqual(context, range(10))
+        self.assertEqual(profiler.calls, 10)
+        self.assertEqual(profiler.samples, 3)
+        self.assertEqual(job.__name__, 'sample_job')
+
+    def test_exception(self):
+        profiler = self._make_one(every=1)
+        job = profiler.wrap(sample_job)
+        self.assertRaises(ValueError, job, 'fail', [])
+        self.assertEqual(profiler.samples, 1)
+
+    def test_dump(self):
+        profiler = self._make_one(every=1)
+        # nothing to write yet
+        profiler.dump()
+        self.assertFalse(os.path.exists(profiler.filename))
+        job = profiler.wrap(sample_job)
+        job('a', [])
+        job('b', [])
+        profiler.dump()
+        stats = pstats.Stats(profiler.filename)
+        names = [func[2] for func in stats.stats]
+        self.assertTrue('sample_job' in names)
+        self.assertEqual(os.listdir(self.tempdir), ['test.pstats'])
+
+    def test_dump_interval(self):
+        profiler = self._make_one(every=1, interval=0)
+        job = profiler.wrap(sample_job)
+        job('a', [])
+        self.assertTrue(os.path.exists(profiler.filename))
+
+    def test_dump_error(self):
+        profiler = self._make_one(every=1, interval=0)
+        profiler.filename = os.path.join(self.tempdir, 'missing', 'a.pstats')
+        job = profiler.wrap(sample_job)
+        # a failed write neither fails the job, nor hides its exception
+        context = []
+        job('a', context)
+        self.assertEqual(context, ['a'])
+        self.assertRaises(ValueError, job, 'fail', [])
+        self.assertEqual(profiler.samples, 2)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+
+class TestQuarantine(unittest.TestCase):
+
+    def _make_one(self, max_failures=2, capacity=10000):
+        from qdo.quarantine import Quarantine
+        return Quarantine(max_failures, capacity=capacity)
+
+    def test_disabled(self):
+        quarantine = self._make_one(max_failures=0)
+        message = {'message_id': 'abc', 'attempts': 10}
+        quarantine.record_failure(message)
+        self.assertFalse(quarantine.is_poison(message))
+        self.assertEqual(len(quarantine), 0)
+
+    def test_failures(self):
+        quarantine = self._make_one()
+        message = {'message_id': 'abc'}
+        quarantine.record_failure(message)
+        self.assertFalse(quarantine.is_poison(message))
+        quarantine.record_failure(message)
+        self.assertTrue(quarantine.is_poison(message))
+        self.assertEqual(quarantine.as_dict(),
+            {'tracked': 1, 'quarantined': 1})
+
+    def test_attempts(self):
+        quarantine = self._make_one()
+        message = {'message_id': 'abc', 'attempts': 1}
+        self.assertFalse(quarantine.is_poison(message))
+        message['attempts'] = 2
+        self.assertTrue(quarantine.is_poison(message))
+
+    def test_success(self):
+        quarantine = self._make_one()
+        message = {'message_id': 'abc'}
+        quarantine.record_failure(message)
+        quarantine.record_success(message)
+        self.assertEqual(quarantine.failures(message), 0)
+        self.assertEqual(len(quarantine), 0)
+
+    def test_capacity(self):
+        quarantine = self._make_one(capacity=3)
+        for i in range(5):
+            quarantine.record_failure({'message_id': str(i)})
+        self.assertEqual(len(quarantine), 3)
+        self.assertEqual(quarantine.failures({'message_id': '1'}), 0)
+        self.assertEqual(quarantine.failures({'message_id': '4'}), 1)
+        # removed entries don't take up any capacity
+        quarantine.record_success({'message_id': '4'})
+        for i in range(5, 7):
+            quarantine.record_failure({'message_id': str(i)})
+        self.assertEqual(len(quarantine), 3)
+        self.assertEqual(quarantine.failures({'message_id': '3'}), 1)
+        self.assertEqual(quarantine.failures({'message_id': '5'}), 1)
+
+    def test_fail_after_success(self):
+        quarantine = self._make_one(capacity=2)
+        poison = {'message_id': 'abc'}
+        quarantine.record_failure(poison)
+        quarantine.record_success(poison)
+        quarantine.record_failure(poison)
+        quarantine.record_failure({'message_id': 'def'})
+        quarantine.record_failure(poison)
+        # no stale entry of the first failure evicts the live count
+        quarantine.record_failure({'message_id': 'ghi'})
+        self.assertEqual(len(quarantine), 2)
+        self.assertEqual(quarantine.failures(poison), 2)
+        self.assertTrue(quarantine.is_poison(poison))
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+
+import ujson
+
+from qdo.config import ERROR_PARTITIONS
+from qdo.config import ERROR_QUEUE
+from qdo.config import QdoSettings
+from qdo.tests.base import BaseTestCase
+from qdo.worker import StopWorker
+
+
+def _make_replayer(app_key=None, extra=None):
+    from qdo.replay import Replayer
+    settings = QdoSettings()
+    settings['queuey.app_key'] = app_key
+    if extra is not None:
+        settings.update(extra)
+    return Replayer(settings)
+
+
+class DummyResponse(object):
+
+    ok = True
+    status_code = 200
+
+
+class DummyConnection(object):
+
+    def __init__(self):
+        self.posts = []
+        self.deletes = []
+
+    def post(self, url='', params=None, data='', headers=None):
+        self.posts.append(ujson.decode(data)['messages'])
+        return DummyResponse()
+
+    def delete(self, url='', params=None):
+        self.deletes.append(url)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_unlimited(self):
+        from qdo.replay import RateLimiter
+        limiter = RateLimiter(0)
+        start = time.time()
+        for i in range(1000):
+            limiter.acquire()
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_rate(self):
+        from qdo.replay import RateLimiter
+        limiter = RateLimiter(100)
+        start = time.time()
+        for i in range(11):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.09)
+
+
+class TestReplayer(unittest.TestCase):
+
+    def test_defaults(self):
+        replayer = _make_replayer()
+        self.assertEqual(replayer.partitions,
+            range(1, ERROR_PARTITIONS + 1))
+        self.assertEqual(replayer.limiter.rate, 0)
+
+    def test_partitions(self):
+        # a single value in the config file is parsed as a number
+        replayer = _make_replayer(extra={'replay.partitions': 3})
+        self.assertEqual(replayer.partitions, [3])
+        replayer = _make_replayer(extra={'replay.partitions': [2, 5]})
+        self.assertEqual(replayer.partitions, [2, 5])
+
+    def test_matches_queue(self):
+        replayer = _make_replayer(extra={'replay.queue': 'abc'})
+        self.assertTrue(replayer.matches({'queue': 'abc-1'}))
+        self.assertFalse(replayer.matches({'queue': 'abcd-1'}))
+        replayer = _make_replayer(extra={'replay.queue': 'abc-2'})
+        self.assertTrue(replayer.matches({'queue': 'abc-2'}))
+        self.assertFalse(replayer.matches({'queue': 'abc-1'}))
+
+    def test_matches_time(self):
+        replayer = _make_replayer(extra={
+            'replay.since': 100, 'replay.until': 200})
+        self.assertFalse(replayer.matches({'timestamp': '99.5'}))
+        self.assertTrue(replayer.matches({'timestamp': '100.0'}))
+        self.assertTrue(replayer.matches({'timestamp': '200.0'}))
+        self.assertFalse(replayer.matches({'timestamp': '200.1'}))
+
+    def test_replay_message(self):
+        replayer = _make_replayer()
+        replayer.job = lambda message, context: None
+        conn = DummyConnection()
+        replayer.replay_message(conn, {}, 3, 'abc',
+            {'body': 'a', 'queue': 'q-1'})
+        self.assertEqual(replayer.replayed, 1)
+        self.assertEqual(conn.posts, [])
+        self.assertEqual(conn.deletes, [ERROR_QUEUE + '/3%3Aabc'])
+
+    def test_replay_message_failure(self):
+        from qdo import log
+        log.configure(None, debug=True)
+        replayer = _make_replayer()
+
+        def job(message, context):
+            raise ValueError
+
+        replayer.job = job
+        conn = DummyConnection()
+        replayer.replay_message(conn, {}, 3, 'abc',
+            {'body': 'a', 'queue': 'q-1', 'attempts': 1})
+        self.assertEqual(replayer.failed, 1)
+        saved = ujson.decode(conn.posts[0][0]['body'])
+        self.assertEqual(saved['attempts'], 2)
+        self.assertEqual(conn.deletes, [ERROR_QUEUE + '/3%3Aabc'])
+
+    def test_replay_message_stop(self):
+        replayer = _make_replayer()
+
+        def job(message, context):
+            raise StopWorker
+
+        replayer.job = job
+        conn = DummyConnection()
+        replayer.replay_message(conn, {}, 3, 'abc', {'body': 'a'})
+        self.assertTrue(replayer.shutdown)
+        self.assertEqual(conn.deletes, [])
+
+
+class TestReplayQueuey(BaseTestCase):
+
+    def test_replay(self):
+        from qdo.errors import post_failed_messages
+        conn = self._make_queuey_conn()
+        conn.create_queue(queue_name=ERROR_QUEUE,
+            partitions=ERROR_PARTITIONS)
+        failed = []
+        for i in range(10):
+            failed.append({'body': str(i), 'queue': 'q%s-1' % (i % 3),
+                'timestamp': '%s' % time.time(), 'attempts': 1})
+        post_failed_messages(conn, failed)
+        replayer = _make_replayer(self.queuey_app_key,
+            extra={'replay.queue': 'q0'})
+        bodies = []
+
+        def job(message, context):
+            bodies.append(message['body'])
+            if message['body'] == '3':
+                raise ValueError
+
+        replayer.job = job
+        replayer.run()
+        self.assertEqual(sorted(bodies), ['0', '3', '6', '9'])
+        self.assertEqual(replayer.replayed, 3)
+        self.assertEqual(replayer.failed, 1)
+        self.assertEqual(replayer.skipped, 6)
+        partition_spec = ','.join(
+            [unicode(i + 1) for i in range(ERROR_PARTITIONS)])
+        remaining = [ujson.decode(m['body']) for m in conn.messages(
+            ERROR_QUEUE, partition=partition_spec)]
+        self.assertEqual(len(remaining), 7)
+        retried = [m for m in remaining if m['body'] == '3']
+        self.assertEqual(retried[0]['attempts'], 2)
+
+    def test_replay_quarantined(self):
+        from qdo.errors import post_failed_messages
+        conn = self._make_queuey_conn()
+        conn.create_queue(queue_name=ERROR_QUEUE,
+            partitions=ERROR_PARTITIONS)
+        post_failed_messages(conn, [
+            {'body': '1', 'queue': 'q-1', 'attempts': 1},
+            {'body': '2', 'queue': 'q-1', 'attempts': 3},
+        ])
+        replayer = _make_replayer(self.queuey_app_key,
+            extra={'quarantine.max_failures': 3})
+        bodies = []
+        replayer.job = lambda message, context: bodies.append(message['body'])
+        replayer.run()
+        self.assertEqual(bodies, ['1'])
+        self.assertEqual(replayer.quarantined, 1)
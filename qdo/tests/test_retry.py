@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import socket
+import unittest
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def _make_one(self, *args, **kw):
+        from qdo.retry import RetryPolicy
+        return RetryPolicy(*args, **kw)
+
+    def test_disabled(self):
+        policy = self._make_one()
+        self.assertFalse(policy.enabled)
+        self.assertEqual(policy.attempts_for(ValueError()), 0)
+
+    def test_exceptions(self):
+        policy = self._make_one(attempts=1, exceptions=[
+            'socket:timeout 5',
+            'exceptions:LookupError 0',
+        ])
+        self.assertTrue(policy.enabled)
+        self.assertEqual(policy.attempts_for(socket.timeout()), 5)
+        self.assertEqual(policy.attempts_for(KeyError()), 0)
+        self.assertEqual(policy.attempts_for(ValueError()), 1)
+
+    def test_single_exception(self):
+        policy = self._make_one(exceptions='socket:timeout 2')
+        self.assertTrue(policy.enabled)
+        self.assertEqual(policy.attempts_for(socket.timeout()), 2)
+
+    def test_delay(self):
+        policy = self._make_one(backoff=1, max_backoff=10)
+        for i in range(20):
+            self.assertTrue(0.5 <= policy.delay(1) <= 1)
+            self.assertTrue(2 <= policy.delay(3) <= 4)
+            self.assertTrue(5 <= policy.delay(10) <= 10)
+
+
+class TestRetryQueue(unittest.TestCase):
+
+    def _make_one(self, attempts=2, capacity=1000):
+        from qdo.retry import RetryPolicy
+        from qdo.retry import RetryQueue
+        return RetryQueue(RetryPolicy(attempts=attempts, backoff=1),
+            capacity=capacity)
+
+    def test_schedule(self):
+        queue = self._make_one(attempts=2)
+        exc = ValueError()
+        self.assertTrue(queue.schedule('a-1', {'body': '1'}, exc, 1, now=0))
+        self.assertTrue(queue.schedule('a-1', {'body': '2'}, exc, 2, now=0))
+        self.assertFalse(queue.schedule('a-1', {'body': '3'}, exc, 3, now=0))
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.pending('a-1'), 2)
+        self.assertTrue(0.5 <= queue.next_due() <= 1)
+
+    def test_capacity(self):
+        queue = self._make_one(capacity=2)
+        exc = ValueError()
+        self.assertTrue(queue.schedule('a-1', {'body': '1'}, exc, 1, now=0))
+        self.assertTrue(queue.schedule('b-1', {'body': '2'}, exc, 1, now=0))
+        self.assertTrue(queue.full)
+        self.assertFalse(queue.schedule('a-1', {'body': '3'}, exc, 1, now=0))
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.pending('a-1'), 1)
+        # due retries make room for new ones
+        queue.pop_due(now=2)
+        self.assertFalse(queue.full)
+
+    def test_pop_due(self):
+        queue = self._make_one()
+        exc = ValueError()
+        queue.schedule('a-1', {'body': '1'}, exc, 1, now=0)
+        queue.schedule('b-1', {'body': '2'}, exc, 2, now=0)
+        self.assertEqual(queue.pop_due(now=0.1), [])
+        self.assertEqual(queue.pop_due(now=1),
+            [('a-1', {'body': '1'}, 1)])
+        # popped retries stay pending until they are done
+        self.assertEqual(queue.pending('a-1'), 1)
+        queue.done('a-1')
+        self.assertEqual(queue.pending('a-1'), 0)
+        self.assertEqual(queue.pop_due(now=2),
+            [('b-1', {'body': '2'}, 2)])
+        self.assertEqual(queue.next_due(), None)
+
+    def test_discard(self):
+        queue = self._make_one()
+        exc = ValueError()
+        queue.schedule('a-1', {'body': '1'}, exc, 1)
+        queue.schedule('b-1', {'body': '2'}, exc, 1)
+        queue.discard(['a-1'])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pending('a-1'), 0)
+        self.assertEqual(queue.pending('b-1'), 1)
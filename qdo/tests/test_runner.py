@@ -44,6 +44,26 @@ class TestArgsParser(unittest.TestCase):
         namespace = parse_args(['-c', TEST_CONFIG])
         self.assertEqual(namespace.configfile, TEST_CONFIG)
 
+    def test_parse_args_command(self):
+        from qdo.runner import parse_args
+        self.assertEqual(parse_args([]).command, 'work')
+        namespace = parse_args(['replay-errors', '--queue', 'abc',
+            '--since', '1346153731.5', '--rate', '10',
+            '--partition', '2', '--partition', '3'])
+        self.assertEqual(namespace.command, 'replay-errors')
+        self.assertEqual(namespace.replay_queue, 'abc')
+        self.assertEqual(namespace.replay_since, 1346153731.5)
+        self.assertEqual(namespace.replay_until, None)
+        self.assertEqual(namespace.replay_rate, 10.0)
+        self.assertEqual(namespace.replay_partitions, [2, 3])
+
+    def test_parse_args_profile(self):
+        from qdo.runner import parse_args
+        namespace = parse_args([])
+        self.assertEqual(namespace.profile_every, None)
+        namespace = parse_args(['-p', '50'])
+        self.assertEqual(namespace.profile_every, 50)
+
 
 class TestRunner(unittest.TestCase):
 
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+
+class TestSimulation(unittest.TestCase):
+
+    def _make_one(self, **kw):
+        from qdo.simulator import SimulatedQueue
+        from qdo.simulator import Simulation
+        queues = [
+            SimulatedQueue('a', partitions=4, rate=20, job_time=0.01),
+            SimulatedQueue('b', partitions=2, rate=0),
+        ]
+        kw.setdefault('seed', 1)
+        return Simulation(queues, **kw)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, self._make_one, strategy='unknown')
+
+    def test_single_worker(self):
+        simulation = self._make_one(wait_interval=0.5, party_wait=1)
+        name = simulation.add_worker()
+        report = simulation.run(120)
+        self.assertEqual(len(report['workers'][name]['partitions']), 6)
+        # the worker keeps up with the arrival rate
+        self.assertTrue(report['throughput'] > 18, report['throughput'])
+        self.assertTrue(report['backlog'] < 20, report['backlog'])
+        self.assertTrue(report['idle_polls'] > 0)
+        self.assertEqual(report['rebalances'], 0)
+        self.assertTrue(report['lag']['p50'] <= report['lag']['max'])
+
+    def test_reproducible(self):
+        reports = []
+        for i in range(2):
+            simulation = self._make_one()
+            simulation.add_worker()
+            simulation.add_worker(start=5)
+            report = simulation.run(60)
+            reports.append((report['processed'], report['lag']))
+        self.assertEqual(reports[0], reports[1])
+
+    def test_rebalance(self):
+        simulation = self._make_one(party_wait=5)
+        first = simulation.add_worker()
+        second = simulation.add_worker(start=30)
+        report = simulation.run(60)
+        workers = report['workers']
+        self.assertEqual(len(workers[first]['partitions']), 3)
+        self.assertEqual(len(workers[second]['partitions']), 3)
+        self.assertEqual(report['rebalances'], 1)
+
+    def test_leave(self):
+        simulation = self._make_one(party_wait=5)
+        first = simulation.add_worker()
+        second = simulation.add_worker(stop=30)
+        report = simulation.run(60)
+        self.assertEqual(len(report['workers'][first]['partitions']), 6)
+        self.assertEqual(report['workers'][second]['partitions'], [])
+        # its partitions had no owner, until the first worker took over
+        self.assertTrue(report['unowned_seconds'] > 5 * 3)
+
+    def test_party_wait(self):
+        results = []
+        for party_wait in (1, 20):
+            simulation = self._make_one(party_wait=party_wait)
+            simulation.add_worker()
+            simulation.add_worker(start=10)
+            results.append(simulation.run(100)['unowned_seconds'])
+        # waiting longer for a stable party delays the initial assignment
+        self.assertTrue(results[0] < results[1], results)
+
+    def test_wait_interval(self):
+        idle_polls = []
+        for wait_interval in (0.1, 10):
+            simulation = self._make_one(wait_interval=wait_interval,
+                party_wait=1)
+            simulation.add_worker()
+            idle_polls.append(simulation.run(100)['idle_polls'])
+        self.assertTrue(idle_polls[0] > idle_polls[1], idle_polls)
+
+    def test_idle_backoff(self):
+        from qdo.simulator import SimulatedQueue
+        from qdo.simulator import Simulation
+        simulation = Simulation([SimulatedQueue('a', 4, rate=0.0001)],
+            wait_interval=30, seed=1)
+        simulation.add_worker()
+        # membership polls don't cut the fetch backoff short
+        self.assertTrue(simulation.run(3600)['idle_polls'] < 10)
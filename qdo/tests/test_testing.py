@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NotEmptyError
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
+
+
+class TestFakeZooKeeper(unittest.TestCase):
+
+    def setUp(self):
+        from qdo.testing import FakeZooKeeper
+        self.zookeeper = FakeZooKeeper()
+        self.client = self._make_client()
+
+    def _make_client(self):
+        client = self.zookeeper.client(hosts='127.0.0.1:2181')
+        client.start()
+        return client
+
+    def test_create(self):
+        client = self.client
+        self.assertEqual(client.create('/a', 'data'), '/a')
+        self.assertRaises(NodeExistsError, client.create, '/a')
+        self.assertRaises(NoNodeError, client.create, '/b/c')
+        client.create('/b/c', makepath=True)
+        self.assertEqual(client.get_children('/'), ['a', 'b'])
+        data, stat = client.get('/a')
+        self.assertEqual(data, 'data')
+        self.assertEqual(stat.version, 0)
+        self.assertEqual(stat.ephemeralOwner, 0)
+
+    def test_ensure_path(self):
+        client = self.client
+        client.ensure_path('/a/b/c')
+        client.ensure_path('/a/b/c')
+        self.assertEqual(client.get_children('/a/b'), ['c'])
+
+    def test_sequence(self):
+        client = self.client
+        client.ensure_path('/a')
+        self.assertEqual(client.create('/a/n-', sequence=True),
+            '/a/n-0000000000')
+        self.assertEqual(client.create('/a/n-', sequence=True),
+            '/a/n-0000000001')
+
+    def test_set(self):
+        client = self.client
+        client.create('/a', 'one')
+        stat = client.set('/a', 'two')
+        self.assertEqual(stat.version, 1)
+        self.assertRaises(BadVersionError, client.set, '/a', 'x', version=0)
+        client.set('/a', 'three', version=1)
+        self.assertEqual(client.get('/a')[0], 'three')
+        self.assertRaises(NoNodeError, client.set, '/b', 'x')
+
+    def test_delete(self):
+        client = self.client
+        client.create('/a/b', makepath=True)
+        self.assertRaises(NotEmptyError, client.delete, '/a')
+        self.assertRaises(BadVersionError, client.delete, '/a/b', version=3)
+        client.delete('/a', recursive=True)
+        self.assertEqual(client.exists('/a'), None)
+        self.assertRaises(NoNodeError, client.delete, '/a')
+
+    def test_ephemeral(self):
+        other = self._make_client()
+        other.create('/a', ephemeral=True)
+        data, stat = self.client.get('/a')
+        self.assertEqual(stat.ephemeralOwner, other.client_id[0])
+        other.stop()
+        self.assertEqual(self.client.exists('/a'), None)
+        self.assertEqual(other.client_id, None)
+
+    def test_expire(self):
+        other = self._make_client()
+        states = []
+        other.add_listener(states.append)
+        other.create('/a', ephemeral=True)
+        self.zookeeper.expire(other.client_id[0])
+        self.assertEqual(states, [KazooState.LOST])
+        self.assertEqual(self.client.exists('/a'), None)
+
+    def test_data_watch(self):
+        client = self.client
+        events = []
+        self.assertEqual(client.exists('/a', watch=events.append), None)
+        client.create('/a')
+        client.get('/a', watch=events.append)
+        client.set('/a', 'x')
+        # watches fire only once
+        client.set('/a', 'y')
+        self.assertEqual([e.type for e in events],
+            [EventType.CREATED, EventType.CHANGED])
+        self.assertEqual(events[0].path, '/a')
+
+    def test_child_watch(self):
+        client = self.client
+        events = []
+        client.ensure_path('/a')
+        client.get_children('/a', watch=events.append)
+        client.create('/a/b')
+        client.create('/a/c')
+        self.assertEqual([e.type for e in events], [EventType.CHILD])
+
+    def test_watch_failure(self):
+        client = self.client
+
+        def watch(event):
+            raise ValueError
+
+        client.exists('/a', watch=watch)
+        self.assertEqual(client.create('/a'), '/a')
+
+    def test_no_events_after_stop(self):
+        other = self._make_client()
+        events = []
+        other.exists('/a', watch=events.append)
+        other.stop()
+        self.client.create('/a')
+        self.assertEqual(events, [])
+
+
+class TestFakeZooKeeperHarness(unittest.TestCase):
+
+    def test_harness(self):
+        from qdo.testing import FakeZooKeeperHarness
+        harness = FakeZooKeeperHarness()
+        harness.setup_zookeeper()
+        client = harness._get_client()
+        client.start()
+        client.create('/a', ephemeral=True)
+        harness.expire_session(client.client_id)
+        self.assertEqual(harness.client.exists('/a'), None)
+        harness.teardown_zookeeper()
+        self.assertEqual(harness.client, None)
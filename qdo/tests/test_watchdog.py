@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import signal
+import sys
+import threading
+import time
+import unittest
+
+
+class TestWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.watchdog = None
+
+    def tearDown(self):
+        if self.watchdog is not None:
+            self.watchdog.stop()
+
+    def _make_one(self, timeout=0.05, recycle=False):
+        from qdo.watchdog import Watchdog
+        self.watchdog = Watchdog(timeout, recycle=recycle)
+        self.watchdog.start()
+        return self.watchdog
+
+    def test_disabled(self):
+        watchdog = self._make_one(timeout=0)
+        self.assertEqual(watchdog.call(lambda: 1), 1)
+        self.assertEqual(watchdog._thread, None)
+        self.assertTrue(watchdog.check())
+
+    def test_timeout(self):
+        from qdo.watchdog import JobTimeout
+        watchdog = self._make_one()
+
+        def hang():
+            time.sleep(1)
+
+        start = time.time()
+        self.assertRaises(JobTimeout, watchdog.call, hang)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(watchdog.expired, 1)
+        self.assertTrue(watchdog.healthy)
+
+    def test_no_timeout(self):
+        watchdog = self._make_one()
+        self.assertEqual(watchdog.call(lambda x: x, 2), 2)
+        time.sleep(0.1)
+        self.assertEqual(watchdog.expired, 0)
+
+    def test_check(self):
+        watchdog = self._make_one(timeout=10)
+
+        def job():
+            now = time.time()
+            self.assertTrue(watchdog.check(now=now + 19))
+            self.assertFalse(watchdog.check(now=now + 21))
+
+        watchdog.call(job)
+        self.assertFalse(watchdog.healthy)
+        self.assertTrue(watchdog.check())
+
+    def test_stop(self):
+        previous = signal.getsignal(signal.SIGALRM)
+        watchdog = self._make_one()
+        self.assertEqual(signal.getsignal(signal.SIGALRM), watchdog._alarm)
+        watchdog.stop()
+        self.assertEqual(signal.getsignal(signal.SIGALRM), previous)
+
+    def test_alarm_after_return(self):
+        from qdo.watchdog import JobTimeout
+        watchdog = self._make_one(timeout=10)
+
+        def job():
+            # an alarm inside `call` arrives after the job has returned
+            watchdog._alarm(signal.SIGALRM, sys._getframe(1))
+            self.assertEqual(watchdog.expired, 0)
+            self.assertRaises(JobTimeout, watchdog._alarm, signal.SIGALRM,
+                sys._getframe())
+            return 'done'
+
+        self.assertEqual(watchdog.call(job), 'done')
+        self.assertEqual(watchdog.expired, 1)
+
+    def test_budget_close_to_job_time(self):
+        from qdo.watchdog import JobTimeout
+        watchdog = self._make_one(timeout=0.005)
+        finished = []
+        timeouts = 0
+
+        def job(i):
+            end = time.time() + 0.005
+            while time.time() < end:
+                pass
+            finished.append(i)
+            return i
+
+        for i in range(200):
+            try:
+                self.assertEqual(watchdog.call(job, i), i)
+            except JobTimeout:
+                timeouts += 1
+        self.assertEqual(watchdog.expired, timeouts)
+        self.assertEqual(len(finished) + timeouts >= 200, True)
+        # no timer is left armed after the last job
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+    def test_thread(self):
+        watchdog = self._make_one(timeout=10)
+        checks = []
+
+        def job():
+            now = time.time()
+            checks.append(watchdog.check(now=now + 19))
+            checks.append(watchdog.check(now=now + 21))
+
+        # jobs of other threads aren't interrupted, but checked
+        thread = threading.Thread(target=watchdog.call, args=(job,))
+        thread.start()
+        thread.join()
+        self.assertEqual(checks, [True, False])
+        self.assertFalse(watchdog.healthy)
+        self.assertEqual(watchdog.expired, 0)
+        self.assertEqual(watchdog._started, {})
@@ -4,16 +4,22 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from contextlib import contextmanager
+import os
+import signal
+import socket
 import threading
 import time
+import unittest
+import uuid
 
 import ujson
 from kazoo.testing import KazooTestHarness
 
+from qdo.config import ERROR_PARTITIONS
 from qdo.config import ERROR_QUEUE
 from qdo.config import QdoSettings
-from qdo.config import STATUS_PARTITIONS
 from qdo.config import STATUS_QUEUE
+from qdo.errors import error_partition
 from qdo.worker import StopWorker
 from qdo.tests.base import BaseTestCase
 
@@ -241,15 +247,19 @@ class TestWorker(BaseTestCase):
         worker.work()
 
         partition_spec = ','.join(
-            [unicode(i + 1) for i in range(STATUS_PARTITIONS)])
+            [unicode(i + 1) for i in range(ERROR_PARTITIONS)])
         failed_messages = worker.queuey_conn.messages(
             ERROR_QUEUE, partition=partition_spec)
         self.assertEqual(len(failed_messages), 20)
-        error_partitions = [m['partition'] for m in failed_messages]
-        # multiple error partitions are used, 20 messages aren't enough to
-        # guarantee all 7 partitions get randomly selected
-        self.assertTrue(len(set(error_partitions)) > 3)
         failures = [ujson.decode(m['body']) for m in failed_messages]
+        # error partitions are chosen by the source partition, the eleven
+        # source partitions are spread over multiple error partitions
+        error_partitions = set()
+        for message in failed_messages:
+            source = ujson.decode(message['body'])['queue']
+            self.assertEqual(message['partition'], error_partition(source))
+            error_partitions.add(message['partition'])
+        self.assertTrue(len(error_partitions) > 1)
         # the first 20 of 22 failures get saved, two random ones aren't
         # processed
         data = set([int(f['body']) for f in failures])
@@ -311,6 +321,635 @@ class TestWorker(BaseTestCase):
             events[i].wait()
             self.assertEqual(contexts[i][-1], lasts[i])
 
+    def test_multiple_workers_partitioned(self):
+        from qdo.testing import FakeZooKeeper
+        zookeeper = FakeZooKeeper()
+        queuey_conn = self._queuey_conn
+        queue = queuey_conn.create_queue(partitions=4)
+        response = queuey_conn.post(queue,
+            data=['%s' % i for i in xrange(20)])
+        expected = set([m['key'] for m in
+            ujson.decode(response.text)['messages']])
+        seen = []
+        threads = []
+        workers = []
+
+        def job(message, context):
+            seen.append(message['message_id'])
+
+        for i in range(2):
+            worker, _ = _make_worker(self.queuey_app_key, queue=False,
+                extra={
+                    'qdo-worker.name': 'worker%s' % i,
+                    'partitions.policy': 'automatic',
+                    'partitions.ids': ['%s-%s' % (queue, p)
+                        for p in xrange(1, 5)],
+                    'zookeeper.party_wait': 1,
+                })
+            # all workers share a single in-process ZooKeeper
+            worker.zk_client_class = zookeeper.client
+            worker.job = job
+            workers.append(worker)
+            thread = threading.Thread(target=worker.work)
+            thread.start()
+            threads.append(thread)
+
+        start = time.time()
+        end = start + 30
+        rebalance_time = None
+        while time.time() < end:
+            if rebalance_time is None:
+                # measure the time until both workers own their share
+                sizes = [len(list(w.partitioner or [])) for w in workers]
+                if sizes == [2, 2]:
+                    rebalance_time = time.time() - start
+            elif set(seen) == expected:
+                break
+            time.sleep(0.1)
+        assigned = [sorted(w.partitioner) for w in workers]
+        for worker in workers:
+            worker.shutdown = True
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(set(seen), expected)
+        # no message was processed by both workers
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertTrue(rebalance_time is not None)
+        self.assertTrue(rebalance_time < 30, rebalance_time)
+        # the partitions got split between both workers
+        self.assertEqual([len(a) for a in assigned], [2, 2])
+        self.assertEqual(sorted(assigned[0] + assigned[1]),
+            ['%s-%s' % (queue, p) for p in xrange(1, 5)])
+
+    def _drain_idle(self, extra=None, zk_client_class=None):
+        worker, queue_name = self._make_one(extra=extra)
+        name = queue_name + '-1'
+        worker.settings['partitions.ids'] = [name]
+        worker.wait_interval = 60
+        if zk_client_class is not None:
+            worker.zk_client_class = zk_client_class
+        response = self._post_message(worker, queue_name, 'Hello')
+        message_id = ujson.decode(response.text)['messages'][0]['key']
+        processed = threading.Event()
+        worker.job = lambda message, context: processed.set()
+        thread = threading.Thread(target=worker.work)
+        thread.start()
+        self.assertTrue(processed.wait(10))
+        # let the worker go idle in its backoff
+        time.sleep(0.5)
+        start = time.time()
+        worker.drain()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(time.time() - start < 5, time.time() - start)
+        self.assertEqual(worker.partition_cache[name].last_message,
+            message_id)
+
+    def test_drain_idle_manual(self):
+        self._drain_idle()
+
+    def test_drain_idle_automatic(self):
+        from qdo.testing import FakeZooKeeper
+        self._drain_idle(extra={
+            'partitions.policy': 'automatic',
+            'partitions.handoff_timeout': 1,
+            'zookeeper.party_wait': 1,
+        }, zk_client_class=FakeZooKeeper().client)
+
+
+class DummyPartition(object):
+
+    def __init__(self, name):
+        self.name = name
+        from qdo.partition import CheckpointTracker
+        self.queue_name = name.rsplit('-', 1)[0]
+        self.tracker = CheckpointTracker()
+        self.position = None
+        self.last_message = None
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_backoff(self):
+        from qdo.worker import backoff
+        self.assertEqual(backoff(5, 0, 1.0), 5)
+        self.assertEqual(backoff(5, 3, 1.0), 40)
+        self.assertEqual(backoff(5, 20, 1.0), 5 * 1024)
+        seconds = backoff(5, 0)
+        self.assertTrue(4 <= seconds <= 6, seconds)
+
+
+class TestName(unittest.TestCase):
+
+    def test_default(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, queue=False)
+        self.assertTrue(worker.name.endswith('-%s' % os.getpid()))
+
+    def test_name(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key,
+            extra={'qdo-worker.name': 'one'}, queue=False)
+        self.assertEqual(worker.name,
+            '%s-%s-one' % (socket.getfqdn(), os.getpid()))
+        self.assertFalse(worker.stable_name)
+
+    def test_stable(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key,
+            extra={'qdo-worker.name': 'one', 'qdo-worker.stable_name': True},
+            queue=False)
+        self.assertEqual(worker.name, '%s-one' % socket.getfqdn())
+        self.assertRaises(ValueError, _make_worker,
+            BaseTestCase.queuey_app_key,
+            extra={'qdo-worker.stable_name': True}, queue=False)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def _make_one(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, queue=False)
+        worker.partition_cache['a-1'] = DummyPartition('a-1')
+        return worker
+
+    def test_checkpoint(self):
+        worker = self._make_one()
+        partition = worker.partition_cache['a-1']
+        worker.checkpoint(partition, 'abc')
+        self.assertEqual(partition.position, 'abc')
+        self.assertEqual(partition.last_message, 'abc')
+        self.assertEqual(worker.deferred, {})
+
+    def test_checkpoint_deferred(self):
+        worker = self._make_one()
+        partition = worker.partition_cache['a-1']
+        writer = worker.error_writer
+        writer._pending['a-1'] = 1
+        worker.checkpoint(partition, 'abc')
+        worker.checkpoint(partition, 'def')
+        self.assertEqual(partition.position, 'def')
+        self.assertEqual(partition.last_message, None)
+        self.assertEqual(worker.deferred, {'a-1': 'def'})
+        worker.commit_checkpoints()
+        self.assertEqual(partition.last_message, None)
+        # once the failed messages are saved, the checkpoint is committed
+        del writer._pending['a-1']
+        worker.commit_checkpoints()
+        self.assertEqual(partition.last_message, 'def')
+        self.assertEqual(worker.deferred, {})
+
+    def test_checkpoint_fenced(self):
+        from qdo.partitioner import StaticPartitioner
+        worker = self._make_one()
+        partitioner = worker.partitioner = StaticPartitioner('/worker',
+            set=['a-1'])
+        partitioner.holds = lambda name: False
+        partitioner.token = lambda name: 7
+        partition = worker.partition_cache['a-1']
+        worker.checkpoint(partition, 'abc')
+        # the lease might be lost, don't overwrite the checkpoint
+        self.assertEqual(partition.last_message, None)
+        self.assertEqual(worker.deferred, {'a-1': 'abc'})
+        partitioner.holds = lambda name: True
+        worker.commit_checkpoints()
+        self.assertEqual(partition.last_message, 'abc')
+        self.assertEqual(partition.token, 7)
+
+
+class TestRetries(unittest.TestCase):
+
+    def _make_one(self, **extra):
+        extra.update({'retry.attempts': 2, 'retry.backoff': '0.01'})
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, extra=extra,
+            queue=False)
+        worker.partition_cache['a-1'] = DummyPartition('a-1')
+        self.failures = []
+
+        def job_failure(message, context, name, exc, queuey_conn):
+            self.failures.append((message['body'], name))
+
+        worker.job_failure = job_failure
+        return worker
+
+    def test_retry_success(self):
+        worker = self._make_one()
+        calls = []
+
+        def job(message, context):
+            calls.append(message['body'])
+            if len(calls) < 3:
+                raise ValueError
+
+        message = {'body': 'a', 'message_id': 'abc'}
+        self.assertTrue(worker.run_job(job, 'a-1', message, {}))
+        self.assertEqual(worker.retries.pending('a-1'), 1)
+        self.assertTrue(worker.held('a-1'))
+        # the checkpoint is held back while the retry is pending
+        worker.checkpoint(worker.partition_cache['a-1'], 'abc')
+        self.assertEqual(worker.deferred, {'a-1': 'abc'})
+        time.sleep(0.02)
+        worker.run_retries(job, {})
+        time.sleep(0.04)
+        worker.run_retries(job, {})
+        self.assertEqual(calls, ['a', 'a', 'a'])
+        self.assertEqual(self.failures, [])
+        self.assertFalse(worker.held('a-1'))
+        worker.commit_checkpoints()
+        self.assertEqual(worker.partition_cache['a-1'].last_message, 'abc')
+
+    def test_retry_exhausted(self):
+        worker = self._make_one()
+
+        def job(message, context):
+            raise ValueError
+
+        message = {'body': 'a', 'message_id': 'abc'}
+        worker.run_job(job, 'a-1', message, {})
+        for i in range(2):
+            time.sleep(0.05)
+            worker.run_retries(job, {})
+        self.assertEqual(self.failures, [('a', 'a-1')])
+        self.assertEqual(len(worker.retries), 0)
+        self.assertFalse(worker.held('a-1'))
+
+    def test_capacity(self):
+        worker = self._make_one(**{'retry.capacity': 1})
+
+        def job(message, context):
+            raise ValueError
+
+        worker.run_job(job, 'a-1', {'body': 'a', 'message_id': 'abc'}, {})
+        worker.run_job(job, 'a-1', {'body': 'b', 'message_id': 'def'}, {})
+        # the second message didn't fit and failed right away
+        self.assertEqual(self.failures, [('b', 'a-1')])
+        self.assertEqual(len(worker.retries), 1)
+
+    def test_release(self):
+        worker = self._make_one()
+
+        def job(message, context):
+            raise ValueError
+
+        partition = worker.partition_cache['a-1']
+        worker.run_job(job, 'a-1', {'body': 'a', 'message_id': 'abc'}, {})
+        worker.checkpoint(partition, 'abc')
+        worker.release(['a-1'])
+        self.assertEqual(len(worker.retries), 0)
+        self.assertEqual(worker.deferred, {})
+        self.assertEqual(partition.position, None)
+        self.assertEqual(partition.last_message, None)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def _make_one(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, extra={
+            'breaker.threshold': '0.5', 'breaker.min_jobs': 2,
+            'breaker.probe_interval': 0}, queue=False)
+        worker.partition_cache['a-1'] = DummyPartition('a-1')
+        worker.partition_cache['b-1'] = DummyPartition('b-1')
+        worker.job_failure = lambda *args: None
+        return worker
+
+    def _fail(self, message, context):
+        raise ValueError
+
+    def test_trip(self):
+        worker = self._make_one()
+        worker.run_job(self._fail, 'a-1', {'message_id': 'abc'}, {})
+        self.assertTrue(worker.breakers.allow('a'))
+        worker.run_job(self._fail, 'a-1', {'message_id': 'abd'}, {})
+        self.assertEqual(worker.breakers.get('a').state, 'open')
+        # other queues aren't affected
+        self.assertEqual(worker.breakers.get('b').state, 'closed')
+        # a successful probe closes the breaker
+        self.assertTrue(worker.breakers.allow('a'))
+        self.assertFalse(worker.breakers.allow('a'))
+        worker.run_job(lambda m, c: None, 'a-1', {'message_id': 'abe'}, {})
+        self.assertEqual(worker.breakers.get('a').state, 'closed')
+
+    def test_wait_for_probe(self):
+        worker = self._make_one()
+        worker.wait_interval = 10
+        worker.run_job(self._fail, 'a-1', {'message_id': 'abc'}, {})
+        worker.run_job(self._fail, 'a-1', {'message_id': 'abd'}, {})
+        start = time.time()
+        worker.wait()
+        self.assertTrue(time.time() - start < 1)
+
+
+class DummyPartitioner(object):
+
+    poll_interval = 0.01
+    release = False
+    allocating = False
+    failed = False
+    draining = False
+
+    def __init__(self):
+        self.polls = 0
+        self.partitions = ['a-1']
+
+    def __iter__(self):
+        return iter(self.partitions)
+
+    def poll(self):
+        self.polls += 1
+        if self.polls == 5:
+            self.partitions = ['a-1', 'a-2']
+
+
+class TestWait(unittest.TestCase):
+
+    def _make_one(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, queue=False)
+        worker.wait_interval = 0.05
+        worker.partitioner = DummyPartitioner()
+        return worker
+
+    def test_poll_while_waiting(self):
+        worker = self._make_one()
+        worker.partitioner.partitions = ['a-1']
+        worker.partitioner.poll = lambda: None
+        start = time.time()
+        worker.wait(1)
+        # the backoff is kept, despite the short poll interval
+        self.assertTrue(time.time() - start >= 0.07)
+
+    def _wait_woken_up(self, worker, wake_up):
+        worker.wait_interval = 60
+        timer = threading.Timer(0.05, wake_up)
+        timer.start()
+        start = time.time()
+        worker.wait(0)
+        timer.join()
+        return time.time() - start
+
+    def test_drain_static(self):
+        from qdo.worker import StaticPartitioner
+        worker = self._make_one()
+        worker.partitioner = StaticPartitioner('/worker', set=['a-1'])
+        # the static partitioner isn't polled while waiting
+        self.assertEqual(worker.partitioner.poll_interval, None)
+        self.assertTrue(self._wait_woken_up(worker, worker.drain) < 1)
+        self.assertTrue(worker.draining)
+
+    def test_drain_lanes(self):
+        from qdo.worker import StaticPartitioner
+        worker = _make_worker(BaseTestCase.queuey_app_key, queue=False,
+            extra={'lanes.count': 1})[0]
+        worker.partitioner = StaticPartitioner('/worker', set=['a-1'])
+        # a message in flight makes the worker wait for the lanes
+        worker.lanes.in_flight['a-1'] = 1
+        self.assertTrue(self._wait_woken_up(worker, worker.drain) < 1)
+        self.assertEqual(worker.lanes.completed(), [])
+
+    def test_stop(self):
+        worker = self._make_one()
+        self.assertTrue(self._wait_woken_up(worker, worker.stop) < 1)
+        self.assertTrue(worker.shutdown)
+
+    def test_sigterm(self):
+        from qdo.worker import StaticPartitioner
+        worker = self._make_one()
+        worker.partitioner = StaticPartitioner('/worker', set=['a-1'])
+        previous = signal.signal(signal.SIGTERM, worker.handle_sigterm)
+        try:
+            seconds = self._wait_woken_up(worker,
+                lambda: os.kill(os.getpid(), signal.SIGTERM))
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        self.assertTrue(seconds < 1, seconds)
+        self.assertTrue(worker.draining)
+
+    def test_wake_up_on_change(self):
+        worker = self._make_one()
+        worker.wait_interval = 10
+        start = time.time()
+        worker.wait(0)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(worker.partitioner.polls, 5)
+
+
+class TestQuarantine(unittest.TestCase):
+
+    def _make_one(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, extra={
+            'quarantine.max_failures': 2}, queue=False)
+        worker.partition_cache['a-1'] = DummyPartition('a-1')
+        self.failures = []
+
+        def job_failure(message, context, name, exc, queuey_conn):
+            self.failures.append((message['body'], exc))
+
+        worker.job_failure = job_failure
+        return worker
+
+    def test_quarantine(self):
+        from qdo.quarantine import PoisonMessage
+        worker = self._make_one()
+        calls = []
+
+        def job(message, context):
+            calls.append(message['body'])
+            raise ValueError
+
+        message = {'body': 'a', 'message_id': 'abc'}
+        for i in range(3):
+            worker.run_job(job, 'a-1', message, {})
+        # the job isn't run a third time
+        self.assertEqual(calls, ['a', 'a'])
+        self.assertEqual(len(self.failures), 3)
+        self.assertTrue(isinstance(self.failures[2][1], PoisonMessage))
+        self.assertEqual(worker.quarantine.quarantined, 1)
+
+    def test_success(self):
+        worker = self._make_one()
+
+        def job(message, context):
+            if message['body'] == 'fail':
+                message['body'] = 'ok'
+                raise ValueError
+
+        message = {'body': 'fail', 'message_id': 'abc'}
+        worker.run_job(job, 'a-1', message, {})
+        self.assertEqual(worker.quarantine.failures(message), 1)
+        worker.run_job(job, 'a-1', message, {})
+        self.assertEqual(worker.quarantine.failures(message), 0)
+
+    def test_attempts(self):
+        worker = self._make_one()
+        calls = []
+        worker.run_job(lambda m, c: calls.append(m), 'a-1',
+            {'body': 'a', 'message_id': 'abc', 'attempts': 2}, {})
+        self.assertEqual(calls, [])
+        self.assertEqual(len(self.failures), 1)
+
+
+class TestJobTimeout(unittest.TestCase):
+
+    def _make_one(self, recycle=False):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, extra={
+            'qdo-worker.job_timeout': '0.05',
+            'qdo-worker.job_timeout_recycle': recycle}, queue=False)
+        worker.partition_cache['a-1'] = DummyPartition('a-1')
+        self.failures = []
+
+        def job_failure(message, context, name, exc, queuey_conn):
+            self.failures.append(exc)
+
+        worker.job_failure = job_failure
+        worker.watchdog.start()
+        self.addCleanup(worker.watchdog.stop)
+        return worker
+
+    def _hang(self, message, context):
+        time.sleep(1)
+
+    def test_timeout(self):
+        from qdo.watchdog import JobTimeout
+        worker = self._make_one()
+        self.assertTrue(worker.run_job(self._hang, 'a-1',
+            {'body': 'a', 'message_id': 'abc'}, {}))
+        self.assertEqual(len(self.failures), 1)
+        self.assertTrue(isinstance(self.failures[0], JobTimeout))
+        self.assertFalse(worker.shutdown)
+        self.assertTrue(worker.watchdog.healthy)
+
+    def test_recycle(self):
+        worker = self._make_one(recycle=True)
+        worker.run_job(self._hang, 'a-1',
+            {'body': 'a', 'message_id': 'abc'}, {})
+        self.assertEqual(len(self.failures), 1)
+        self.assertTrue(worker.shutdown)
+        self.assertFalse(worker.watchdog.healthy)
+
+
+class TestLanes(unittest.TestCase):
+
+    def _make_one(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, extra={
+            'lanes.count': 1, 'lanes.threshold': '0.01',
+            'lanes.min_jobs': 1}, queue=False)
+        worker.partition_cache['a-1'] = DummyPartition('a-1')
+        worker.partition_cache['b-1'] = DummyPartition('b-1')
+        self.failures = []
+
+        def job_failure(message, context, name, exc, queuey_conn):
+            self.failures.append((message['body'], name))
+
+        worker.job_failure = job_failure
+        return worker
+
+    def test_slow_lane(self):
+        worker = self._make_one()
+
+        def job(message, context):
+            if message['body'] == 'slow':
+                time.sleep(0.02)
+            elif message['body'] == 'fail':
+                raise ValueError
+
+        worker.lanes.start(job, worker.job_context)
+        self.addCleanup(worker.lanes.stop, 1)
+        worker.run_job(job, 'a-1', {'body': 'slow', 'message_id': 'abc'}, {})
+        worker.run_job(job, 'b-1', {'body': 'fast', 'message_id': 'abc'}, {})
+        self.assertFalse(worker.lanes.lane('a-1') is None)
+        self.assertTrue(worker.lanes.lane('b-1') is None)
+        message_id = uuid.uuid1().hex
+        worker.lanes.submit('a-1', {'body': 'fail',
+            'message_id': message_id, 'timestamp': str(time.time())})
+        self.assertTrue(worker.lanes.wait(1))
+        worker.collect_lanes({})
+        self.assertEqual(self.failures, [('fail', 'a-1')])
+        partition = worker.partition_cache['a-1']
+        self.assertEqual(partition.last_message, message_id)
+
+    def test_stop(self):
+        worker = self._make_one()
+
+        def job(message, context):
+            raise StopWorker
+
+        worker.lanes.start(job, worker.job_context)
+        self.addCleanup(worker.lanes.stop, 1)
+        worker.lanes.record('a-1', 1)
+        worker.lanes.submit('a-1', {'body': 'a', 'message_id': 'abc'})
+        worker.lanes.wait(1)
+        worker.collect_lanes({})
+        self.assertTrue(worker.shutdown)
+        self.assertEqual(worker.partition_cache['a-1'].last_message, None)
+
+
+class TestUnordered(unittest.TestCase):
+
+    def _make_one(self):
+        worker, _ = _make_worker(BaseTestCase.queuey_app_key, extra={
+            'unordered.queues': 'a*', 'unordered.threads': 2}, queue=False)
+        worker.partition_cache['a-1'] = DummyPartition('a-1')
+        worker.partition_cache['b-1'] = DummyPartition('b-1')
+        return worker
+
+    def _messages(self, count):
+        return [{'body': str(i), 'message_id': uuid.uuid1().hex,
+            'timestamp': str(time.time())} for i in range(count)]
+
+    def test_is_unordered(self):
+        worker = self._make_one()
+        self.assertTrue(worker.is_unordered('a'))
+        self.assertTrue(worker.is_unordered('abc'))
+        self.assertFalse(worker.is_unordered('b'))
+        self.assertEqual(worker.lanes.pool_size, 2)
+
+    def test_dispatch(self):
+        worker = self._make_one()
+        first = threading.Event()
+
+        def job(message, context):
+            if message['body'] == '0':
+                # the first message finishes last
+                first.wait(1)
+
+        worker.lanes.start(job, worker.job_context)
+        self.addCleanup(worker.lanes.stop, 1)
+        partition = worker.partition_cache['a-1']
+        messages = self._messages(3)
+        worker.dispatch(partition, messages, {})
+        self.assertEqual(partition.position, messages[2]['message_id'])
+        self.assertEqual(worker.lanes.in_flight['a-1'], 3)
+        while len(worker.lanes) > 1:
+            worker.lanes.wait(1)
+            worker.collect_lanes({})
+        # the checkpoint waits for the first message
+        self.assertEqual(partition.last_message, None)
+        first.set()
+        worker.lanes.wait(1)
+        worker.collect_lanes({})
+        self.assertEqual(partition.last_message, messages[2]['message_id'])
+        self.assertEqual(partition.position, messages[2]['message_id'])
+        self.assertEqual(len(partition.tracker), 0)
+
+    def test_fetch_limit(self):
+        worker = self._make_one()
+        worker.max_in_flight = 3
+        partition = worker.partition_cache['a-1']
+        self.assertEqual(worker.fetch_limit(partition, True), 3)
+        messages = self._messages(3)
+        for message in messages:
+            partition.tracker.dispatch(message['message_id'])
+        # later messages are done, the first one is stuck
+        partition.tracker.complete(messages[1]['message_id'])
+        partition.tracker.complete(messages[2]['message_id'])
+        self.assertEqual(worker.fetch_limit(partition, True), 0)
+        partition.tracker.complete(messages[0]['message_id'])
+        self.assertEqual(worker.fetch_limit(partition, True), 3)
+        self.assertEqual(worker.fetch_limit(partition, False), 2)
+
+    def test_release(self):
+        worker = self._make_one()
+        partition = worker.partition_cache['a-1']
+        worker.dispatch(partition, self._messages(2), {})
+        worker.release(['a-1'])
+        self.assertEqual(len(partition.tracker), 0)
+        self.assertEqual(worker.lanes.discarded, set(['a-1']))
+
 
 class TestKazooWorker(BaseTestCase, KazooTestHarness):
 
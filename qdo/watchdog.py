@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import signal
+import threading
+import time
+
+from qdo.log import get_logger
+
+
+class JobTimeout(Exception):
+    """Raised inside a job, which exceeded its time budget."""
+
+
+def _in_main_thread():
+    return threading.current_thread().name == 'MainThread'
+
+
+class Watchdog(object):
+    """Enforces a time budget for each job.
+
+    Inside the main thread a `SIGALRM` timer raises :py:class:`JobTimeout`
+    inside the job once it runs for longer than `timeout` seconds. Jobs
+    which can't be interrupted, for example because they are blocked inside
+    a C extension or run in a lane or pool thread, are detected by a
+    background thread, which checks the start time of the current job of
+    each thread. Once such a job runs for twice its budget, the worker is
+    marked as unhealthy and with `recycle` the process is terminated, so it
+    can be restarted by its process manager.
+
+    :param timeout: Time budget of a single job in seconds. Zero disables
+        the watchdog.
+    :type timeout: float
+    :param recycle: Terminate the process if a job can't be interrupted.
+    :type recycle: bool
+    """
+
+    def __init__(self, timeout=0, recycle=False):
+        self.timeout = timeout
+        self.recycle = recycle
+        self.healthy = True
+        self.expired = 0
+        # start time of the current job by thread id
+        self._started = {}
+        self._active = False
+        self._use_signal = False
+        self._previous_handler = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self.timeout)
+
+    def _alarm(self, signum, frame):
+        # if the signal arrives inside `call` itself, the job has returned
+        # already and its result must not be turned into a timeout
+        if self._active and frame.f_code is not _CALL_CODE:
+            self._active = False
+            self.expired += 1
+            raise JobTimeout('Job exceeded its time budget of %s seconds' %
+                self.timeout)
+
+    def start(self):
+        """Install the signal handler and start the watchdog thread."""
+        if not self.enabled or self._thread is not None:
+            return
+        self._use_signal = _in_main_thread()
+        if self._use_signal:
+            self._previous_handler = signal.signal(
+                signal.SIGALRM, self._alarm)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+            name='qdo-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the watchdog thread and restore the signal handler."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join(self.timeout)
+        self._thread = None
+        if self._use_signal:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._previous_handler or
+                signal.SIG_DFL)
+            self._use_signal = False
+
+    def call(self, func, *args, **kwargs):
+        """Call `func` with the given arguments, enforcing the time budget
+        and return its result. Only a function implemented in Python can be
+        interrupted, the signal is ignored once control is back in this
+        method, so a job which returned just in time never fails.
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        ident = threading.current_thread().ident
+        use_signal = self._use_signal and _in_main_thread()
+        self._started[ident] = time.time()
+        if use_signal:
+            self._active = True
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if use_signal:
+                self._active = False
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            self._started.pop(ident, None)
+
+    def check(self, now=None):
+        """Check the currently running jobs of all threads. Returns `False`
+        if any of them exceeded twice its time budget.
+        """
+        started = self._started.values()
+        if not started:
+            return True
+        started = min(started)
+        if now is None:
+            now = time.time()
+        if now - started < 2 * self.timeout:
+            return True
+        self.healthy = False
+        return False
+
+    def _run(self):
+        interval = min(self.timeout / 2.0, 1.0)
+        while not self._stopped.is_set():
+            self._stopped.wait(interval)
+            healthy = self.healthy
+            if self.check():
+                continue
+            if self.recycle:
+                try:
+                    get_logger().error(
+                        'Job hung for more than %s seconds, terminating '
+                        'the worker process' % (2 * self.timeout))
+                finally:
+                    os._exit(1)
+            elif healthy:
+                get_logger().error('Job hung for more than %s seconds, '
+                    'marking the worker as unhealthy' % (2 * self.timeout))
+
+
+_CALL_CODE = Watchdog.call.__func__.__code__
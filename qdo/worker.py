@@ -5,21 +5,48 @@
 
 import atexit
 from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from functools import partial
 import os
 import random
+import signal
 import time
 import socket
+import threading
 
 from kazoo.client import KazooClient
 from queuey_py import Client
 from ujson import decode as ujson_decode
-from ujson import encode as ujson_encode
 
+from qdo.breaker import CircuitBreakers
+from qdo.config import ERROR_PARTITIONS
 from qdo.config import ERROR_QUEUE
+from qdo.errors import ErrorQueueWriter
+from qdo.errors import get_writer
+from qdo.errors import post_failed_messages
+from qdo.errors import register_writer
 from qdo.config import STATUS_PARTITIONS
 from qdo.config import STATUS_QUEUE
+from qdo.lag import LagTracker
+from qdo.lag import LatencyTracker
+from qdo.lanes import Lanes
 from qdo.partition import Partition
-from qdo.log import get_logger
+from qdo.partitioner import Coordinator
+from qdo.partitioner import IncrementalPartitioner
+from qdo.partitioner import LoadBalancer
+from qdo.partitioner import STRATEGIES
+from qdo.partitioner import StaticPartitioner
+from qdo.profiler import JobProfiler
+from qdo.quarantine import PoisonMessage
+from qdo.quarantine import Quarantine
+from qdo.retry import RetryPolicy
+from qdo.retry import RetryQueue
+from qdo.log import log_raven
+from qdo.log import make_metrics
+from qdo.monitor import StatusServer
+from qdo.monitor import WorkerStats
+from qdo.watchdog import JobTimeout
+from qdo.watchdog import Watchdog
 
 
 @contextmanager
@@ -33,19 +60,11 @@ def dict_context():
         del context
 
 
-def _log_raven():
-    """Log exceptions using metlog-raven if it's configured."""
-    logger = get_logger()
-    raven = getattr(logger, 'raven', None)
-    if raven is not None:
-        raven()
-
-
 def log_failure(message, context, queue, exc, queuey_conn):
     """A simple job failure handler. It logs a full traceback for any failed
     job using `metlog-raven`.
     """
-    _log_raven()
+    log_raven()
 
 
 def save_failed_message(message, context, queue, exc, queuey_conn):
@@ -57,17 +76,25 @@ def save_failed_message(message, context, queue, exc, queuey_conn):
     debugging purposes. The failed messages are left in their original queues
     untouched, but will be purged after the shorter but configurable Queuey
     default TTL (3 days).
+
+    Inside a worker the messages are buffered and posted in batches by a
+    background thread. The worker holds back the checkpoint of a partition
+    until all its failed messages have been stored.
     """
 
-    _log_raven()
+    log_raven()
     # record <queue>-<partition> of the failed message
     message['queue'] = queue
+    message['attempts'] = message.get('attempts', 0) + 1
+    writer = get_writer(queuey_conn)
+    if writer is not None:
+        writer.put(message)
+        return
     try:
-        queuey_conn.post(ERROR_QUEUE, data=ujson_encode(message),
-            headers={'X-TTL': '2592000'})  # thirty days
+        post_failed_messages(queuey_conn, [message])
     except Exception:  # pragma: no cover
         # never fail in the failure handler itself
-        _log_raven()
+        log_raven()
 
 
 def resolve(worker, section, name):
@@ -79,42 +106,27 @@ def resolve(worker, section, name):
         setattr(worker, name, func)
 
 
-class StopWorker(Exception):
-    """An exception which causes the worker loop to shut down cleanly.
-    Especially useful in writing tests.
-    """
-
-
-class StaticPartitioner(object):
-    """A partitioner using a static set list. Basic API compatibility
-    with the `kazoo.recipe.SetPartitioner` is preserved.
+def backoff(interval, waited, jitter=None):
+    """Returns the number of seconds to wait, after `waited` consecutive
+    rounds without any messages. The wait doubles each round, up to
+    `interval * 1024` and is randomized by 20% to spread out the polls of
+    multiple workers.
     """
+    if jitter is None:
+        jitter = random.uniform(0.8, 1.2)
+    return interval * jitter * 2 ** min(waited, 10)
 
-    failed = False
-    release = False
-    allocating = True
-    acquired = False
-
-    def __init__(self, path, set, identifier=None, time_boundary=0):
-        # path and time_boundary are ignored and only here for API
-        # compatibility with the kazoo version
-        self._set = set
-        self._identifier = identifier
-
-    def __iter__(self):
-        for s in self._set:
-            yield s
 
-    def wait_for_acquire(self, timeout=0):
-        self.allocating = False
-        self.acquired = True
+def _job_partitions(partitions):
+    # the error and status queues are never worked on
+    return [p for p in partitions if not
+        p.startswith((ERROR_QUEUE, STATUS_QUEUE))]
 
-    def release_set(self):  # pragma: no cover
-        pass
 
-    def finish(self):
-        self.acquired = False
-        self.failed = True
+class StopWorker(Exception):
+    """An exception which causes the worker loop to shut down cleanly.
+    Especially useful in writing tests.
+    """
 
 
 class PartitionCache(dict):
@@ -139,24 +151,52 @@ class Worker(object):
     def __init__(self, settings):
         self.settings = settings
         self.shutdown = False
+        self.draining = False
+        # cuts a wait short, once the worker has to drain or stop
+        self._wakeup = threading.Event()
         self.job = None
         self.job_context = dict_context
         self.job_failure = log_failure
         self.partition_policy = 'manual'
         self.queuey_conn = None
         self.zk = None
+        # replaceable, for example by qdo.testing.FakeZooKeeper().client
+        self.zk_client_class = KazooClient
         self.partitioner = None
+        self.balancer = None
+        self.coordinator = None
+        self.fixed_partitions = False
         self.partition_cache = PartitionCache(self)
+        self.stats = WorkerStats()
+        self.buffers = {}
+        self.deferred = {}
         self.configure()
 
     def configure(self):
         # Configure the worker based on the configuration settings.
         qdo_section = self.settings.getsection('qdo-worker')
-        self.name = '%s-%s' % (socket.getfqdn(), os.getpid())
         identifier = qdo_section['name']
-        if identifier:
-            self.name += '-' + identifier
+        self.stable_name = qdo_section['stable_name']
+        if self.stable_name:
+            if not identifier:
+                raise ValueError('A stable_name requires a name.')
+            # a stable identity, which survives restarts
+            self.name = '%s-%s' % (socket.getfqdn(), identifier)
+        else:
+            self.name = '%s-%s' % (socket.getfqdn(), os.getpid())
+            if identifier:
+                self.name += '-' + identifier
         self.wait_interval = qdo_section['wait_interval']
+        self.lag = LagTracker(qdo_section['lag_interval'])
+        self.latency = LatencyTracker(qdo_section['metrics_interval'])
+        self.metrics = make_metrics(qdo_section['metrics_interval'])
+        self.watchdog = Watchdog(float(qdo_section['job_timeout']),
+            recycle=qdo_section['job_timeout_recycle'])
+        self.profiler = None
+        if qdo_section['profile_every']:
+            self.profiler = JobProfiler(qdo_section['profile_every'],
+                interval=qdo_section['profile_interval'],
+                path=qdo_section['profile_path'])
         resolve(self, qdo_section, 'job')
         resolve(self, qdo_section, 'job_context')
         resolve(self, qdo_section, 'job_failure')
@@ -164,12 +204,55 @@ class Worker(object):
         self.queuey_conn = Client(
             queuey_section['app_key'],
             connection=queuey_section['connection'])
+        self.error_writer = ErrorQueueWriter(self.queuey_conn,
+            capacity=qdo_section['error_buffer_size'],
+            batch_size=qdo_section['error_batch_size'],
+            interval=qdo_section['error_flush_interval'])
+        register_writer(self.queuey_conn, self.error_writer)
+        self.buffers['errors'] = self.error_writer
+        retry_section = self.settings.getsection('retry')
+        self.retries = RetryQueue(RetryPolicy(
+            attempts=retry_section['attempts'],
+            backoff=float(retry_section['backoff']),
+            max_backoff=float(retry_section['max_backoff']),
+            exceptions=retry_section['exceptions']),
+            capacity=retry_section['capacity'])
+        breaker_section = self.settings.getsection('breaker')
+        self.breakers = CircuitBreakers(
+            scope=breaker_section['scope'],
+            threshold=float(breaker_section['threshold']),
+            window=breaker_section['window'],
+            min_jobs=breaker_section['min_jobs'],
+            probe_interval=breaker_section['probe_interval'])
+        unordered_section = self.settings.getsection('unordered')
+        self.unordered_queues = unordered_section['queues']
+        if isinstance(self.unordered_queues, basestring):
+            self.unordered_queues = [self.unordered_queues]
+        self.max_in_flight = unordered_section['max_in_flight']
+        self._unordered = {}
+        pool_size = 0
+        if self.unordered_queues:
+            pool_size = unordered_section['threads']
+        lanes_section = self.settings.getsection('lanes')
+        self.lanes = Lanes(lanes_section['count'],
+            threshold=float(lanes_section['threshold']),
+            min_jobs=lanes_section['min_jobs'], pool_size=pool_size)
+        self.buffers['lanes'] = self.lanes
+        quarantine_section = self.settings.getsection('quarantine')
+        self.quarantine = Quarantine(
+            max_failures=quarantine_section['max_failures'],
+            capacity=quarantine_section['capacity'])
         zk_section = self.settings.getsection('zookeeper')
         self.zk_hosts = zk_section['connection']
         self.zk_party_wait = zk_section['party_wait']
+        status_section = self.settings.getsection('status')
+        self.status_server = None
+        if status_section['port'] or status_section['file']:
+            self.status_server = StatusServer(self,
+                port=status_section['port'], file=status_section['file'])
 
     def setup_zookeeper(self):
-        self.zk = KazooClient(hosts=self.zk_hosts, max_retries=1)
+        self.zk = self.zk_client_class(hosts=self.zk_hosts, max_retries=1)
         self.zk.start()
 
     def all_partitions(self):
@@ -185,32 +268,64 @@ class Worker(object):
                 partitions.append('%s-%s' % (name, i))
         return partitions
 
+    def discover_partitions(self):
+        """List all partitions and create the error and status queues, if
+        they don't exist yet. Returns all partitions.
+        """
+        queuey_conn = self.queuey_conn
+        all_partitions = self.all_partitions()
+
+        def cond_create(queue_name, partitions):
+            if queue_name + '-1' not in all_partitions:
+                queuey_conn.create_queue(
+                    queue_name=queue_name, partitions=partitions)
+        cond_create(ERROR_QUEUE, ERROR_PARTITIONS)
+        cond_create(STATUS_QUEUE, STATUS_PARTITIONS)
+        return all_partitions
+
     def configure_partitions(self):
         section = self.settings.getsection('partitions')
         self.partition_policy = policy = section['policy']
-        queuey_conn = self.queuey_conn
-        all_partitions = self.all_partitions()
         partition_ids = section.get('ids')
+        self.fixed_partitions = bool(partition_ids)
         partitioner_class = StaticPartitioner
-        if not partition_ids:
-            partition_ids = all_partitions
         if policy == 'automatic':
+            strategy = section['strategy']
+            if strategy not in STRATEGIES and strategy != 'weighted':
+                raise ValueError('Unknown partition strategy: %r' % strategy)
+            partition_func = STRATEGIES.get(strategy)
+            if strategy == 'consistent_hash':
+                partition_func = partial(partition_func,
+                    replicas=section['replicas'])
             self.setup_zookeeper()
-            partitioner_class = self.zk.SetPartitioner
-
-        partition_ids = [p for p in partition_ids if not
-            p.startswith((ERROR_QUEUE, STATUS_QUEUE))]
+            # a single, elected worker lists the queues for all others
+            self.coordinator = Coordinator(self.zk, '/worker', self.name,
+                self.discover_partitions,
+                interval=section['discovery_interval'])
+            all_partitions = self.coordinator.wait(self.zk_party_wait)
+            if all_partitions is None:
+                # nobody published the partitions in time
+                all_partitions = self.discover_partitions()
+            if strategy == 'weighted':
+                self.balancer = LoadBalancer(self.zk, '/worker', self.name,
+                    interval=section['balance_interval'],
+                    tolerance=float(section['balance_tolerance']))
+            partitioner_class = partial(IncrementalPartitioner, self.zk,
+                partition_func=partition_func, balancer=self.balancer,
+                grace_period=section['grace_period'],
+                lease_timeout=section['lease_timeout'],
+                handoff_timeout=section['handoff_timeout'],
+                capacity=float(section['capacity']),
+                max_partitions=section['max_partitions'],
+                takeover=self.stable_name)
+        else:
+            all_partitions = self.discover_partitions()
+        if not partition_ids:
+            partition_ids = all_partitions
 
         self.partitioner = partitioner_class(
-            '/worker', set=tuple(partition_ids), identifier=self.name,
-            time_boundary=self.zk_party_wait)
-
-        def cond_create(queue_name):
-            if queue_name + '-1' not in all_partitions:
-                queuey_conn.create_queue(
-                    queue_name=queue_name, partitions=STATUS_PARTITIONS)
-        cond_create(ERROR_QUEUE)
-        cond_create(STATUS_QUEUE)
+            '/worker', set=tuple(_job_partitions(partition_ids)),
+            identifier=self.name, time_boundary=self.zk_party_wait)
         self.status = self.status_partitions()
 
     def status_partitions(self):
@@ -221,12 +336,16 @@ class Worker(object):
         if len(status_messages) >= 1000:  # pragma: no cover
             # TODO deal with more than 1000 status messages / partitions
             raise RuntimeError('More than 1000 status messages detected!')
+        tokens = {}
         for message in status_messages:
             body = ujson_decode(message['body'])
             partition = body['partition']
-            if partition not in status:
-                # don't overwrite newer messages with older status
+            token = body.get('token') or 0
+            if partition not in status or token > tokens[partition]:
+                # don't overwrite newer messages with older status, unless
+                # they were written by a newer owner
                 status[partition] = message['message_id']
+                tokens[partition] = token
         return status
 
     def work(self):
@@ -237,7 +356,17 @@ class Worker(object):
         self.queuey_conn.connect()
         self.configure_partitions()
         atexit.register(self.stop)
-        timer = get_logger().timer
+        self.watchdog.start()
+        job = self.job
+        if self.profiler is not None:
+            job = self.profiler.wrap(job)
+        self.lanes.start(job, self.job_context, self.watchdog)
+        if self.status_server is not None:
+            self.status_server.start()
+        previous_handler = None
+        if threading.current_thread().name == 'MainThread':
+            previous_handler = signal.signal(signal.SIGTERM,
+                self.handle_sigterm)
         partitioner = self.partitioner
         with self.job_context() as context:
             if partitioner.allocating:
@@ -246,52 +375,432 @@ class Worker(object):
             while 1:
                 if self.shutdown or partitioner.failed:
                     break
+                self.poll_partitioner()
                 if partitioner.release:
+                    if self.draining:
+                        self.finish_in_flight(partitioner.releasing, context)
+                    # stop working on the moved partitions only
+                    self.release(partitioner.releasing)
                     partitioner.release_set()
                 elif partitioner.allocating:
                     partitioner.wait_for_acquire(self.zk_party_wait)
                 elif partitioner.acquired:
                     no_messages = 0
                     partitions = list(self.partitioner)
+                    breakers = self.breakers
+                    lanes = self.lanes
+                    if lanes:
+                        self.collect_lanes(context)
+                    if self.retries:
+                        self.run_retries(job, context)
                     for name in partitions:
+                        if self.shutdown:
+                            break
                         partition = self.partition_cache[name]
-                        messages = partition.messages(limit=2)
+                        queue_name = partition.queue_name
+                        unordered = self.is_unordered(queue_name)
+                        limit = self.fetch_limit(partition, unordered)
+                        if limit <= 0 or name in lanes.discarded:
+                            # the lanes are busy with this partition or its
+                            # uncommitted window is full
+                            no_messages += 1
+                            continue
+                        if not breakers.allow(queue_name):
+                            # paused by an open circuit breaker
+                            no_messages += 1
+                            continue
+                        if unordered and not breakers.closed(queue_name):
+                            # only send a single probe
+                            limit = 1
+                        messages = partition.messages(limit=limit)
                         if not messages:
+                            breakers.cancel(queue_name)
+                            self.lag.caught_up(name)
                             no_messages += 1
                             continue
+                        if unordered:
+                            self.dispatch(partition, messages, context)
+                            continue
                         message = messages[0]
-                        message_id = message['message_id']
-                        try:
-                            with timer('worker.job_time'):
-                                self.job(message, context)
-                        except StopWorker:
-                            self.shutdown = True
-                            break
-                        except Exception as exc:
-                            with timer('worker.job_failure_time'):
-                                self.job_failure(message, context,
-                                    name, exc, self.queuey_conn)
-                        # record successful message processing
-                        partition.last_message = message_id
+                        if lanes.lane(name) is None:
+                            if not self.run_job(job, name, message, context):
+                                break
+                        elif not self.quarantined(name, message, context):
+                            lanes.submit(name, message)
+                            continue
+                        self.message_done(partition, message)
+                    if self.deferred:
+                        self.commit_checkpoints()
+                    if self.lag.due():
+                        self.report_lag(partitions)
+                    if self.latency.due():
+                        self.latency.report()
+                    if self.metrics.due():
+                        self.metrics.flush()
                     if no_messages == len(partitions):
                         # if none of the partitions had a message, wait
                         self.wait(waited)
                         waited += 1
                     else:
                         waited = 0
+            # let the slow lanes finish their messages
+            self.lanes.stop(timeout=self.zk_party_wait)
+            self.collect_lanes(context)
+            # store all failed messages before the final checkpoints
+            self.error_writer.close()
+            self.commit_checkpoints()
             # give up the partitions and leave party
             self.partitioner.finish()
+            if self.coordinator is not None:
+                self.coordinator.finish()
+            self.metrics.flush()
+            if self.profiler is not None:
+                self.profiler.dump()
+            self.watchdog.stop()
+            if self.status_server is not None:
+                self.status_server.stop()
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+
+    def drain(self):
+        """Hand over all partitions to other workers and stop. Before each
+        partition is released, its messages in flight are finished and its
+        checkpoint is committed. The next partition is only released once
+        another worker picked up the previous one.
+        """
+        self.draining = True
+        self.wake_up()
+
+    def wake_up(self):
+        """Interrupt the current :py:meth:`wait` of the worker loop."""
+        self._wakeup.set()
+        self.lanes.interrupt()
+
+    def handle_sigterm(self, signum, frame):
+        """Drain the worker on `SIGTERM`."""
+        # the interrupted main thread might hold the locks needed to wake
+        # it up, so don't take them inside the signal handler
+        thread = threading.Thread(target=self.drain, name='qdo-drain')
+        thread.daemon = True
+        thread.start()
+
+    def finish_in_flight(self, partitions, context):
+        """Wait for the lanes to finish the messages of the given partitions,
+        for at most `party_wait` seconds.
+        """
+        lanes = self.lanes
+        end = time.time() + self.zk_party_wait
+        while [name for name in partitions if lanes.in_flight.get(name)]:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            lanes.wait(remaining)
+            self.collect_lanes(context)
+
+    def run_job(self, job, name, message, context, retry=0):
+        """Run the job for one message of partition `name`. Failed jobs are
+        scheduled for a retry if the retry policy allows it, otherwise the
+        `job_failure` hook is called. Quarantined messages are passed to
+        the `job_failure` hook right away, without running the job. Jobs
+        exceeding the `job_timeout` are interrupted with a
+        :py:class:`~qdo.watchdog.JobTimeout`. Returns `False` if the worker
+        should stop.
+        """
+        if self.quarantined(name, message, context):
+            return True
+        exc = None
+        start = time.time()
+        try:
+            self.watchdog.call(job, message, context)
+        except Exception as exc:
+            pass
+        return self.job_done(name, message, context, exc,
+            time.time() - start, retry)
+
+    def job_done(self, name, message, context, exc, seconds, retry=0):
+        """Handle the outcome of a job, which ran for `seconds` and raised
+        `exc` or `None`. Returns `False` if the worker should stop.
+        """
+        self.metrics.timing('worker.job_time', seconds * 1000)
+        self.lag.job_time(name, seconds)
+        if not self.is_unordered(self.partition_cache[name].queue_name):
+            self.lanes.record(name, seconds)
+        if exc is None:
+            self.record_outcome(name, message, True)
+            return True
+        if isinstance(exc, StopWorker):
+            self.shutdown = True
+            return False
+        if not isinstance(exc, Exception):
+            # system exceptions from a slow lane abort the worker
+            raise exc
+        if isinstance(exc, JobTimeout):
+            self.job_timed_out()
+        self.record_outcome(name, message, False)
+        retries = self.retries
+        if retries.schedule(name, message, exc, retry + 1):
+            self.metrics.incr('worker.job_retry')
+            return True
+        if retries.full:
+            # too many messages wait for a retry, fail this one right away
+            self.metrics.incr('worker.job_retry_overflow')
+        self.job_failed(name, message, context, exc)
+        return True
+
+    def job_failed(self, name, message, context, exc):
+        """Call the `job_failure` hook for `message`."""
+        self.stats.record_failure(name, message['message_id'], exc)
+        with self.metrics.timer('worker.job_failure_time'):
+            self.job_failure(message, context, name, exc, self.queuey_conn)
+
+    def quarantined(self, name, message, context):
+        """Pass a quarantined `message` to the `job_failure` hook, without
+        running its job. Returns `True` if the message was quarantined.
+        """
+        if not self.quarantine.is_poison(message):
+            return False
+        self.metrics.incr('worker.job_quarantined')
+        self.job_failed(name, message, context, PoisonMessage(
+            'Quarantined after %s failures' %
+            self.quarantine.failures(message)))
+        return True
+
+    def is_unordered(self, queue_name):
+        """Can the messages of `queue_name` be processed in any order?"""
+        unordered = self._unordered.get(queue_name)
+        if unordered is None:
+            unordered = False
+            for pattern in self.unordered_queues:
+                if fnmatchcase(queue_name, pattern):
+                    unordered = True
+                    break
+            self._unordered[queue_name] = unordered
+        return unordered
+
+    def fetch_limit(self, partition, unordered):
+        """Returns the number of messages to fetch from `partition`. For
+        unordered partitions all messages above the checkpoint count,
+        whether they are still in flight or already done. A slow or stuck
+        message thus stops the partition after `max_in_flight` messages,
+        which bounds the messages processed again after a crash.
+        """
+        if unordered:
+            return self.max_in_flight - len(partition.tracker)
+        return 0 if self.lanes.busy(partition.name) else 2
+
+    def dispatch(self, partition, messages, context):
+        """Hand out `messages` of an unordered partition to the thread
+        pool, all at once.
+        """
+        name = partition.name
+        tracker = partition.tracker
+        for message in messages:
+            message_id = message['message_id']
+            tracker.dispatch(message_id)
+            partition.position = message_id
+            if self.quarantined(name, message, context):
+                self.message_done(partition, message)
+            else:
+                self.lanes.submit(name, message)
+
+    def message_done(self, partition, message):
+        """Record `message` of `partition` as processed. For unordered
+        partitions the checkpoint only advances up to the newest message,
+        for which all earlier messages have been processed as well.
+        """
+        message_id = message['message_id']
+        tracker = partition.tracker
+        if tracker:
+            watermark = tracker.complete(message_id)
+            if watermark is not None:
+                self.checkpoint(partition, watermark)
+        else:
+            self.checkpoint(partition, message_id)
+        self.lag.processed(partition.name, message_id)
+        self.latency.record(partition.queue_name, message)
+        self.stats.record_processed()
+
+    def collect_lanes(self, context):
+        """Handle the results of all messages finished by slow lanes."""
+        for name, message, exc, seconds in self.lanes.completed():
+            if self.job_done(name, message, context, exc, seconds):
+                self.message_done(self.partition_cache[name], message)
+
+    def job_timed_out(self):
+        """Called after a job has been interrupted by the watchdog. With
+        `job_timeout_recycle` the worker is marked as unhealthy and shuts
+        down after the current message.
+        """
+        self.metrics.incr('worker.job_timeout')
+        if self.watchdog.recycle:
+            self.watchdog.healthy = False
+            self.shutdown = True
+
+    def record_outcome(self, name, message, success):
+        """Feed the outcome of a job for `message` of partition `name` into
+        the circuit breakers and the quarantine.
+        """
+        if success:
+            self.quarantine.record_success(message)
+        else:
+            self.quarantine.record_failure(message)
+        queue_name = self.partition_cache[name].queue_name
+        if self.breakers.record(queue_name, success):
+            self.metrics.incr('worker.breaker_open')
+
+    def run_retries(self, job, context):
+        """Retry all failed messages which are due."""
+        retries = self.retries
+        for name, message, retry in retries.pop_due():
+            try:
+                if not self.run_job(job, name, message, context, retry):
+                    break
+            finally:
+                retries.done(name)
+
+    def release(self, partitions):
+        """Prepare to give up the given partitions. Commit all checkpoints
+        which can be committed and forget about any outstanding work.
+        Messages whose checkpoint couldn't be committed will be processed
+        again by the next owner.
+        """
+        self.commit_checkpoints(flush=True)
+        self.retries.discard(partitions)
+        self.lanes.discard(partitions)
+        cache = self.partition_cache
+        for name in partitions:
+            self.deferred.pop(name, None)
+            if name in cache:
+                # re-read the committed checkpoint, if we get it back
+                cache[name].position = None
+                cache[name].tracker.reset()
+
+    def held(self, name):
+        """Is the checkpoint of partition `name` held back by outstanding
+        work on some of its messages or because the lease on the partition
+        might have been lost?
+        """
+        if self.error_writer.pending(name) or self.retries.pending(name):
+            return True
+        partitioner = self.partitioner
+        return partitioner is not None and not partitioner.holds(name)
+
+    def commit(self, partition, message_id):
+        """Commit the checkpoint of `partition`, together with the fencing
+        token of our ownership. The write isn't conditional on the stored
+        token, so :py:meth:`held` only protects against lost leases on a
+        best-effort basis.
+        """
+        if self.partitioner is not None:
+            partition.token = self.partitioner.token(partition.name)
+        partition.last_message = message_id
+        self.lag.committed(partition.name, message_id)
+
+    def checkpoint(self, partition, message_id):
+        """Record `message_id` as processed. The checkpoint is committed
+        right away, unless messages of the partition are still waiting for
+        a retry or to be saved in the error queue.
+        """
+        if not partition.tracker:
+            # unordered partitions have handed out newer messages already
+            partition.position = message_id
+        if self.held(partition.name):
+            self.deferred[partition.name] = message_id
+        else:
+            self.deferred.pop(partition.name, None)
+            self.commit(partition, message_id)
+
+    def commit_checkpoints(self, flush=False):
+        """Commit deferred checkpoints of all partitions without pending
+        retries or unsaved failed messages. With `flush`, wait for the error
+        queue writer to save all buffered messages first.
+        """
+        if flush:
+            self.error_writer.flush(timeout=self.zk_party_wait)
+        cache = self.partition_cache
+        for name, message_id in self.deferred.items():
+            if not self.held(name):
+                del self.deferred[name]
+                self.commit(cache[name], message_id)
+
+    def report_lag(self, partitions):
+        """Send consumer lag metrics for the given partition names and
+        publish their load for the `weighted` partition strategy.
+        """
+        cache = self.partition_cache
+        try:
+            self.lag.report([cache[name] for name in partitions])
+            if self.balancer is not None:
+                self.balancer.publish(self.lag.loads)
+        except Exception:  # pragma: no cover
+            # lag metrics must never stop the worker
+            log_raven()
 
     def wait(self, waited=1):
-        get_logger().incr('worker.wait_for_jobs')
-        jitter = random.uniform(0.8, 1.2)
-        time.sleep(self.wait_interval * jitter * 2 ** min(waited, 10))
+        """Wait for new messages with an exponential backoff. The wait ends
+        early if a lane finished a message, the partitions changed or the
+        worker has to drain or stop.
+        """
+        self.metrics.incr('worker.wait_for_jobs')
+        seconds = backoff(self.wait_interval, waited)
+        for wakeup in (self.retries.next_due(), self.breakers.next_probe()):
+            if wakeup is not None:
+                # wake up in time for the next retry or breaker probe
+                seconds = max(min(seconds, wakeup - time.time()), 0)
+        self.stats.record_idle(seconds)
+        partitioner = self.partitioner
+        interval = None
+        if partitioner is not None:
+            interval = partitioner.poll_interval
+        wakeup = self._wakeup
+        end = time.time() + seconds
+        while not (wakeup.is_set() or self.shutdown):
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            if interval:
+                remaining = min(remaining, interval)
+            if self.lanes:
+                # wake up as soon as a slow lane finished a message
+                if self.lanes.wait(remaining):
+                    break
+            else:
+                wakeup.wait(remaining)
+            if interval and self.poll_partitioner():
+                # keep up with membership changes, without fetching
+                break
+        wakeup.clear()
+
+    def poll_partitioner(self):
+        """Follow newly discovered partitions and poll the partitioner.
+        Returns `True` if the partitioner has to be attended to, because
+        it releases or allocates partitions or the owned partitions have
+        changed.
+        """
+        partitioner = self.partitioner
+        if self.draining and not partitioner.draining:
+            # hand over all partitions before stopping
+            partitioner.drain()
+        changed = False
+        coordinator = self.coordinator
+        if (coordinator is not None and coordinator.poll() and
+                not self.fixed_partitions):
+            # follow newly discovered queues, unless the partitions are fixed
+            partitioner.update_set(_job_partitions(coordinator.partitions))
+            changed = True
+        owned = list(partitioner)
+        partitioner.poll()
+        return (changed or partitioner.release or partitioner.allocating or
+            partitioner.failed or list(partitioner) != owned)
 
     def stop(self):
         """Stop the worker loop. Used in an `atexit` hook."""
         self.shutdown = True
+        self.wake_up()
         if self.zk is not None:
             self.partitioner.finish()
+            if self.coordinator is not None:
+                self.coordinator.finish()
             self.zk.stop()
 
 